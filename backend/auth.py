@@ -4,7 +4,14 @@ from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+import asyncio
+import hashlib
+import hmac
 import os
+import time
 from models import User, UserResponse
 
 # Security configuration
@@ -12,8 +19,18 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 часа
 
+# Кэш проверенных токенов: {sha256(token): (principal, expires_at)} в порядке LRU.
+# Запись живет не дольше TTL и не дольше срока действия токена (exp)
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get("TOKEN_CACHE_MAX_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = int(os.environ.get("TOKEN_CACHE_TTL_SECONDS", "300"))
+
+# bcrypt считается в отдельном пуле потоков, чтобы не блокировать цикл событий;
+# размер пула ограничивает число одновременных вычислений хеша (нагрузку на CPU)
+PASSWORD_HASH_CONCURRENCY = max(1, int(os.environ.get("PASSWORD_HASH_CONCURRENCY", "2")))
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="password-hash")
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -21,6 +38,20 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password в пуле потоков паролей"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    """get_password_hash в пуле потоков паролей"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, get_password_hash, password)
+
+def secrets_equal(provided: str, expected: str) -> bool:
+    """Сравнение секретов за постоянное время"""
+    return hmac.compare_digest(provided.encode("utf-8"), expected.encode("utf-8"))
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -31,30 +62,111 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    credentials_exception = HTTPException(
+def build_user_principal(payload: dict) -> dict:
+    """Собрать данные пользователя (включая права администратора) из payload токена"""
+    user_id = payload.get("sub")
+    return {
+        "user_id": payload.get("user_id", user_id),
+        "sub": payload.get("sub", user_id),
+        "is_admin": payload.get("is_admin", False),
+        "is_super_admin": payload.get("is_super_admin", False),
+        "role": payload.get("role", "user")
+    }
+
+verified_token_cache = OrderedDict()
+token_cache_stats = {"hits": 0, "misses": 0}
+
+def credentials_error() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def decode_user_token(token: str) -> MappingProxyType:
+    """Проверить токен и вернуть неизменяемые данные пользователя (с кэшем проверенных токенов)"""
+    token_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    now = time.time()
+    cached = verified_token_cache.get(token_key)
+    if cached is not None:
+        principal, expires_at = cached
+        if expires_at > now:
+            verified_token_cache.move_to_end(token_key)
+            token_cache_stats["hits"] += 1
+            return principal
+        del verified_token_cache[token_key]
+    token_cache_stats["misses"] += 1
+
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        raise credentials_error()
+    if payload.get("sub") is None:
+        raise credentials_error()
 
-    # Return user info including admin rights
+    principal = MappingProxyType(build_user_principal(payload))
+    expires_at = now + TOKEN_CACHE_TTL_SECONDS
+    if isinstance(payload.get("exp"), (int, float)):
+        expires_at = min(expires_at, payload["exp"])
+    verified_token_cache[token_key] = (principal, expires_at)
+    while len(verified_token_cache) > TOKEN_CACHE_MAX_SIZE:
+        verified_token_cache.popitem(last=False)
+    return principal
+
+def get_token_cache_stats() -> dict:
+    """Счетчики кэша проверенных токенов"""
+    lookups = token_cache_stats["hits"] + token_cache_stats["misses"]
     return {
-        "user_id": payload.get("user_id", user_id),
-        "sub": payload.get("sub", user_id),
-        "is_admin": payload.get("is_admin", False),
-        "is_super_admin": payload.get("is_super_admin", False),
-        "role": payload.get("role", "user")
+        "hits": token_cache_stats["hits"],
+        "misses": token_cache_stats["misses"],
+        "hit_rate": round(token_cache_stats["hits"] / lookups, 4) if lookups else 0,
+        "size": len(verified_token_cache),
+        "max_size": TOKEN_CACHE_MAX_SIZE,
+        "ttl_seconds": TOKEN_CACHE_TTL_SECONDS
     }
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Return user info including admin rights
+    return decode_user_token(credentials.credentials)
+
+
+optional_security = HTTPBearer(auto_error=False)
+
+# Подписанные ссылки на файл для <video>/<img>/<iframe>, которые не умеют передавать
+# заголовок Authorization: ссылка действует только для одного файла и ограниченное время,
+# токен сессии в URL (историю браузера, логи, Referer) не попадает
+MEDIA_URL_TTL_SECONDS = int(os.environ.get("MEDIA_URL_TTL_SECONDS", "7200"))
+MEDIA_URL_KEY = hmac.new(SECRET_KEY.encode("utf-8"), b"media-url", hashlib.sha256).digest()
+
+def media_url_signature(file_id: str, expires: int) -> str:
+    return hmac.new(MEDIA_URL_KEY, f"{file_id}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+def create_media_url_params(file_id: str) -> dict:
+    """Параметры подписанной ссылки на файл: {"expires", "signature"}"""
+    expires = int(time.time()) + MEDIA_URL_TTL_SECONDS
+    return {"expires": expires, "signature": media_url_signature(file_id, expires)}
+
+async def get_file_access(
+    file_id: str,
+    expires: Optional[int] = None,
+    signature: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Доступ к файлу по заголовку Authorization или по подписанной ссылке на этот файл"""
+    if credentials is not None:
+        return decode_user_token(credentials.credentials)
+    if expires is not None and signature:
+        if expires > time.time() and secrets_equal(signature, media_url_signature(file_id, expires)):
+            return MappingProxyType({"file_id": file_id, "signed_url": True})
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid or expired file link",
+        )
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Not authenticated",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
 
 async def get_current_user_full(credentials: HTTPAuthorizationCredentials = Depends(security), db=None):
     """Get full user object from database"""
@@ -104,54 +216,39 @@ def create_user_response(user: User) -> UserResponse:
         created_at=user.created_at
     )
 
-async def ensure_super_admin_exists(db):
-    """Создаем суперадминистратора при первом запуске"""
-    SUPER_ADMIN_EMAIL = "dmitrii.malahov@gmail.com"
-    SUPER_ADMIN_PASSWORD = "756bvy67H"
+async def ensure_super_admin_exists(db, email: str, password: str, full_name: str = "Суперадминистратор") -> dict:
+    """Создать или обновить учетную запись суперадминистратора (при запуске сервера).
+    Пароль хешируется заново, только если сохраненный хеш ему не соответствует"""
+    existing_admin = await db.users.find_one({"email": email})
     
-    # Проверяем, существует ли уже суперадминистратор
-    existing_admin = await db.users.find_one({"email": SUPER_ADMIN_EMAIL})
+    admin_update = {
+        "email": email,
+        "username": email,
+        "is_admin": True,
+        "is_super_admin": True
+    }
+    stored_hash = (existing_admin or {}).get("password_hash")
+    if not stored_hash or not await verify_password_async(password, stored_hash):
+        admin_update["password_hash"] = await get_password_hash_async(password)
     
-    if not existing_admin:
-        # Создаем суперадминистратора
-        super_admin = User(
-            email=SUPER_ADMIN_EMAIL,
-            password_hash=get_password_hash(SUPER_ADMIN_PASSWORD),
-            full_name="Дмитрий Малахов (Суперадминистратор)",
-            birth_date="01.01.1980",
-            city="Москва",
-            is_premium=True,
-            is_super_admin=True,
-            credits_remaining=1000000  # Безлимитные кредиты
-        )
-        
-        await db.users.insert_one(super_admin.dict())
-        print(f"✅ Создан суперадминистратор: {SUPER_ADMIN_EMAIL}")
-    else:
-        # Обновляем существующего пользователя до суперадминистратора и сбрасываем пароль
+    if existing_admin is None or any(existing_admin.get(key) != value for key, value in admin_update.items()):
+        now = datetime.utcnow()
+        admin_update["updated_at"] = now
         await db.users.update_one(
-            {"email": SUPER_ADMIN_EMAIL},
-            {"$set": {
-                "is_super_admin": True,
-                "is_premium": True,
-                "credits_remaining": 1000000,
-                "password_hash": get_password_hash(SUPER_ADMIN_PASSWORD),
-                "updated_at": datetime.utcnow()
-            }}
+            {"email": email},
+            {
+                "$set": admin_update,
+                "$setOnInsert": {
+                    "full_name": full_name,
+                    "created_at": now
+                }
+            },
+            upsert=True
         )
-        # Гарантируем доступ к административным эндпоинтам (создаем запись admin_users)
-        existing_admin_user = await db.users.find_one({"email": SUPER_ADMIN_EMAIL})
-        if existing_admin_user:
-            await db.admin_users.update_one(
-                {"user_id": existing_admin_user.get("id")},
-                {"$set": {
-                    "user_id": existing_admin_user.get("id"),
-                    "role": "super_admin",
-                    "permissions": ["video_management", "user_management", "content_management"]
-                }},
-                upsert=True
-            )
-        print(f"✅ Обновлен статус суперадминистратора и пароль: {SUPER_ADMIN_EMAIL}")
+        print(f"✅ Учетная запись суперадминистратора обновлена: {email}")
+        existing_admin = await db.users.find_one({"email": email})
+    
+    return existing_admin
 
 def require_super_admin(current_user: dict, db):
     """Декоратор для проверки прав суперадминистратора"""
@@ -0,0 +1,78 @@
+"""
+Задержка цикла событий при одновременных входах.
+
+Сравнивает проверку пароля bcrypt прямо в цикле событий (как было в login_v2)
+и через пул потоков паролей (verify_password_async). Пока идут входы, фоновая
+задача каждые 5 мс замеряет, насколько позже срока она просыпается; максимум этой
+задержки - сколько ждали бы все остальные запросы сервера.
+
+Запуск: cd backend && python bench/bench_password_hashing.py [--logins 20] [--rounds 12]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passlib.context import CryptContext
+
+import auth
+
+TICK_SECONDS = 0.005
+
+
+async def measure_loop_stall(scenario) -> tuple:
+    """Выполнить сценарий; вернуть (максимальная задержка цикла, общее время) в секундах"""
+    max_stall = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal max_stall
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(TICK_SECONDS)
+            max_stall = max(max_stall, time.perf_counter() - started - TICK_SECONDS)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK_SECONDS * 2)
+    started = time.perf_counter()
+    await scenario()
+    elapsed = time.perf_counter() - started
+    running = False
+    await ticker_task
+    return max_stall, elapsed
+
+
+async def main(logins: int, rounds: int):
+    context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+    # Сервер использует auth.pwd_context; подменяем, чтобы задать стоимость хеша
+    auth.pwd_context = context
+    password = "bench-password"
+    hashed = context.hash(password)
+
+    async def login_sync():
+        # Прежний вход: verify_password блокирует цикл событий
+        await asyncio.sleep(0)
+        assert auth.verify_password(password, hashed)
+
+    async def login_async():
+        assert await auth.verify_password_async(password, hashed)
+
+    print(f"{logins} одновременных входов, bcrypt rounds={rounds}, "
+          f"PASSWORD_HASH_CONCURRENCY={auth.PASSWORD_HASH_CONCURRENCY}")
+    for name, login in (("в цикле событий", login_sync), ("в пуле потоков", login_async)):
+        stall, elapsed = await measure_loop_stall(
+            lambda: asyncio.gather(*[login() for _ in range(logins)])
+        )
+        print(f"  {name:18} макс. задержка цикла {stall * 1000:8.1f} мс, все входы за {elapsed * 1000:8.1f} мс")
+    auth.password_executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=20, help="число одновременных входов")
+    parser.add_argument("--rounds", type=int, default=12, help="стоимость bcrypt (passlib по умолчанию - 12)")
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, args.rounds))
@@ -0,0 +1,182 @@
+"""
+Статистика файлов студента (/api/student/my-files-stats/{lesson_id}).
+
+Сравнивает прежнюю реализацию (все события студента из file_analytics в память и
+подсчет двумя проходами по списку на каждый файл) с текущей ($group по file_id в MongoDB
+и соединение через словари). Сначала проверяется, что ответы совпадают, затем
+замеряется медиана времени запроса целиком и отдельно - прежнего соединения в Python.
+
+Данные создаются во временной базе, которая удаляется после замера.
+
+Запуск: cd backend && python bench/bench_student_files_stats.py --mongodb-url mongodb://localhost:27017
+        (без MongoDB: --mongomock - только проверка ответов и время соединения в Python;
+         нужен mongomock-motor из requirements-dev.txt)
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+BENCH_DB_NAME = "bench_student_files_stats"
+LESSON_ID = "bench-lesson"
+USER_ID = "bench-student"
+
+
+def old_join(files: list, analytics: list, video_stats: list) -> dict:
+    """Прежнее соединение файлов с событиями и временем просмотра (без изменений)"""
+    files_data = []
+    total_views = 0
+    total_downloads = 0
+    total_video_minutes = 0
+    total_video_points = 0
+
+    for file_doc in files:
+        file_id = file_doc.get("id")
+
+        file_views = sum(1 for a in analytics if a.get("file_id") == file_id and a.get("action") == "view")
+        file_downloads = sum(1 for a in analytics if a.get("file_id") == file_id and a.get("action") == "download")
+
+        total_views += file_views
+        total_downloads += file_downloads
+
+        video_data = None
+        if file_doc.get("mime_type", "").startswith("video/"):
+            video_stat = next((v for v in video_stats if v.get("file_id") == file_id), None)
+            if video_stat:
+                minutes = video_stat.get("total_minutes", 0)
+                points = video_stat.get("total_points", 0)
+                total_video_minutes += minutes
+                total_video_points += points
+                video_data = {
+                    "minutes_watched": minutes,
+                    "points_earned": points
+                }
+
+        files_data.append({
+            "file_id": file_id,
+            "file_name": file_doc.get("original_name"),
+            "file_type": file_doc.get("file_type"),
+            "section": file_doc.get("section"),
+            "mime_type": file_doc.get("mime_type"),
+            "views": file_views,
+            "downloads": file_downloads,
+            "video_stats": video_data
+        })
+
+    return {
+        "files": files_data,
+        "summary": {
+            "total_files": len(files),
+            "total_views": total_views,
+            "total_downloads": total_downloads,
+            "total_video_minutes": total_video_minutes,
+            "total_video_points": total_video_points
+        }
+    }
+
+
+async def old_fetch(db) -> tuple:
+    files = await db.files.find({"lesson_id": LESSON_ID}).to_list(length=None)
+    analytics = await db.file_analytics.find({"lesson_id": LESSON_ID, "user_id": USER_ID}).to_list(length=None)
+    video_stats = await db.video_watch_time.find({"lesson_id": LESSON_ID, "user_id": USER_ID}).to_list(length=None)
+    return files, analytics, video_stats
+
+
+async def old_student_files_stats(db) -> dict:
+    return old_join(*(await old_fetch(db)))
+
+
+async def seed(db, files_count: int, events_count: int):
+    rng = random.Random(20)
+    files = []
+    for index in range(files_count):
+        is_video = index % 3 == 0
+        files.append({
+            "id": f"file-{index}",
+            "lesson_id": LESSON_ID,
+            "original_name": f"file-{index}.{'mp4' if is_video else 'pdf'}",
+            "file_type": "media" if is_video else "document",
+            "section": rng.choice(["theory", "exercises", "challenge"]),
+            "mime_type": "video/mp4" if is_video else "application/pdf"
+        })
+    await db.files.insert_many(files)
+    await db.file_analytics.insert_many([
+        {
+            "id": f"event-{index}",
+            "file_id": rng.choice(files)["id"],
+            "lesson_id": LESSON_ID,
+            "user_id": USER_ID,
+            "action": rng.choice(["view", "view", "download"]),
+            "created_at": datetime.utcnow()
+        }
+        for index in range(events_count)
+    ])
+    await db.video_watch_time.insert_many([
+        {"file_id": file_doc["id"], "lesson_id": LESSON_ID, "user_id": USER_ID,
+         "total_minutes": rng.randint(1, 60), "total_points": rng.randint(1, 600)}
+        for file_doc in files if file_doc["mime_type"].startswith("video/")
+    ])
+    # Индекс, который добавлен вместе с группировкой (init-mongo.js)
+    await db.file_analytics.create_index([("user_id", 1), ("lesson_id", 1), ("file_id", 1), ("action", 1)])
+
+
+async def median_ms(call, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+async def main(args):
+    if args.mongomock:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+    else:
+        client = server.AsyncIOMotorClient(args.mongodb_url)
+    db = client[BENCH_DB_NAME]
+    server.db = db
+    await client.drop_database(BENCH_DB_NAME)
+    try:
+        await seed(db, args.files, args.events)
+        current_user = {"user_id": USER_ID}
+
+        old = await old_student_files_stats(db)
+        new = await server.get_student_files_stats(LESSON_ID, current_user)
+        print(f"{args.files} файлов, {args.events} событий; ответы совпадают: {old == new}")
+
+        fetched = await old_fetch(db)
+        join_started = time.perf_counter()
+        for _ in range(args.repeat):
+            old_join(*fetched)
+        join_ms = (time.perf_counter() - join_started) * 1000 / args.repeat
+
+        print(f"  прежнее соединение в Python {join_ms:8.2f} мс")
+        if args.mongomock:
+            # mongomock выполняет агрегации на Python - время запросов к базе не показательно
+            return
+        old_ms = await median_ms(lambda: old_student_files_stats(db), args.repeat)
+        new_ms = await median_ms(lambda: server.get_student_files_stats(LESSON_ID, current_user), args.repeat)
+        print(f"  прежний запрос целиком      {old_ms:8.2f} мс (медиана из {args.repeat})")
+        print(f"  текущий запрос целиком      {new_ms:8.2f} мс")
+    finally:
+        await client.drop_database(BENCH_DB_NAME)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongodb-url", default=os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--mongomock", action="store_true", help="без сервера MongoDB (нужен mongomock-motor: pip install -r requirements-dev.txt)")
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,58 @@
+"""
+Стоимость проверки токена в get_current_user.
+
+Сравнивает прежнюю проверку (jwt.decode и сборка данных пользователя на каждый запрос)
+с decode_user_token: повторный токен (попадание в кэш) и каждый раз новый токен (промах,
+decode плюс запись в кэш).
+
+Запуск: cd backend && python bench/bench_token_cache.py [--number 20000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jose import jwt
+
+import auth
+
+
+def decode_uncached(token: str) -> dict:
+    """Прежний get_current_user"""
+    payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+    if payload.get("sub") is None:
+        raise auth.credentials_error()
+    return auth.build_user_principal(payload)
+
+
+def make_token(index: int) -> str:
+    return auth.create_access_token({"sub": f"user-{index}", "user_id": f"user-{index}", "is_admin": False})
+
+
+def per_call_us(stmt, number: int) -> float:
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e6
+
+
+def main(number: int):
+    token = make_token(0)
+    auth.decode_user_token(token)
+    miss_tokens = iter([make_token(index) for index in range(1, 5 * number + 1)])
+
+    print(f"{number} проверок токена, лучший из 5 прогонов")
+    results = (
+        ("без кэша (прежняя проверка)", per_call_us(lambda: decode_uncached(token), number)),
+        ("кэш, повторный токен", per_call_us(lambda: auth.decode_user_token(token), number)),
+        ("кэш, новый токен (промах)", per_call_us(lambda: auth.decode_user_token(next(miss_tokens)), number)),
+    )
+    for name, microseconds in results:
+        print(f"  {name:30} {microseconds:8.2f} мкс")
+    print(f"  {auth.get_token_cache_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="число проверок в одном прогоне")
+    args = parser.parse_args()
+    main(args.number)
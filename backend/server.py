@@ -4,22 +4,45 @@
 Отдельный инстанс для тестирования новой системы обучения
 """
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import motor.motor_asyncio
+import numpy as np
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from collections import OrderedDict
+import asyncio
 import os
+import time
+import json
+import base64
+import hashlib
+import tempfile
+import shutil
+from email.utils import formatdate, parsedate_to_datetime
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import List, Optional, Union
 import uuid
 import logging
 import traceback
 
 # Импорты моделей и функций
 from models import LessonV2, TheoryBlock, Exercise, Challenge, ChallengeDay, Quiz, QuizQuestion, LessonFile
-from auth import get_current_user, create_access_token, get_password_hash, verify_password
+from auth import (
+    get_current_user,
+    get_file_access,
+    create_media_url_params,
+    MEDIA_URL_TTL_SECONDS,
+    create_access_token,
+    get_password_hash_async,
+    verify_password_async,
+    secrets_equal,
+    ensure_super_admin_exists,
+    password_executor,
+    get_token_cache_stats
+)
 
 # Импорт базы данных (глобальный объект db)
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -77,8 +100,8 @@ class QuizAttemptRequest(BaseModel):
     """Модель для сохранения результата прохождения теста"""
     lesson_id: str
     quiz_id: str
-    score: int
-    passed: bool
+    score: Optional[int] = None  # Не используется: балл вычисляется на сервере
+    passed: Optional[bool] = None  # Не используется: результат вычисляется на сервере
     answers: dict  # {question_id: answer}
 
 
@@ -100,13 +123,232 @@ class VideoWatchTimeRequest(BaseModel):
     minutes_watched: int  # Количество минут просмотра
 
 
+# ===== КЭШ УРОКОВ =====
+# Уроки меняются редко, а читаются почти каждым запросом студента. Документы кэшируются
+# в памяти по id вместе с меткой updated_at: по истечении TTL запись перепроверяется
+# легким запросом метки и загружается заново только если урок изменился.
+# Для согласованности между воркерами можно включить слушатель change stream
+# (LESSON_CACHE_CHANGE_STREAM=true, требуется replica set).
+
+LESSON_CACHE_TTL_SECONDS = int(os.getenv("LESSON_CACHE_TTL_SECONDS", "60"))
+LESSON_CACHE_CHANGE_STREAM = os.getenv("LESSON_CACHE_CHANGE_STREAM", "false").lower() in ("1", "true", "yes")
+
+# {lesson_id: {"lesson": dict, "structure": dict, "stamp": updated_at, "expires_at": float}}
+lesson_cache = {}
+# {_id: lesson_id} - для событий удаления из change stream (в них есть только _id)
+lesson_cache_ids_by_oid = {}
+lesson_change_stream_task = None
+
+
+def cache_lesson(lesson: dict) -> dict:
+    """Поместить документ урока в кэш (документ не должен изменяться вызывающим кодом)"""
+    lesson_id = lesson.get("id")
+    lesson_cache[lesson_id] = {
+        "lesson": lesson,
+        "structure": build_lesson_structure(lesson),
+        "stamp": lesson.get("updated_at"),
+        "expires_at": time.monotonic() + LESSON_CACHE_TTL_SECONDS
+    }
+    if lesson.get("_id") is not None:
+        lesson_cache_ids_by_oid[lesson["_id"]] = lesson_id
+    return lesson
+
+
+def invalidate_lesson_cache(lesson_id: Optional[str] = None):
+    """Сбросить кэш одного урока (или всех уроков, если id не указан)"""
+    if lesson_id is None:
+        lesson_cache.clear()
+        lesson_cache_ids_by_oid.clear()
+        quiz_answer_key_cache.clear()
+        return
+    entry = lesson_cache.pop(lesson_id, None)
+    if entry and entry["lesson"].get("_id") is not None:
+        lesson_cache_ids_by_oid.pop(entry["lesson"]["_id"], None)
+    quiz_answer_key_cache.pop(lesson_id, None)
+
+
+async def get_cached_lesson(lesson_id: str) -> Optional[dict]:
+    """Получить урок по id из кэша (с перепроверкой метки updated_at после TTL)"""
+    entry = lesson_cache.get(lesson_id)
+    if entry is not None:
+        if entry["expires_at"] >= time.monotonic():
+            return entry["lesson"]
+
+        # TTL истек: сверяем метку версии, не перечитывая весь документ
+        stamp_doc = await db.lessons_v2.find_one({"id": lesson_id}, {"_id": 0, "updated_at": 1})
+        if stamp_doc is None:
+            invalidate_lesson_cache(lesson_id)
+            return None
+        if stamp_doc.get("updated_at") == entry["stamp"]:
+            entry["expires_at"] = time.monotonic() + LESSON_CACHE_TTL_SECONDS
+            return entry["lesson"]
+
+    lesson = await db.lessons_v2.find_one({"id": lesson_id})
+    if lesson is None:
+        invalidate_lesson_cache(lesson_id)
+        return None
+    return cache_lesson(lesson)
+
+
+async def get_cached_lessons(lesson_ids: List[str]) -> dict:
+    """Получить несколько уроков: {lesson_id: lesson}; промахи загружаются одним запросом"""
+    result = {}
+    missing_ids = []
+    now = time.monotonic()
+    for lesson_id in set(lesson_ids):
+        entry = lesson_cache.get(lesson_id)
+        if entry is not None and entry["expires_at"] >= now:
+            result[lesson_id] = entry["lesson"]
+        else:
+            missing_ids.append(lesson_id)
+
+    if missing_ids:
+        lessons = await db.lessons_v2.find({"id": {"$in": missing_ids}}).to_list(length=None)
+        for lesson in lessons:
+            result[lesson.get("id")] = cache_lesson(lesson)
+    return result
+
+
+async def watch_lesson_changes():
+    """Слушатель change stream коллекции lessons_v2: сбрасывает кэш при изменениях из других воркеров"""
+    while True:
+        try:
+            async with db.lessons_v2.watch(full_document="updateLookup") as stream:
+                logger.info("Lesson cache change stream listener started")
+                async for change in stream:
+                    full_document = change.get("fullDocument") or {}
+                    lesson_id = full_document.get("id")
+                    if lesson_id is None:
+                        lesson_id = lesson_cache_ids_by_oid.get((change.get("documentKey") or {}).get("_id"))
+                    if lesson_id is None and change.get("operationType") != "insert":
+                        # Неизвестный урок (например, удален до попадания в кэш) - сбрасываем все
+                        invalidate_lesson_cache()
+                    else:
+                        invalidate_lesson_cache(lesson_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Lesson cache change stream error, retrying in 5s: {str(e)}")
+            invalidate_lesson_cache()
+            await asyncio.sleep(5)
+
+
+# ===== ОДНОКРАТНЫЕ ПЕРЕНОСЫ ДАННЫХ =====
+# Материализованные коллекции (журнал баллов, сводки и т.п.) заполняются из истории один раз
+# на базу фоновой задачей после запуска - сервер принимает запросы сразу, а до завершения
+# переноса материализованные данные могут быть неполными. Выполнение отмечается документом
+# в schema_migrations: параллельно запущенные воркеры его не повторяют, а прерванный перенос
+# перезапускается при следующем запуске (зависший - после таймаута).
+
+BACKFILL_STALE_SECONDS = int(os.getenv("BACKFILL_STALE_SECONDS", "3600"))
+startup_backfill_task = None
+
+
+async def run_backfill_once(name: str, backfill) -> bool:
+    """Выполнить перенос данных backfill() один раз; False - уже выполнен или выполняется"""
+    now = datetime.utcnow()
+    try:
+        await db.schema_migrations.insert_one({"_id": name, "status": "running", "started_at": now})
+    except DuplicateKeyError:
+        # Перенос уже выполнен или выполняется; подхватываем только зависший
+        claimed = await db.schema_migrations.update_one(
+            {
+                "_id": name,
+                "status": "running",
+                "started_at": {"$lt": now - timedelta(seconds=BACKFILL_STALE_SECONDS)}
+            },
+            {"$set": {"started_at": now}}
+        )
+        if claimed.modified_count == 0:
+            return False
+    
+    try:
+        result = await backfill()
+    except (Exception, asyncio.CancelledError):
+        # Метка снимается (в том числе при остановке сервера) - перенос повторится при следующем запуске
+        await db.schema_migrations.delete_one({"_id": name})
+        raise
+    await db.schema_migrations.update_one(
+        {"_id": name},
+        {"$set": {"status": "completed", "result": result, "finished_at": datetime.utcnow()}}
+    )
+    logger.info(f"Backfill {name} completed: {result}")
+    return True
+
+
+async def backfill_points() -> dict:
+    """Журнал начислений и балансы из исходных коллекций"""
+    return {"entries": await backfill_points_ledger()}
+
+
+async def backfill_activity_daily() -> dict:
+    """Дневные сводки активности из истории"""
+    return {"documents": await rebuild_activity_daily()}
+
+
+async def backfill_challenge_notes() -> dict:
+    """Заметки челленджей из daily_notes попыток"""
+    return {"notes": await rebuild_challenge_notes()}
+
+
+async def backfill_file_stats() -> dict:
+    """Счетчики файлов из file_analytics (сброс буфера событий на время перестройки заблокирован)"""
+    async with file_analytics_flush_lock:
+        return {"files": await rebuild_file_stats()}
+
+
+async def run_startup_backfills():
+    """Однократные переносы данных (фоновая задача, запускается при старте сервера)"""
+    for name, backfill in (
+        ("points_ledger_v1", backfill_points),
+        ("activity_daily_v1", backfill_activity_daily),
+        ("challenge_notes_v1", backfill_challenge_notes),
+        ("file_stats_v1", backfill_file_stats),
+    ):
+        try:
+            await run_backfill_once(name, backfill)
+        except Exception as e:
+            logger.error(f"Backfill {name} failed: {str(e)}")
+
+
 # Инициализация подключения к MongoDB
 @app_v2.on_event("startup")
 async def startup_event():
+    global lesson_change_stream_task, file_analytics_flush_task, upload_session_sweep_task, points_reconcile_task, startup_backfill_task
+    if LESSON_CACHE_CHANGE_STREAM:
+        lesson_change_stream_task = asyncio.create_task(watch_lesson_changes())
+    file_analytics_flush_task = asyncio.create_task(run_file_analytics_flusher())
+    upload_session_sweep_task = asyncio.create_task(run_upload_session_sweeper())
+    points_reconcile_task = asyncio.create_task(run_points_reconciler())
+    try:
+        # Учетная запись суперадминистратора создается один раз при запуске, а не при каждом входе
+        await ensure_super_admin_exists(db, SUPER_ADMIN_EMAIL, SUPER_ADMIN_PASSWORD)
+    except Exception as e:
+        logger.error(f"Error provisioning super admin: {str(e)}")
+    startup_backfill_task = asyncio.create_task(run_startup_backfills())
     logger.info("Learning System V2 запущен и подключен к MongoDB")
 
 @app_v2.on_event("shutdown")
 async def shutdown_event():
+    if startup_backfill_task is not None and not startup_backfill_task.done():
+        # Перенос счетчиков файлов держит блокировку сброса буфера - останавливаем его первым
+        startup_backfill_task.cancel()
+        await asyncio.gather(startup_backfill_task, return_exceptions=True)
+    if lesson_change_stream_task is not None:
+        lesson_change_stream_task.cancel()
+    if file_analytics_flush_task is not None:
+        file_analytics_flusher_stopping.set()
+        file_analytics_flush_requested.set()
+        await file_analytics_flush_task
+    if upload_session_sweep_task is not None:
+        upload_session_sweep_task.cancel()
+    if points_reconcile_task is not None:
+        points_reconcile_task.cancel()
+    for task in list(quiz_regrade_tasks.values()):
+        task.cancel()
+    # Записываем накопленные, но еще не сохраненные события аналитики файлов
+    await flush_file_analytics_buffer()
+    password_executor.shutdown(wait=False)
     logger.info("Learning System V2 остановлен")
 
 # ===== API ТОЛЬКО ДЛЯ СИСТЕМЫ ОБУЧЕНИЯ V2 =====
@@ -129,32 +371,16 @@ async def login_v2(request_data: dict):
     is_super_admin = email == SUPER_ADMIN_EMAIL
 
     if is_super_admin:
-        if password != SUPER_ADMIN_PASSWORD:
+        if not secrets_equal(password, SUPER_ADMIN_PASSWORD):
             raise HTTPException(status_code=401, detail="Неверные учетные данные")
 
-        now = datetime.utcnow()
-        admin_update = {
-            "email": email,
-            "username": email,
-            "full_name": request_data.get("name") or "Суперадминистратор",
-            "is_admin": True,
-            "is_super_admin": True,
-            "password_hash": get_password_hash(password),
-            "updated_at": now
-        }
-
-        await db.users.update_one(
-            {"email": email},
-            {
-                "$set": admin_update,
-                "$setOnInsert": {
-                    "created_at": now
-                }
-            },
-            upsert=True
-        )
-
         user_doc = await db.users.find_one({"email": email})
+        if user_doc is None or not user_doc.get("is_super_admin"):
+            # Учетная запись не была создана при запуске (например, БД была недоступна)
+            user_doc = await ensure_super_admin_exists(
+                db, email, password, request_data.get("name") or "Суперадминистратор"
+            )
+            invalidate_user_name_cache(email)
         access_token = create_access_token({
             "sub": email,
             "user_id": user_doc.get("username", email),
@@ -183,17 +409,18 @@ async def login_v2(request_data: dict):
             "email": email,
             "username": email,
             "full_name": request_data.get("name") or email.split('@')[0],
-            "password_hash": get_password_hash(password),
+            "password_hash": await get_password_hash_async(password),
             "is_admin": False,
             "is_super_admin": False,
             "created_at": now,
             "updated_at": now
         }
         await db.users.insert_one(new_user)
+        invalidate_user_name_cache(email)
         user_doc = new_user
     else:
         stored_hash = user_doc.get("password_hash")
-        if not stored_hash or not verify_password(password, stored_hash):
+        if not stored_hash or not await verify_password_async(password, stored_hash):
             raise HTTPException(status_code=401, detail="Неверные учетные данные")
 
         if user_doc.get("is_admin") or user_doc.get("is_super_admin"):
@@ -223,6 +450,13 @@ async def login_v2(request_data: dict):
         }
     }
 
+@app_v2.get("/api/admin/auth/token-cache")
+async def get_token_cache_stats_endpoint(current_user: dict = Depends(get_current_user)):
+    """Статистика кэша проверенных токенов (попадания/промахи)"""
+    if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+    return get_token_cache_stats()
+
 @app_v2.get("/api/user/profile")
 async def get_user_profile_v2(current_user: dict = Depends(get_current_user)):
     """Получить профиль пользователя для системы обучения V2"""
@@ -248,29 +482,183 @@ async def get_user_profile_v2(current_user: dict = Depends(get_current_user)):
         "is_super_admin": user_doc.get("is_super_admin", False)
     }
 
+# ===== СПРАВОЧНИК ИМЕН ПОЛЬЗОВАТЕЛЕЙ =====
+# Отображаемые имена для аналитики: много пользователей - одним запросом $in, с TTL-кэшем.
+# Вход (создание пользователя, суперадминистратор) сбрасывает запись кэша.
+
+USER_NAME_CACHE_TTL_SECONDS = int(os.getenv("USER_NAME_CACHE_TTL_SECONDS", "300"))
+USER_NAME_CACHE_MAX_SIZE = 10000
+
+# {username: (display_name или None для неизвестного пользователя, expires_at)}
+user_name_cache = {}
+
+
+def invalidate_user_name_cache(username: Optional[str] = None):
+    """Сбросить кэш имен (для одного пользователя или целиком)"""
+    if username is None:
+        user_name_cache.clear()
+    else:
+        user_name_cache.pop(username, None)
+
+
+async def resolve_user_names(user_ids) -> dict:
+    """Отображаемые имена пользователей: {user_id: full_name или username}.
+    Неизвестные пользователи в результат не попадают; промахи кэша загружаются одним запросом"""
+    now = time.monotonic()
+    result = {}
+    missing_ids = []
+    for user_id in set(user_ids):
+        if not user_id:
+            continue
+        cached = user_name_cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            if cached[0] is not None:
+                result[user_id] = cached[0]
+        else:
+            missing_ids.append(user_id)
+    
+    if missing_ids:
+        users = await db.users.find(
+            {"username": {"$in": missing_ids}},
+            {"_id": 0, "username": 1, "full_name": 1}
+        ).to_list(length=None)
+        found = {user.get("username"): user.get("full_name") or user.get("username") for user in users}
+        
+        if len(user_name_cache) + len(missing_ids) > USER_NAME_CACHE_MAX_SIZE:
+            for key in [key for key, (_, expires_at) in user_name_cache.items() if expires_at <= now]:
+                del user_name_cache[key]
+            if len(user_name_cache) + len(missing_ids) > USER_NAME_CACHE_MAX_SIZE:
+                user_name_cache.clear()
+        
+        expires_at = now + USER_NAME_CACHE_TTL_SECONDS
+        for user_id in missing_ids:
+            user_name_cache[user_id] = (found.get(user_id), expires_at)
+            if found.get(user_id) is not None:
+                result[user_id] = found[user_id]
+    
+    return result
+
+
+# ===== СПИСКИ УРОКОВ: КРАТКИЙ РЕЖИМ И ПАГИНАЦИЯ =====
+
+# Краткое представление урока для списков: поля карточки и размеры разделов вместо их содержимого
+LESSON_SUMMARY_FIELDS = {
+    "id": 1,
+    "title": 1,
+    "description": 1,
+    "module": 1,
+    "level": 1,
+    "order": 1,
+    "points_required": 1,
+    "is_active": 1,
+    "analytics_enabled": 1,
+    "created_at": 1,
+    "updated_at": 1,
+    "theory_count": {"$size": {"$ifNull": ["$theory", []]}},
+    "exercises_count": {"$size": {"$ifNull": ["$exercises", []]}},
+    "has_challenge": {"$ne": [{"$ifNull": ["$challenge", None]}, None]},
+    "challenge_days": {"$ifNull": ["$challenge.duration_days", None]},
+    "has_quiz": {"$ne": [{"$ifNull": ["$quiz", None]}, None]},
+    "quiz_questions_count": {"$size": {"$ifNull": ["$quiz.questions", []]}}
+}
+LESSONS_PAGE_DEFAULT_LIMIT = 100
+LESSONS_PAGE_MAX_LIMIT = 1000
+
+
+def build_lesson_summary_projection(fields: Optional[str]) -> dict:
+    """Проекция для краткого режима; fields - необязательный список полей через запятую"""
+    if not fields:
+        selected = list(LESSON_SUMMARY_FIELDS)
+    else:
+        selected = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in selected if field not in LESSON_SUMMARY_FIELDS]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Неизвестные поля: {', '.join(unknown)}. Доступны: {', '.join(LESSON_SUMMARY_FIELDS)}"
+            )
+
+    projection = {"_id": 0, "id": 1, "order": 1}  # id и order нужны для курсора
+    for field in selected:
+        projection[field] = LESSON_SUMMARY_FIELDS[field]
+    return projection
+
+
+def encode_lessons_cursor(lesson: dict) -> str:
+    """Курсор следующей страницы: позиция (order, id) последнего урока"""
+    raw = json.dumps([lesson.get("order"), lesson.get("id")])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def build_lessons_cursor_filter(cursor: Optional[str]) -> dict:
+    """Условие выборки уроков после курсора (сортировка по order, затем по id)"""
+    if not cursor:
+        return {}
+    try:
+        order, lesson_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    return {"$or": [
+        {"order": {"$gt": order}},
+        {"order": order, "id": {"$gt": lesson_id}}
+    ]}
+
+
+async def find_lessons_page(
+    base_filter: dict,
+    projection: Optional[dict],
+    limit: int,
+    cursor: Optional[str]
+) -> dict:
+    """Страница уроков, упорядоченных по (order, id), и курсор следующей страницы"""
+    limit = max(1, min(limit, LESSONS_PAGE_MAX_LIMIT))
+    cursor_filter = build_lessons_cursor_filter(cursor)
+    query = {"$and": [base_filter, cursor_filter]} if cursor_filter else base_filter
+
+    lessons = await db.lessons_v2.find(query, projection).sort(
+        [("order", 1), ("id", 1)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(lessons) > limit:
+        lessons = lessons[:limit]
+        next_cursor = encode_lessons_cursor(lessons[-1])
+
+    return {"lessons": lessons, "next_cursor": next_cursor}
+
+
 @app_v2.get("/api/learning-v2/lessons")
-async def get_all_lessons_v2_student(current_user: dict = Depends(get_current_user)):
-    """Получить все доступные уроки V2 для студентов"""
+async def get_all_lessons_v2_student(
+    fields: Optional[str] = None,
+    limit: int = LESSONS_PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Получить список доступных уроков V2 для студентов (краткий режим)
+
+    Возвращает только поля карточки урока и размеры разделов; полный урок
+    отдается эндпоинтом /api/learning-v2/lessons/{lesson_id}.
+    Пагинация по курсору: next_cursor передается в параметр cursor.
+    """
     try:
         user_id = current_user['user_id']
 
-        # Получаем активные уроки
-        lessons = await db.lessons_v2.find({"is_active": True}).sort("order", 1).to_list(1000)
-
-        lessons_list = []
-        for lesson in lessons:
-            lesson_dict = dict(lesson)
-            lesson_dict.pop('_id', None)
-            # Убираем чувствительную информацию
-            lesson_dict.pop('created_by', None)
-            lesson_dict.pop('updated_by', None)
-            lessons_list.append(lesson_dict)
+        page = await find_lessons_page(
+            {"is_active": True},
+            build_lesson_summary_projection(fields),
+            limit,
+            cursor
+        )
 
         return {
-            "lessons": lessons_list,
+            "lessons": page["lessons"],
+            "next_cursor": page["next_cursor"],
             "user_level": 10  # Все уровни доступны для тестирования
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting lessons V2 for student: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error getting lessons: {str(e)}")
@@ -281,14 +669,20 @@ async def get_lesson_v2_student(lesson_id: str, current_user: dict = Depends(get
     try:
         user_id = current_user['user_id']
 
-        lesson = await db.lessons_v2.find_one({"id": lesson_id, "is_active": True})
-        if not lesson:
+        lesson = await get_cached_lesson(lesson_id)
+        if not lesson or not lesson.get("is_active"):
             raise HTTPException(status_code=404, detail="Lesson not found")
 
         lesson_dict = dict(lesson)
         lesson_dict.pop('_id', None)
         lesson_dict.pop('created_by', None)
         lesson_dict.pop('updated_by', None)
+        if lesson_dict.get('quiz'):
+            # Правильные ответы и пояснения приходят только в результатах попытки
+            lesson_dict['quiz'] = dict(lesson_dict['quiz'], questions=[
+                {field: value for field, value in question.items() if field not in QUIZ_ANSWER_FIELDS}
+                for question in lesson_dict['quiz'].get('questions') or []
+            ])
 
         return {
             "lesson": lesson_dict,
@@ -302,8 +696,20 @@ async def get_lesson_v2_student(lesson_id: str, current_user: dict = Depends(get
         raise HTTPException(status_code=500, detail=f"Error getting lesson: {str(e)}")
 
 @app_v2.get("/api/admin/lessons-v2")
-async def get_all_lessons_v2_admin(current_user: dict = Depends(get_current_user)):
-    """Получить все уроки V2 для админа"""
+async def get_all_lessons_v2_admin(
+    mode: str = "full",
+    fields: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Получить уроки V2 для админа
+
+    mode=full (по умолчанию) - полные документы для редактирования,
+    mode=summary - краткий режим с выбором полей (fields).
+    При указании limit или cursor список возвращается постранично.
+    """
     try:
         logger.info(f"Current user: {current_user}")
         # Проверка прав администратора
@@ -311,19 +717,23 @@ async def get_all_lessons_v2_admin(current_user: dict = Depends(get_current_user
             logger.error(f"Access denied for user: {current_user}")
             raise HTTPException(status_code=403, detail="Недостаточно прав")
 
-        logger.info("Access granted, querying lessons...")
-        lessons = await db.lessons_v2.find({}).sort("order", 1).to_list(1000)
-        logger.info(f"Found {len(lessons)} lessons")
+        if mode not in ("full", "summary"):
+            raise HTTPException(status_code=400, detail="mode должен быть full или summary")
 
-        lessons_list = []
-        for lesson in lessons:
-            lesson_dict = dict(lesson)
-            lesson_dict.pop('_id', None)
-            lessons_list.append(lesson_dict)
+        projection = build_lesson_summary_projection(fields) if mode == "summary" else {"_id": 0}
+
+        logger.info("Access granted, querying lessons...")
+        if limit is not None or cursor:
+            page = await find_lessons_page({}, projection, limit or LESSONS_PAGE_DEFAULT_LIMIT, cursor)
+            logger.info(f"Found {len(page['lessons'])} lessons")
+            return page
 
-        logger.info("Successfully processed lessons")
-        return {"lessons": lessons_list}
+        lessons = await db.lessons_v2.find({}, projection).sort("order", 1).to_list(1000)
+        logger.info(f"Found {len(lessons)} lessons")
+        return {"lessons": lessons}
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         logger.error(f"Error getting lessons V2: {str(e)}")
@@ -379,17 +789,42 @@ async def update_lesson_v2(
         if "files" in lesson_data:
             update_data["files"] = lesson_data["files"]
 
-        # Обновляем урок в базе данных
-        result = await db.lessons_v2.update_one(
+        # Обновляем урок в базе данных (возвращаем разделы до изменения для сравнения структуры)
+        previous_lesson = await db.lessons_v2.find_one_and_update(
             {"id": lesson_id},
-            {"$set": update_data}
+            {"$set": update_data},
+            projection={"theory": {"$slice": 1}, "exercises.id": 1, "challenge": 1, "quiz": 1},
+            return_document=ReturnDocument.BEFORE
         )
 
-        if result.matched_count == 0:
+        if previous_lesson is None:
             raise HTTPException(status_code=404, detail="Lesson not found")
 
+        # Полный пересчет прогресса нужен только при изменении структуры урока
+        previous_structure = build_lesson_structure(previous_lesson)
+        new_structure = build_lesson_structure({
+            section: update_data.get(section, previous_lesson.get(section))
+            for section in ("theory", "exercises", "challenge", "quiz")
+        })
+        invalidate_lesson_cache(lesson_id)
+        regrade_job_id = None
+        if "quiz" in lesson_data:
+            answer_key = await save_quiz_answer_key(lesson_id, lesson_data["quiz"])
+            previous_key = compile_quiz_answer_key(lesson_id, previous_lesson.get("quiz"))
+            if (
+                answer_key is not None
+                and previous_key is not None
+                and previous_key["quiz_id"] == answer_key["quiz_id"]
+                and previous_key["version"] != answer_key["version"]
+            ):
+                # Тест изменился - попытки переоцениваются в фоне; попытки замененного теста
+                # (другой quiz_id) остаются с прежней оценкой
+                regrade_job_id = await start_quiz_regrade_job(lesson_id, answer_key, update_data["updated_by"])
+        if new_structure != previous_structure:
+            await recompute_lesson_progress_for_lesson(lesson_id, new_structure)
+
         logger.info(f"Lesson {lesson_id} updated successfully with all sections")
-        return {"message": "Урок успешно обновлен", "lesson_id": lesson_id}
+        return {"message": "Урок успешно обновлен", "lesson_id": lesson_id, "quiz_regrade_job_id": regrade_job_id}
 
     except HTTPException:
         raise
@@ -415,6 +850,16 @@ async def delete_lesson_v2(
         if not lesson:
             raise HTTPException(status_code=404, detail="Урок не найден")
 
+        # Студенты, у которых есть данные по уроку: их аналитика перестроится после удаления
+        affected_user_ids = set()
+        for collection in (db.lesson_progress, db.exercise_responses, db.challenge_progress, db.quiz_attempts):
+            affected_user_ids.update(await collection.distinct("user_id", {"lesson_id": lesson_id}))
+
+        # События удаляемых челленджей и упражнений по дням - вычитаются из сводок студентов
+        removed_activity = await aggregate_activity_daily(
+            "user_id", {"lesson_id": lesson_id}, sources=["challenges", "exercises"]
+        )
+
         # Каскадное удаление связанных данных
         # 1. Удаляем прогресс студентов по этому уроку (если есть коллекция)
         if "lesson_progress" in await db.list_collection_names():
@@ -435,9 +880,31 @@ async def delete_lesson_v2(
         if "challenge_progress" in await db.list_collection_names():
             challenge_result = await db.challenge_progress.delete_many({"lesson_id": lesson_id})
             logger.info(f"Deleted {challenge_result.deleted_count} challenge progress records for lesson {lesson_id}")
+            await db.challenge_notes.delete_many({"lesson_id": lesson_id})
 
         # 5. Удаляем сам урок
         delete_result = await db.lessons_v2.delete_one({"id": lesson_id})
+        invalidate_lesson_cache(lesson_id)
+        await save_quiz_answer_key(lesson_id, None)
+        invalidate_lesson_progress_snapshots(lesson_id)
+        await invalidate_student_analytics(affected_user_ids)
+        # Баллы за удаленные челленджи урока списываются корректирующими записями журнала
+        challenge_points = await db.points_ledger.aggregate([
+            {"$match": {"lesson_id": lesson_id, "source": "challenges"}},
+            {"$group": {"_id": "$user_id", "points": {"$sum": "$points"}}}
+        ]).to_list(length=None)
+        await award_points_many([
+            {"user_id": entry["_id"], "lesson_id": lesson_id, "source": "challenges", "points": -entry["points"], "ref_id": lesson_id}
+            for entry in challenge_points
+        ])
+        await db.activity_daily.delete_many({"scope": "lesson", "scope_id": lesson_id})
+        removed_by_user = {}
+        for day in removed_activity:
+            removed_by_user.setdefault(day["_id"]["scope_id"], {})[day["_id"]["date"]] = {
+                source: day.get(source, 0) for source in ("challenges", "exercises")
+            }
+        for removed_user_id, counts_by_day in removed_by_user.items():
+            await remove_daily_activity(removed_user_id, None, counts_by_day)
         
         if delete_result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Не удалось удалить урок")
@@ -497,6 +964,8 @@ async def upload_lesson_from_file_v2(
         lesson_dict['updated_by'] = current_user.get('user_id', current_user.get('id', 'admin_system'))
 
         result = await db.lessons_v2.insert_one(lesson_dict)
+        invalidate_lesson_cache(lesson_obj.id)
+        await save_quiz_answer_key(lesson_obj.id, lesson_dict.get("quiz"))
 
         return {
             "message": "Урок V2 успешно загружен",
@@ -677,30 +1146,44 @@ async def submit_exercise_response(
             "reviewed_by": None
         }
         
-        # Проверяем, есть ли уже ответ на это упражнение
-        existing_response = await db.exercise_responses.find_one({
-            "user_id": user_id,
-            "lesson_id": lesson_id,
-            "exercise_id": exercise_id
-        })
+        # Атомарно создаем или обновляем ответ; документ "до" показывает, был ли ответ раньше
+        existing_response = await db.exercise_responses.find_one_and_update(
+            {
+                "user_id": user_id,
+                "lesson_id": lesson_id,
+                "exercise_id": exercise_id
+            },
+            {
+                "$set": {
+                    "response_text": response_text,
+                    "submitted_at": response_data["submitted_at"]
+                },
+                "$setOnInsert": {
+                    "id": response_data["id"],
+                    "reviewed": False,
+                    "admin_comment": None,
+                    "reviewed_at": None,
+                    "reviewed_by": None
+                }
+            },
+            projection={"id": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
         
         if existing_response:
-            # Обновляем существующий ответ
-            await db.exercise_responses.update_one(
-                {"_id": existing_response["_id"]},
-                {"$set": {
-                    "response_text": response_text,
-                    "submitted_at": datetime.utcnow()
-                }}
-            )
             response_id = existing_response.get("id", existing_response["_id"])
         else:
-            # Создаем новый ответ
-            await db.exercise_responses.insert_one(response_data)
             response_id = response_data["id"]
         
-        # Обновляем прогресс урока
-        await update_lesson_progress(user_id, lesson_id)
+        # Обновляем прогресс урока и аналитику: новый ответ увеличивает счетчики упражнений
+        await apply_lesson_progress_delta(
+            user_id,
+            lesson_id,
+            exercises_delta=0 if existing_response else 1,
+            analytics_increments={"total_exercises_completed": 0 if existing_response else 1},
+            analytics_daily={"exercises": 0 if existing_response else 1}
+        )
         
         logger.info(f"Exercise response saved: user={user_id}, lesson={lesson_id}, exercise={exercise_id}")
         
@@ -788,225 +1271,446 @@ async def get_exercise_response(
         raise HTTPException(status_code=500, detail=f"Ошибка при получении ответа: {str(e)}")
 
 
-async def update_lesson_progress(user_id: str, lesson_id: str):
-    """Обновить прогресс студента по уроку"""
+# ===== ДВИЖОК ПРОГРЕССА УРОКОВ =====
+# Прогресс хранится в lesson_progress и обновляется дельтами из каждого пути записи
+# (одно атомарное обращение к БД). Полный пересчет по исходным коллекциям выполняется
+# только при изменении структуры урока и при сбросе прогресса.
+
+def build_lesson_structure(lesson: dict) -> dict:
+    """Структура урока, от которой зависит процент завершения"""
+    return {
+        "has_theory": bool(lesson.get("theory")),
+        "total_exercises": len(lesson.get("exercises") or []),
+        "has_challenge": bool(lesson.get("challenge")),
+        "has_quiz": bool(lesson.get("quiz"))
+    }
+
+
+async def get_lesson_structure(lesson_id: str) -> Optional[dict]:
+    """Получить структуру урока. Хранится в записи кэша уроков, поэтому проходит ту же
+    проверку TTL и updated_at, что и сам урок"""
+    lesson = await get_cached_lesson(lesson_id)
+    if not lesson:
+        return None
+    entry = lesson_cache.get(lesson_id)
+    if entry is None or entry["lesson"] is not lesson:
+        # Запись сброшена параллельно - считаем по полученному документу
+        return build_lesson_structure(lesson)
+    return entry["structure"]
+
+
+def build_lesson_progress_pipeline(
+    structure: dict,
+    now: datetime,
+    exercises_delta: int = 0,
+    set_fields: Optional[dict] = None,
+    touch: bool = True,
+    for_upsert: bool = True
+) -> list:
+    """
+    Конвейер обновления lesson_progress: применяет изменения и пересчитывает
+    процент завершения на стороне MongoDB по сохраненным счетчикам и флагам.
+    """
+    apply_stage = {
+        "theory_completed": True,  # Теория считается пройденной по умолчанию
+        "exercises_completed": {"$add": [{"$ifNull": ["$exercises_completed", 0]}, exercises_delta]},
+        "challenge_completed": {"$ifNull": ["$challenge_completed", False]},
+        "quiz_completed": {"$ifNull": ["$quiz_completed", False]},
+        "quiz_passed": {"$ifNull": ["$quiz_passed", False]},
+        # Версия документа растет при каждом изменении и служит ETag для чтения
+        "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+    }
+    if for_upsert:
+        apply_stage["id"] = {"$ifNull": ["$id", str(uuid.uuid4())]}
+        apply_stage["started_at"] = {"$ifNull": ["$started_at", now]}
+        apply_stage["time_spent_minutes"] = {"$ifNull": ["$time_spent_minutes", 0]}
+    if touch:
+        apply_stage["last_activity_at"] = now
+    for field, value in (set_fields or {}).items():
+        apply_stage[field] = {"$literal": value}
+
+    # Разделы урока: количество известно заранее, выполненные считаются по документу
+    total_sections = 0
+    completed_terms = []
+    if structure["has_theory"]:
+        total_sections += 1
+        completed_terms.append({"$cond": ["$theory_completed", 1, 0]})
+    if structure["total_exercises"] > 0:
+        total_sections += 1
+        completed_terms.append({"$cond": [{"$gte": ["$exercises_completed", structure["total_exercises"]]}, 1, 0]})
+    if structure["has_challenge"]:
+        total_sections += 1
+        completed_terms.append({"$cond": ["$challenge_completed", 1, 0]})
+    if structure["has_quiz"]:
+        total_sections += 1
+        completed_terms.append({"$cond": ["$quiz_completed", 1, 0]})
+
+    if total_sections > 0:
+        completion_expr = {"$round": [
+            {"$multiply": [{"$divide": [{"$add": completed_terms}, total_sections]}, 100]}, 2
+        ]}
+    else:
+        completion_expr = 0
+
+    return [
+        {"$set": apply_stage},
+        {"$set": {"completion_percentage": completion_expr}},
+        {"$set": {
+            # completed_at фиксируется в момент перехода урока в состояние "завершен"
+            "completed_at": {"$cond": [
+                {"$and": [
+                    {"$gte": ["$completion_percentage", 100]},
+                    {"$ne": [{"$ifNull": ["$is_completed", False]}, True]}
+                ]},
+                now,
+                {"$ifNull": ["$completed_at", None]}
+            ]},
+            "is_completed": {"$gte": ["$completion_percentage", 100]}
+        }}
+    ]
+
+
+# Снимки прогресса для чтения: {(user_id, lesson_id): {"version", "etag", "payload", "expires_at"}}
+# Пути записи обновляют снимок сразу; TTL ограничивает устаревание при нескольких воркерах
+PROGRESS_SNAPSHOT_TTL_SECONDS = int(os.getenv("PROGRESS_SNAPSHOT_TTL_SECONDS", "30"))
+PROGRESS_SNAPSHOT_MAX_ENTRIES = int(os.getenv("PROGRESS_SNAPSHOT_MAX_ENTRIES", "50000"))
+lesson_progress_snapshots = OrderedDict()
+
+
+def format_lesson_progress(progress: Optional[dict]) -> dict:
+    """Ответ API по документу lesson_progress"""
+    if not progress:
+        return {
+            "exercises_completed": 0,
+            "completion_percentage": 0,
+            "is_completed": False
+        }
+
+    return {
+        "exercises_completed": progress.get("exercises_completed", 0),
+        "theory_completed": progress.get("theory_completed", False),
+        "challenge_completed": progress.get("challenge_completed", False),
+        "quiz_completed": progress.get("quiz_completed", False),
+        "completion_percentage": progress.get("completion_percentage", 0),
+        "is_completed": progress.get("is_completed", False),
+        "last_activity_at": progress.get("last_activity_at").isoformat() if progress.get("last_activity_at") else None
+    }
+
+
+def store_lesson_progress_snapshot(user_id: str, lesson_id: str, progress: Optional[dict]) -> dict:
+    """Сохранить снимок прогресса, построенный по документу из БД"""
+    version = progress.get("version", 0) if progress else 0
+    # id документа входит в ETag: после сброса прогресса документ создается заново
+    document_id = (progress.get("id") if progress else None) or "none"
+    snapshot = {
+        "version": version,
+        "etag": f'"{document_id}-{version}"',
+        "payload": format_lesson_progress(progress),
+        "expires_at": time.monotonic() + PROGRESS_SNAPSHOT_TTL_SECONDS
+    }
+
+    key = (user_id, lesson_id)
+    lesson_progress_snapshots[key] = snapshot
+    lesson_progress_snapshots.move_to_end(key)
+    while len(lesson_progress_snapshots) > PROGRESS_SNAPSHOT_MAX_ENTRIES:
+        lesson_progress_snapshots.popitem(last=False)
+    return snapshot
+
+
+def get_lesson_progress_snapshot(user_id: str, lesson_id: str) -> Optional[dict]:
+    """Получить актуальный снимок прогресса или None"""
+    snapshot = lesson_progress_snapshots.get((user_id, lesson_id))
+    if snapshot is None:
+        return None
+    if snapshot["expires_at"] < time.monotonic():
+        lesson_progress_snapshots.pop((user_id, lesson_id), None)
+        return None
+    return snapshot
+
+
+def invalidate_lesson_progress_snapshots(lesson_id: str, user_id: Optional[str] = None):
+    """Сбросить снимки прогресса урока (всех студентов или одного)"""
+    if user_id is not None:
+        lesson_progress_snapshots.pop((user_id, lesson_id), None)
+        return
+    for key in [key for key in lesson_progress_snapshots if key[1] == lesson_id]:
+        lesson_progress_snapshots.pop(key, None)
+
+
+async def apply_lesson_progress_delta(
+    user_id: str,
+    lesson_id: str,
+    exercises_delta: int = 0,
+    set_fields: Optional[dict] = None,
+    analytics_increments: Optional[dict] = None,
+    analytics_daily: Optional[dict] = None
+) -> Optional[dict]:
+    """Атомарно применить изменение к прогрессу студента по уроку (одно обращение к БД)
+    и прибавить изменения к аналитике студента (вместе с началом/завершением урока)
+    и к дневным сводкам активности (analytics_daily: {"exercises"|"quizzes"|"challenges": n})"""
+    progress = None
+    now = datetime.utcnow()
     try:
-        # Получаем урок
-        lesson = await db.lessons_v2.find_one({"id": lesson_id})
-        if not lesson:
-            return
-        
-        # Подсчитываем количество выполненных упражнений
-        total_exercises = len(lesson.get("exercises", []))
-        completed_exercises = await db.exercise_responses.count_documents({
-            "user_id": user_id,
-            "lesson_id": lesson_id
-        })
-        
-        # Проверяем прогресс по другим разделам
-        # Теория считается пройденной, если есть хоть какая-то активность в уроке
-        theory_completed = True  # Теория считается пройденной по умолчанию
-        
-        # Проверяем челлендж - есть ли хотя бы одна завершенная попытка
-        challenge_completed = False
-        if lesson.get("challenge"):
-            challenge_count = await db.challenge_progress.count_documents({
+        structure = await get_lesson_structure(lesson_id)
+        if structure is not None:
+            progress = await db.lesson_progress.find_one_and_update(
+                {"user_id": user_id, "lesson_id": lesson_id},
+                build_lesson_progress_pipeline(structure, now, exercises_delta, set_fields),
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+
+            store_lesson_progress_snapshot(user_id, lesson_id, progress)
+
+            logger.info(f"Lesson progress updated: user={user_id}, lesson={lesson_id}, completion={progress.get('completion_percentage')}%, version={progress.get('version')}")
+
+    except Exception as e:
+        logger.error(f"Error updating lesson progress: {str(e)}")
+
+    increments = dict(analytics_increments or {})
+    for field, value in lesson_progress_analytics_increments(progress, now).items():
+        increments[field] = increments.get(field, 0) + value
+    increments = {field: value for field, value in increments.items() if value}
+    if increments:
+        await record_student_activity(user_id, increments)
+    await record_daily_activity(user_id, lesson_id, analytics_daily, now)
+    return progress
+
+
+async def recompute_lesson_progress(user_id: str, lesson_id: str) -> Optional[dict]:
+    """Полный пересчет прогресса студента по уроку из исходных коллекций"""
+    try:
+        structure = await get_lesson_structure(lesson_id)
+        if structure is None:
+            return None
+
+        completed_exercises, challenge_count, quiz_attempt = await asyncio.gather(
+            db.exercise_responses.count_documents({
                 "user_id": user_id,
-                "lesson_id": lesson_id,
-                "is_completed": True
-            })
-            challenge_completed = challenge_count > 0
-        
-        # Проверяем тест - есть ли хотя бы одна пройденная попытка
-        quiz_completed = False
-        quiz_passed = False
-        if lesson.get("quiz"):
-            quiz_attempt = await db.quiz_attempts.find_one({
+                "lesson_id": lesson_id
+            }),
+            db.challenge_progress.count_documents({
                 "user_id": user_id,
                 "lesson_id": lesson_id,
-                "passed": True
-            })
-            if quiz_attempt:
-                quiz_completed = True
-                quiz_passed = True
-        
-        # Вычисляем процент завершения
-        total_sections = 0
-        completed_sections = 0
-        
-        if lesson.get("theory"):
-            total_sections += 1
-            if theory_completed:
-                completed_sections += 1
-        
-        if lesson.get("exercises") and total_exercises > 0:
-            total_sections += 1
-            if completed_exercises >= total_exercises:
-                completed_sections += 1
-        
-        if lesson.get("challenge"):
-            total_sections += 1
-            if challenge_completed:
-                completed_sections += 1
-        
-        if lesson.get("quiz"):
-            total_sections += 1
-            if quiz_completed:
-                completed_sections += 1
-        
-        completion_percentage = (completed_sections / total_sections * 100) if total_sections > 0 else 0
-        is_completed = completion_percentage >= 100
-        
-        # Обновляем или создаем запись прогресса
-        progress_data = {
-            "user_id": user_id,
-            "lesson_id": lesson_id,
+                "is_completed": True
+            }),
+            db.quiz_attempts.find_one(
+                {"user_id": user_id, "lesson_id": lesson_id, "passed": True},
+                {"_id": 1}
+            )
+        )
+
+        quiz_passed = structure["has_quiz"] and quiz_attempt is not None
+        set_fields = {
             "exercises_completed": completed_exercises,
-            "theory_completed": theory_completed,
-            "challenge_completed": challenge_completed,
-            "quiz_completed": quiz_completed,
-            "quiz_passed": quiz_passed,
-            "completion_percentage": round(completion_percentage, 2),
-            "is_completed": is_completed,
-            "last_activity_at": datetime.utcnow()
+            "challenge_completed": structure["has_challenge"] and challenge_count > 0,
+            "quiz_completed": quiz_passed,
+            "quiz_passed": quiz_passed
         }
-        
-        existing_progress = await db.lesson_progress.find_one({
-            "user_id": user_id,
-            "lesson_id": lesson_id
-        })
-        
-        if existing_progress:
-            # Если урок только что завершён, устанавливаем completed_at
-            if is_completed and not existing_progress.get("is_completed", False):
-                progress_data["completed_at"] = datetime.utcnow()
-            
-            await db.lesson_progress.update_one(
-                {"_id": existing_progress["_id"]},
-                {"$set": progress_data}
-            )
-        else:
-            progress_data["id"] = str(uuid.uuid4())
-            progress_data["started_at"] = datetime.utcnow()
-            progress_data["completed_at"] = datetime.utcnow() if is_completed else None
-            progress_data["time_spent_minutes"] = 0
-            await db.lesson_progress.insert_one(progress_data)
-        
-        logger.info(f"Lesson progress updated: user={user_id}, lesson={lesson_id}, completion={completion_percentage}%, sections: {completed_sections}/{total_sections}")
-        
+
+        progress = await db.lesson_progress.find_one_and_update(
+            {"user_id": user_id, "lesson_id": lesson_id},
+            build_lesson_progress_pipeline(structure, datetime.utcnow(), set_fields=set_fields),
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        store_lesson_progress_snapshot(user_id, lesson_id, progress)
+        return progress
+
     except Exception as e:
-        logger.error(f"Error updating lesson progress: {str(e)}")
+        logger.error(f"Error recomputing lesson progress: {str(e)}")
+        return None
+
+
+async def recompute_lesson_progress_for_lesson(lesson_id: str, structure: dict):
+    """Пересчитать процент завершения у всех студентов урока после изменения его структуры"""
+    invalidate_lesson_progress_snapshots(lesson_id)
+    try:
+        result = await db.lesson_progress.update_many(
+            {"lesson_id": lesson_id},
+            build_lesson_progress_pipeline(structure, datetime.utcnow(), touch=False, for_upsert=False)
+        )
+        logger.info(f"Lesson progress recomputed for lesson {lesson_id}: {result.modified_count} records")
+        # Завершенность уроков могла измениться - счетчики уроков в аналитике перестроятся
+        await invalidate_student_analytics(
+            await db.lesson_progress.distinct("user_id", {"lesson_id": lesson_id})
+        )
+    except Exception as e:
+        logger.error(f"Error recomputing lesson progress for lesson {lesson_id}: {str(e)}")
 
 
 @app_v2.get("/api/student/lesson-progress/{lesson_id}")
 async def get_lesson_progress(
     lesson_id: str,
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
-    """Получить прогресс студента по уроку"""
+    """
+    Получить прогресс студента по уроку
+
+    Чистое чтение: отдается снимок из памяти или сохраненный документ lesson_progress.
+    Версия документа передается в ETag, при совпадении If-None-Match возвращается 304.
+    """
     try:
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
         
-        # Пересчитываем прогресс перед возвратом
-        await update_lesson_progress(user_id, lesson_id)
+        snapshot = get_lesson_progress_snapshot(user_id, lesson_id)
+        if snapshot is None:
+            progress = await db.lesson_progress.find_one(
+                {"user_id": user_id, "lesson_id": lesson_id},
+                {"_id": 0, "user_id": 0, "lesson_id": 0}
+            )
+            snapshot = store_lesson_progress_snapshot(user_id, lesson_id, progress)
         
-        progress = await db.lesson_progress.find_one({
-            "user_id": user_id,
-            "lesson_id": lesson_id
-        })
+        headers = {"ETag": snapshot["etag"], "Cache-Control": "private, no-cache"}
         
-        if not progress:
-            return {
-                "exercises_completed": 0,
-                "completion_percentage": 0,
-                "is_completed": False
-            }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            client_etags = [tag.strip() for tag in if_none_match.split(",")]
+            if snapshot["etag"] in client_etags or f"W/{snapshot['etag']}" in client_etags or "*" in client_etags:
+                return Response(status_code=304, headers=headers)
         
-        return {
-            "exercises_completed": progress.get("exercises_completed", 0),
-            "theory_completed": progress.get("theory_completed", False),
-            "challenge_completed": progress.get("challenge_completed", False),
-            "quiz_completed": progress.get("quiz_completed", False),
-            "completion_percentage": progress.get("completion_percentage", 0),
-            "is_completed": progress.get("is_completed", False),
-            "last_activity_at": progress.get("last_activity_at").isoformat() if progress.get("last_activity_at") else None
-        }
+        return JSONResponse(content=snapshot["payload"], headers=headers)
 
     except Exception as e:
         logger.error(f"Error getting lesson progress: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при получении прогресса: {str(e)}")
 
 
+# ===== АТОМАРНЫЕ СЧЕТЧИКИ АКТИВНОСТИ =====
+# Минуты и баллы накапливаются через $inc с upsert: параллельные heartbeat-запросы
+# (несколько вкладок) не теряют друг друга и укладываются в один запрос к БД.
+
+ACTIVITY_BATCH_MAX = 100  # максимум heartbeat-записей в одном запросе
+
+
+async def increment_activity_counter(collection, key: dict, increments: dict, set_fields: dict, insert_fields: dict):
+    """Атомарно прибавить счетчики (создав запись при первом обращении).
+    Возвращает (документ до изменения или None, если запись создана)"""
+    update = {"$inc": increments, "$set": set_fields, "$setOnInsert": insert_fields}
+    try:
+        return await collection.find_one_and_update(
+            key, update, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Параллельный upsert уже создал запись - повторяем как обычное обновление
+        return await collection.find_one_and_update(
+            key, update, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+
+
+async def bulk_increment_activity_counters(collection, operations: List[UpdateOne]):
+    """Выполнить пачку upsert-инкрементов; операции, проигравшие гонку upsert, повторяются"""
+    try:
+        await collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        retry = [
+            operations[error["index"]]
+            for error in e.details.get("writeErrors", [])
+            if error.get("code") == 11000
+        ]
+        if len(retry) != len(e.details.get("writeErrors", [])):
+            raise
+        await collection.bulk_write(retry, ordered=False)
+
+
 @app_v2.post("/api/student/time-activity")
 async def track_time_activity(
-    request: TimeActivityRequest,
+    request: Union[TimeActivityRequest, List[TimeActivityRequest]],
     current_user: dict = Depends(get_current_user)
 ):
-    """Отслеживание времени активности студента и начисление баллов (1 балл за минуту)"""
+    """Отслеживание времени активности студента и начисление баллов (1 балл за минуту).
+    Принимает одну запись или массив записей (по нескольким урокам)"""
     try:
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
-        lesson_id = request.lesson_id
-        minutes_spent = request.minutes_spent
-        
-        # Начисляем баллы: 1 балл за минуту
-        points_earned = minutes_spent
-        
-        # Проверяем, есть ли уже запись для этого урока
-        existing_activity = await db.time_activity.find_one({
-            "user_id": user_id,
-            "lesson_id": lesson_id
-        })
+        now = datetime.utcnow()
         
-        if existing_activity:
-            # Обновляем существующую запись
-            new_total_minutes = existing_activity.get("total_minutes", 0) + minutes_spent
-            new_total_points = existing_activity.get("total_points", 0) + points_earned
+        if not isinstance(request, list):
+            lesson_id = request.lesson_id
+            minutes_spent = request.minutes_spent
             
-            await db.time_activity.update_one(
-                {
-                    "user_id": user_id,
-                    "lesson_id": lesson_id
-                },
-                {
-                    "$set": {
-                        "total_minutes": new_total_minutes,
-                        "total_points": new_total_points,
-                        "last_activity_at": datetime.utcnow()
-                    }
-                }
+            # Начисляем баллы: 1 балл за минуту
+            points_earned = minutes_spent
+            
+            previous = await increment_activity_counter(
+                db.time_activity,
+                {"user_id": user_id, "lesson_id": lesson_id},
+                {"total_minutes": minutes_spent, "total_points": points_earned, "ledger_points": points_earned},
+                {"last_activity_at": now},
+                {"id": str(uuid.uuid4()), "started_at": now}
+            )
+            
+            new_total_minutes = (previous or {}).get("total_minutes", 0) + minutes_spent
+            new_total_points = (previous or {}).get("total_points", 0) + points_earned
+            await asyncio.gather(
+                record_student_activity(user_id, {"total_time_spent_minutes": minutes_spent}),
+                award_points(user_id, lesson_id, "time", points_earned, lesson_id)
             )
             
-            logger.info(f"Time activity updated: user={user_id}, lesson={lesson_id}, minutes={new_total_minutes}, points={new_total_points}")
+            logger.info(f"Time activity tracked: user={user_id}, lesson={lesson_id}, minutes={new_total_minutes}, points={new_total_points}")
             
             return {
-                "message": "Время активности обновлено",
+                "message": "Время активности обновлено" if previous else "Время активности сохранено",
                 "total_minutes": new_total_minutes,
                 "total_points": new_total_points,
                 "points_earned": points_earned
             }
-        else:
-            # Создаем новую запись
-            activity_data = {
-                "id": str(uuid.uuid4()),
-                "user_id": user_id,
-                "lesson_id": lesson_id,
-                "total_minutes": minutes_spent,
-                "total_points": points_earned,
-                "started_at": datetime.utcnow(),
-                "last_activity_at": datetime.utcnow()
-            }
-            
-            await db.time_activity.insert_one(activity_data)
-            
-            logger.info(f"Time activity created: user={user_id}, lesson={lesson_id}, minutes={minutes_spent}, points={points_earned}")
-            
-            return {
-                "message": "Время активности сохранено",
-                "total_minutes": minutes_spent,
-                "total_points": points_earned,
-                "points_earned": points_earned
-            }
         
+        if len(request) > ACTIVITY_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"Не больше {ACTIVITY_BATCH_MAX} записей за запрос")
+        
+        # Складываем минуты по урокам, чтобы на каждый урок был один инкремент
+        minutes_by_lesson = {}
+        for item in request:
+            minutes_by_lesson[item.lesson_id] = minutes_by_lesson.get(item.lesson_id, 0) + item.minutes_spent
+        
+        if minutes_by_lesson:
+            await bulk_increment_activity_counters(db.time_activity, [
+                UpdateOne(
+                    {"user_id": user_id, "lesson_id": lesson_id},
+                    {
+                        "$inc": {"total_minutes": minutes, "total_points": minutes, "ledger_points": minutes},
+                        "$set": {"last_activity_at": now},
+                        "$setOnInsert": {"id": str(uuid.uuid4()), "started_at": now}
+                    },
+                    upsert=True
+                )
+                for lesson_id, minutes in minutes_by_lesson.items()
+            ])
+        
+        await asyncio.gather(
+            record_student_activity(user_id, {"total_time_spent_minutes": sum(minutes_by_lesson.values())}),
+            award_points_many([
+                {"user_id": user_id, "lesson_id": lesson_id, "source": "time", "points": minutes, "ref_id": lesson_id}
+                for lesson_id, minutes in minutes_by_lesson.items()
+            ])
+        )
+        
+        totals = {}
+        async for activity in db.time_activity.find(
+            {"user_id": user_id, "lesson_id": {"$in": list(minutes_by_lesson.keys())}},
+            {"_id": 0, "lesson_id": 1, "total_minutes": 1, "total_points": 1}
+        ):
+            totals[activity["lesson_id"]] = activity
+        
+        logger.info(f"Time activity batch tracked: user={user_id}, lessons={len(minutes_by_lesson)}")
+        
+        return {
+            "message": "Время активности обновлено",
+            "points_earned": sum(minutes_by_lesson.values()),
+            "lessons": [
+                {
+                    "lesson_id": lesson_id,
+                    "total_minutes": totals.get(lesson_id, {}).get("total_minutes", 0),
+                    "total_points": totals.get(lesson_id, {}).get("total_points", 0),
+                    "points_earned": minutes
+                }
+                for lesson_id, minutes in minutes_by_lesson.items()
+            ]
+        }
+        
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error tracking time activity: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при отслеживании времени: {str(e)}")
@@ -1055,21 +1759,34 @@ async def reset_lesson_progress(
     try:
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
         
-        # Удаляем все ответы на упражнения
-        await db.exercise_responses.delete_many({
-            "user_id": user_id,
-            "lesson_id": lesson_id
-        })
+        # Удаляем все ответы на упражнения; их дни вычитаются из дневных сводок студента и урока
+        responses = await db.exercise_responses.find(
+            {"user_id": user_id, "lesson_id": lesson_id},
+            {"_id": 1, "submitted_at": 1}
+        ).to_list(length=None)
+        if responses:
+            await db.exercise_responses.delete_many({"_id": {"$in": [response["_id"] for response in responses]}})
+            removed_by_day = {}
+            for response in responses:
+                if isinstance(response.get("submitted_at"), datetime):
+                    day = get_day_start(response["submitted_at"])
+                    removed_by_day.setdefault(day, {"exercises": 0})["exercises"] += 1
+            await remove_daily_activity(user_id, lesson_id, removed_by_day)
         
         # Удаляем прогресс урока
         await db.lesson_progress.delete_many({
             "user_id": user_id,
             "lesson_id": lesson_id
         })
+        invalidate_lesson_progress_snapshots(lesson_id, user_id)
         
         # НЕ удаляем попытки тестов и челленджей - они остаются в истории
         # НЕ удаляем время активности - оно продолжает накапливаться
         
+        # Восстанавливаем прогресс по оставшимся данным (пройденный тест, завершенный челлендж)
+        await recompute_lesson_progress(user_id, lesson_id)
+        await invalidate_student_analytics([user_id])
+        
         logger.info(f"Lesson progress reset: user={user_id}, lesson={lesson_id}")
         
         return {
@@ -1082,6 +1799,130 @@ async def reset_lesson_progress(
         raise HTTPException(status_code=500, detail=f"Ошибка при сбросе прогресса: {str(e)}")
 
 
+# ===== КЛЮЧИ ОТВЕТОВ ТЕСТОВ =====
+# При сохранении урока тест компилируется в ключ ответов (quiz_answer_keys): нормализованные
+# правильные ответы и баллы вопросов, параметры начисления. Попытки оцениваются на сервере
+# по ключу из памяти за O(вопросов), без чтения документа урока. Ключи уроков, сохраненных
+# до появления коллекции, компилируются при первой попытке.
+
+QUIZ_FREE_TEXT_TYPES = ("text",)
+# Поля вопроса, которые студент не получает вместе с уроком
+QUIZ_ANSWER_FIELDS = ("correct_answer", "explanation")
+
+# {lesson_id: {"key": dict, "expires_at": float}}
+quiz_answer_key_cache = {}
+
+
+def normalize_quiz_answer(answer, question_type: str) -> Optional[str]:
+    """Нормализованный ответ: выбор варианта сравнивается точно, текст - без регистра и лишних пробелов"""
+    if answer is None:
+        return None
+    if isinstance(answer, bool):
+        answer = "true" if answer else "false"
+    answer = str(answer).strip()
+    if question_type in QUIZ_FREE_TEXT_TYPES:
+        return " ".join(answer.split()).casefold()
+    if question_type == "true_false":
+        return answer.casefold()
+    return answer
+
+
+def compile_quiz_answer_key(lesson_id: str, quiz: Optional[dict]) -> Optional[dict]:
+    """Скомпилировать тест урока в ключ ответов (None, если теста нет)"""
+    if not quiz:
+        return None
+    questions = [
+        {
+            "id": question.get("id"),
+            "type": question.get("type", "multiple_choice"),
+            "answer": normalize_quiz_answer(question.get("correct_answer"), question.get("type", "multiple_choice")),
+            "points": question.get("points", 1)
+        }
+        for question in quiz.get("questions") or []
+    ]
+    key = {
+        "lesson_id": lesson_id,
+        "quiz_id": quiz.get("id"),
+        "questions": questions,
+        "total_points": sum(question["points"] for question in questions),
+        "passing_score": quiz.get("passing_score", 70),
+        "points_per_percent": quiz.get("points_per_percent", 1),  # 1 балл за каждый процент
+        "bonus_points": quiz.get("bonus_points", 20)  # Бонус за прохождение теста
+    }
+    # Версия ключа - хэш содержимого: попытки хранят версию, по которой оценены
+    key["version"] = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+    return key
+
+
+def cache_quiz_answer_key(lesson_id: str, key: Optional[dict]):
+    """Поместить ключ ответов в кэш (None - у урока нет теста)"""
+    quiz_answer_key_cache[lesson_id] = {
+        "key": key,
+        "expires_at": time.monotonic() + LESSON_CACHE_TTL_SECONDS
+    }
+
+
+async def save_quiz_answer_key(lesson_id: str, quiz: Optional[dict]) -> Optional[dict]:
+    """Скомпилировать и сохранить ключ ответов при сохранении урока"""
+    key = compile_quiz_answer_key(lesson_id, quiz)
+    if key is None:
+        await db.quiz_answer_keys.delete_one({"lesson_id": lesson_id})
+    else:
+        await db.quiz_answer_keys.replace_one(
+            {"lesson_id": lesson_id},
+            dict(key, updated_at=datetime.utcnow()),
+            upsert=True
+        )
+    cache_quiz_answer_key(lesson_id, key)
+    return key
+
+
+async def get_quiz_answer_key(lesson_id: str) -> Optional[dict]:
+    """Ключ ответов теста урока (из памяти; после TTL перечитывается из quiz_answer_keys)"""
+    entry = quiz_answer_key_cache.get(lesson_id)
+    if entry is not None and entry["expires_at"] >= time.monotonic():
+        return entry["key"]
+    
+    key = await db.quiz_answer_keys.find_one({"lesson_id": lesson_id}, {"_id": 0, "updated_at": 0})
+    if key is None:
+        # Урок сохранен до появления ключей - компилируем из документа урока
+        lesson = await get_cached_lesson(lesson_id)
+        if not lesson:
+            return None
+        return await save_quiz_answer_key(lesson_id, lesson.get("quiz"))
+    cache_quiz_answer_key(lesson_id, key)
+    return key
+
+
+def grade_quiz_answers(key: dict, answers: dict) -> dict:
+    """Оценить ответы по ключу: процент (по баллам вопросов), результат, баллы и правильность по вопросам"""
+    results = []
+    earned = 0
+    for question in key["questions"]:
+        is_correct = (
+            question["answer"] is not None
+            and normalize_quiz_answer(answers.get(question["id"]), question["type"]) == question["answer"]
+        )
+        if is_correct:
+            earned += question["points"]
+        results.append({"question_id": question["id"], "is_correct": is_correct})
+    
+    total_points = key["total_points"]
+    # Округление как в клиенте (Math.round)
+    score = int(earned * 100 / total_points + 0.5) if total_points > 0 else 0
+    passed = score >= key["passing_score"]
+    
+    # Баллы = процент × множитель (+ бонус за прохождение)
+    points_earned = score * key["points_per_percent"] + (key["bonus_points"] if passed else 0)
+    return {
+        "score": score,
+        "passed": passed,
+        "points_earned": points_earned,
+        "correct_count": sum(1 for result in results if result["is_correct"]),
+        "results": results
+    }
+
+
 # ===== ENDPOINTS ДЛЯ ТЕСТОВ (СТУДЕНТЫ) =====
 
 @app_v2.post("/api/student/quiz-attempt")
@@ -1093,27 +1934,21 @@ async def submit_quiz_attempt(
     try:
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
         lesson_id = request.lesson_id
-        quiz_id = request.quiz_id
-        score = request.score
-        passed = request.passed
         answers = request.answers
         
-        # Получаем урок для определения параметров начисления баллов
-        lesson = await db.lessons_v2.find_one({"id": lesson_id})
-        quiz = lesson.get("quiz", {}) if lesson else {}
-        
-        # Параметры начисления баллов за тест
-        points_per_percent = quiz.get("points_per_percent", 1)  # 1 балл за каждый процент
-        bonus_points = quiz.get("bonus_points", 20)  # Бонус за прохождение теста
+        # Оцениваем ответы по скомпилированному ключу (балл клиента не используется)
+        answer_key = await get_quiz_answer_key(lesson_id)
+        if answer_key is None:
+            raise HTTPException(status_code=404, detail="Тест не найден")
+        # Тест без id клиент отправляет с id урока; попытка хранит id теста из ключа
+        quiz_id = answer_key.get("quiz_id") or lesson_id
+        if request.quiz_id != quiz_id:
+            raise HTTPException(status_code=409, detail="Тест урока изменился, обновите страницу")
         
-        # Подсчет баллов
-        points_earned = 0
-        if passed:
-            # Баллы = процент × множитель + бонус за прохождение
-            points_earned = (score * points_per_percent) + bonus_points
-        else:
-            # Даже за непройденный тест начисляем баллы пропорционально проценту
-            points_earned = score * points_per_percent
+        grade = grade_quiz_answers(answer_key, answers)
+        score = grade["score"]
+        passed = grade["passed"]
+        points_earned = grade["points_earned"]
         
         # Создаем запись о попытке с баллами
         attempt_data = {
@@ -1124,30 +1959,43 @@ async def submit_quiz_attempt(
             "score": score,
             "passed": passed,
             "answers": answers,
+            "correct_count": grade["correct_count"],
             "points_earned": points_earned,
+            "ledger_points": points_earned,
+            "key_version": answer_key["version"],
             "attempted_at": datetime.utcnow()
         }
         
         # Сохраняем попытку
         await db.quiz_attempts.insert_one(attempt_data)
         
-        # Обновляем прогресс урока
-        await db.lesson_progress.update_one(
-            {
-                "user_id": user_id,
-                "lesson_id": lesson_id
+        # Обновляем прогресс урока (пройденный тест остается пройденным)
+        await apply_lesson_progress_delta(
+            user_id,
+            lesson_id,
+            set_fields={"quiz_completed": True, "quiz_passed": True} if passed else None,
+            analytics_increments={
+                "total_quiz_attempts": 1,
+                "total_quizzes_passed": 1 if passed else 0,
+                "quiz_score_sum": score
             },
-            {
-                "$set": {
-                    "quiz_completed": passed,
-                    "last_activity_at": datetime.utcnow()
-                }
-            },
-            upsert=True
+            analytics_daily={"quizzes": 1}
         )
+        await award_points(user_id, lesson_id, "quizzes", points_earned, attempt_data["id"])
         
-        # Пересчитываем общий прогресс
-        await update_lesson_progress(user_id, lesson_id)
+        # Правильные ответы и пояснения показываются только после отправки попытки
+        lesson = await get_cached_lesson(lesson_id)
+        answers_by_question = {
+            question.get("id"): question
+            for question in ((lesson or {}).get("quiz") or {}).get("questions") or []
+        }
+        results = [
+            dict(result, **{
+                field: answers_by_question.get(result["question_id"], {}).get(field)
+                for field in QUIZ_ANSWER_FIELDS
+            })
+            for result in grade["results"]
+        ]
         
         logger.info(f"Quiz attempt saved: user={user_id}, lesson={lesson_id}, score={score}%, points={points_earned}")
         
@@ -1156,9 +2004,14 @@ async def submit_quiz_attempt(
             "attempt_id": attempt_data["id"],
             "score": score,
             "passed": passed,
-            "points_earned": points_earned
+            "points_earned": points_earned,
+            "correct_count": grade["correct_count"],
+            "total_questions": len(results),
+            "results": results
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error saving quiz attempt: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении результата теста: {str(e)}")
@@ -1204,8 +2057,531 @@ async def get_quiz_attempts(
         raise HTTPException(status_code=500, detail=f"Ошибка при получении попыток теста: {str(e)}")
 
 
+# ===== ПЕРЕОЦЕНКА ПОПЫТОК ТЕСТОВ =====
+# После изменения теста урока попытки, оцененные по другой версии ключа, переоцениваются
+# фоновой задачей: попытки читаются пачками, ответы сравниваются с ключом матрично (NumPy),
+# результаты записываются неупорядоченным bulk_write. Разница баллов проводится через журнал
+# начислений. Ход задачи хранится в quiz_regrade_jobs и доступен администратору.
+
+QUIZ_REGRADE_BATCH_SIZE = int(os.getenv("QUIZ_REGRADE_BATCH_SIZE", "1000"))
+
+# Задачи одного урока выполняются по очереди: в процессе - под блокировкой урока, между
+# воркерами - по отметке status "running" (уникальный частичный индекс по lesson_id).
+# Задача, которая не может занять отметку, ждет; отметка задачи упавшего воркера
+# освобождается после QUIZ_REGRADE_STALE_SECONDS без обновлений
+QUIZ_REGRADE_CLAIM_RETRY_SECONDS = 5
+QUIZ_REGRADE_STALE_SECONDS = int(os.getenv("QUIZ_REGRADE_STALE_SECONDS", "3600"))
+
+# Запущенные задачи процесса: {job_id: task}. Ссылки не дают сборщику мусора собрать задачи
+quiz_regrade_tasks = {}
+# {lesson_id: asyncio.Lock}
+quiz_regrade_locks = {}
+
+
+def grade_quiz_answers_batch(key: dict, answers_list: List[dict]) -> dict:
+    """Оценить пачку попыток по ключу (как grade_quiz_answers, но матрично):
+    {"score", "passed", "points_earned", "correct_count"} - списки по попыткам"""
+    questions = key["questions"]
+    answer_matrix = np.array(
+        [
+            [normalize_quiz_answer((answers or {}).get(question["id"]), question["type"]) for question in questions]
+            for answers in answers_list
+        ],
+        dtype=object
+    ).reshape(len(answers_list), len(questions))
+    expected = np.array([question["answer"] for question in questions], dtype=object)
+    gradable = np.array([question["answer"] is not None for question in questions], dtype=bool)
+    weights = np.array([question["points"] for question in questions], dtype=float)
+    
+    correct = (answer_matrix == expected) & gradable
+    earned = correct.astype(float) @ weights
+    total_points = key["total_points"]
+    if total_points > 0:
+        # Округление как в клиенте (Math.round)
+        score = np.floor(earned * 100 / total_points + 0.5).astype(int)
+    else:
+        score = np.zeros(len(answers_list), dtype=int)
+    passed = score >= key["passing_score"]
+    points_earned = score * key["points_per_percent"] + np.where(passed, key["bonus_points"], 0)
+    return {
+        "score": score.tolist(),
+        "passed": passed.tolist(),
+        "points_earned": points_earned.tolist(),
+        "correct_count": correct.sum(axis=1).tolist()
+    }
+
+
+async def regrade_quiz_attempts_batch(lesson_id: str, key: dict, attempts: List[dict]) -> dict:
+    """Переоценить пачку попыток и записать результаты; возвращает изменения по студентам.
+    Запись выполняется, только если попытку не успели изменить после чтения (key_version и
+    points_earned совпадают с прочитанными), и баллы проводятся только по примененным записям"""
+    grades = grade_quiz_answers_batch(key, [attempt.get("answers") for attempt in attempts])
+    now = datetime.utcnow()
+    # Метка записей этой пачки - по ней определяются примененные изменения при конфликте
+    batch_token = str(uuid.uuid4())
+    operations = []
+    changes = {}
+    for index, attempt in enumerate(attempts):
+        grade = {field: values[index] for field, values in grades.items()}
+        update = dict(grade, key_version=key["version"])
+        if (grade["score"], grade["passed"], grade["points_earned"]) != (
+            attempt.get("score"), attempt.get("passed"), attempt.get("points_earned", 0)
+        ):
+            update["regraded_at"] = now
+            update["regrade_token"] = batch_token
+            changes[attempt["_id"]] = {
+                "user_id": attempt.get("user_id"),
+                "passed_changed": grade["passed"] != attempt.get("passed"),
+                "award": {
+                    "user_id": attempt.get("user_id"),
+                    "lesson_id": lesson_id,
+                    "source": "quizzes",
+                    "points": grade["points_earned"] - attempt.get("points_earned", 0),
+                    "ref_id": attempt.get("id")
+                }
+            }
+        write = {"$set": update}
+        if attempt["_id"] in changes:
+            # Корректировка проводится через журнал - вместе с баллами растет ledger_points
+            write["$inc"] = {"ledger_points": changes[attempt["_id"]]["award"]["points"]}
+        operations.append(UpdateOne(
+            {
+                "_id": attempt["_id"],
+                "key_version": attempt.get("key_version"),
+                "points_earned": attempt.get("points_earned")
+            },
+            write
+        ))
+    
+    if operations:
+        result = await db.quiz_attempts.bulk_write(operations, ordered=False)
+        if result.matched_count < len(operations) and changes:
+            # Часть попыток изменена параллельно - учитываем только записанные этой пачкой
+            applied = await db.quiz_attempts.find(
+                {"_id": {"$in": list(changes)}, "regrade_token": batch_token},
+                {"_id": 1}
+            ).to_list(length=None)
+            applied_ids = {attempt["_id"] for attempt in applied}
+            changes = {attempt_id: change for attempt_id, change in changes.items() if attempt_id in applied_ids}
+    
+    await award_points_many([change["award"] for change in changes.values()])
+    return {
+        "changed_users": {change["user_id"] for change in changes.values()},
+        "passed_changed_users": {change["user_id"] for change in changes.values() if change["passed_changed"]},
+        "changed": len(changes)
+    }
+
+
+async def run_quiz_regrade_job(job_id: str, lesson_id: str, key: dict):
+    """Фоновая переоценка попыток теста урока по ключу key (только попытки теста key["quiz_id"]).
+    Сначала дожидается очереди урока; если за это время ключ изменился - завершается как superseded"""
+    query = {
+        "lesson_id": lesson_id,
+        "quiz_id": key.get("quiz_id") or lesson_id,
+        "key_version": {"$ne": key["version"]}
+    }
+    changed_users = set()
+    passed_changed_users = set()
+    counts = {"processed": 0, "changed": 0}
+    status = "completed"
+    error = None
+    
+    async def regrade_batch(batch: List[dict]) -> bool:
+        """Переоценить пачку; False - тест успели изменить снова (продолжит задача новой версии)"""
+        current_key = await get_quiz_answer_key(lesson_id)
+        if current_key is None or current_key["version"] != key["version"]:
+            return False
+        result = await regrade_quiz_attempts_batch(lesson_id, key, batch)
+        counts["processed"] += len(batch)
+        counts["changed"] += result["changed"]
+        changed_users.update(result["changed_users"])
+        passed_changed_users.update(result["passed_changed_users"])
+        await db.quiz_regrade_jobs.update_one(
+            {"id": job_id},
+            {"$set": dict(counts, updated_at=datetime.utcnow())}
+        )
+        return True
+    
+    async def claim_job() -> bool:
+        """Дождаться очереди урока и занять отметку running; False - ключ успели изменить"""
+        while True:
+            current_key = await get_quiz_answer_key(lesson_id)
+            if current_key is None or current_key["version"] != key["version"]:
+                return False
+            now = datetime.utcnow()
+            try:
+                await db.quiz_regrade_jobs.update_one(
+                    {"id": job_id, "status": "queued"},
+                    {"$set": {"status": "running", "updated_at": now}}
+                )
+                return True
+            except DuplicateKeyError:
+                # Урок переоценивает задача другого воркера; зависшую освобождаем
+                await db.quiz_regrade_jobs.update_one({"id": job_id}, {"$set": {"updated_at": now}})
+                await db.quiz_regrade_jobs.update_one(
+                    {
+                        "lesson_id": lesson_id,
+                        "status": "running",
+                        "updated_at": {"$lt": now - timedelta(seconds=QUIZ_REGRADE_STALE_SECONDS)}
+                    },
+                    {"$set": {"status": "failed", "error": "Задача не обновлялась", "finished_at": now}}
+                )
+            await asyncio.sleep(QUIZ_REGRADE_CLAIM_RETRY_SECONDS)
+    
+    lock = quiz_regrade_locks.setdefault(lesson_id, asyncio.Lock())
+    locked = False
+    try:
+        await lock.acquire()
+        locked = True
+        if not await claim_job():
+            status = "superseded"
+            return
+        
+        total = await db.quiz_attempts.count_documents(query)
+        await db.quiz_regrade_jobs.update_one({"id": job_id}, {"$set": {"total": total}})
+        
+        cursor = db.quiz_attempts.find(
+            query,
+            {
+                "_id": 1, "id": 1, "user_id": 1, "answers": 1, "score": 1,
+                "passed": 1, "points_earned": 1, "key_version": 1
+            }
+        ).batch_size(QUIZ_REGRADE_BATCH_SIZE)
+        batch = []
+        async for attempt in cursor:
+            batch.append(attempt)
+            if len(batch) >= QUIZ_REGRADE_BATCH_SIZE:
+                if not await regrade_batch(batch):
+                    status = "superseded"
+                    break
+                batch = []
+        else:
+            # Последняя неполная пачка проверяется так же, как полные
+            if batch and not await regrade_batch(batch):
+                status = "superseded"
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except Exception as e:
+        status = "failed"
+        error = str(e)
+        logger.error(f"Error regrading quiz attempts for lesson {lesson_id}: {str(e)}")
+    finally:
+        # Пройденность теста и итоги студентов пересчитываются по переоцененным попыткам
+        for user_id in passed_changed_users:
+            await recompute_lesson_progress(user_id, lesson_id)
+        await invalidate_student_analytics(list(changed_users))
+        
+        now = datetime.utcnow()
+        await db.quiz_regrade_jobs.update_one(
+            {"id": job_id},
+            {"$set": dict(counts, status=status, error=error, updated_at=now, finished_at=now)}
+        )
+        if locked:
+            lock.release()
+        logger.info(
+            f"Quiz regrade job {job_id} {status}: lesson={lesson_id}, "
+            f"processed={counts['processed']}, changed={counts['changed']}"
+        )
+
+
+async def start_quiz_regrade_job(lesson_id: str, key: dict, started_by: Optional[str] = None) -> str:
+    """Создать задачу переоценки попыток теста урока и запустить ее в фоне, не дожидаясь
+    предыдущих задач урока. Задача той же версии ключа в очереди или в работе уже выполняет
+    работу (возвращается ее id); задача прежней версии останавливается на проверке ключа перед
+    следующей пачкой, а новая задача ждет ее завершения в фоне"""
+    existing = await db.quiz_regrade_jobs.find_one(
+        {
+            "lesson_id": lesson_id,
+            "key_version": key["version"],
+            "status": {"$in": ["queued", "running"]},
+            "updated_at": {"$gte": datetime.utcnow() - timedelta(seconds=QUIZ_REGRADE_STALE_SECONDS)}
+        },
+        {"_id": 0, "id": 1}
+    )
+    if existing is not None:
+        return existing["id"]
+    
+    now = datetime.utcnow()
+    job = {
+        "id": str(uuid.uuid4()),
+        "lesson_id": lesson_id,
+        "quiz_id": key.get("quiz_id"),
+        "key_version": key["version"],
+        "status": "queued",
+        "total": None,
+        "processed": 0,
+        "changed": 0,
+        "error": None,
+        "started_by": started_by,
+        "started_at": now,
+        "updated_at": now,
+        "finished_at": None
+    }
+    await db.quiz_regrade_jobs.insert_one(job)
+    task = asyncio.create_task(run_quiz_regrade_job(job["id"], lesson_id, key))
+    quiz_regrade_tasks[job["id"]] = task
+    task.add_done_callback(lambda done_task: quiz_regrade_tasks.pop(job["id"], None))
+    return job["id"]
+
+
+def format_quiz_regrade_job(job: dict) -> dict:
+    """Задача переоценки для ответа API"""
+    result = {field: value for field, value in job.items() if field != "_id"}
+    for field in ("started_at", "updated_at", "finished_at"):
+        result[field] = job.get(field).isoformat() if job.get(field) else None
+    total = job.get("total")
+    result["progress_percentage"] = round(job.get("processed", 0) / total * 100, 2) if total else (100.0 if total == 0 else 0.0)
+    return result
+
+
+@app_v2.post("/api/admin/quiz-regrade/{lesson_id}")
+async def start_quiz_regrade(
+    lesson_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Запустить переоценку попыток теста урока по текущему ключу ответов"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        key = await get_quiz_answer_key(lesson_id)
+        if key is None:
+            raise HTTPException(status_code=404, detail="Тест не найден")
+        
+        job_id = await start_quiz_regrade_job(lesson_id, key, current_user.get('user_id', current_user.get('id', 'admin')))
+        return {"message": "Переоценка попыток запущена", "job_id": job_id}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error starting quiz regrade: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при запуске переоценки: {str(e)}")
+
+
+@app_v2.get("/api/admin/quiz-regrade/jobs/{job_id}")
+async def get_quiz_regrade_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Ход задачи переоценки попыток теста"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        job = await db.quiz_regrade_jobs.find_one({"id": job_id}, {"_id": 0})
+        if not job:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        return format_quiz_regrade_job(job)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting quiz regrade job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении задачи переоценки: {str(e)}")
+
+
+@app_v2.get("/api/admin/quiz-regrade/lesson/{lesson_id}")
+async def get_quiz_regrade_jobs_for_lesson(
+    lesson_id: str,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    """Последние задачи переоценки попыток теста урока"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        limit = max(1, min(limit, 100))
+        jobs = await db.quiz_regrade_jobs.find({"lesson_id": lesson_id}, {"_id": 0}).sort(
+            "started_at", -1
+        ).limit(limit).to_list(length=limit)
+        return {"lesson_id": lesson_id, "jobs": [format_quiz_regrade_job(job) for job in jobs]}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting quiz regrade jobs: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении задач переоценки: {str(e)}")
+
+
 # ===== ENDPOINTS ДЛЯ ЧЕЛЛЕНДЖЕЙ (СТУДЕНТЫ) =====
 
+def build_challenge_day_pipeline(
+    day: int,
+    note: str,
+    completed: bool,
+    total_days: int,
+    points_per_day: int,
+    bonus_points: int,
+    now: datetime
+) -> list:
+    """Конвейер сохранения дня челленджа: заметка дня заменяется или добавляется,
+    день добавляется в completed_days, текущий день, завершение и баллы считаются на сервере.
+    last_points_delta - изменение баллов этим сохранением (для начисления)"""
+    day_note = {"day": day, "note": {"$literal": note}, "completed_at": now}
+    completed_days = {"$ifNull": ["$completed_days", []]}
+    daily_notes = {"$ifNull": ["$daily_notes", []]}
+    
+    apply_stage = {
+        "daily_notes": {"$cond": [
+            {"$in": [day, {"$map": {"input": daily_notes, "as": "item", "in": "$$item.day"}}]},
+            {"$map": {
+                "input": daily_notes,
+                "as": "item",
+                "in": {"$cond": [{"$eq": ["$$item.day", day]}, day_note, "$$item"]}
+            }},
+            {"$concatArrays": [daily_notes, [day_note]]}
+        ]}
+    }
+    if completed:
+        apply_stage["completed_days"] = {"$cond": [
+            {"$in": [day, completed_days]},
+            completed_days,
+            {"$concatArrays": [completed_days, [day]]}
+        ]}
+    
+    days_done = {"$size": {"$ifNull": ["$completed_days", []]}}
+    points_earned = {"$add": [
+        {"$multiply": [days_done, points_per_day]},
+        {"$cond": ["$is_completed", bonus_points, 0]}
+    ]}
+    return [
+        {"$set": apply_stage},
+        {"$set": {
+            "current_day": {"$cond": [
+                {"$gt": [days_done, 0]},
+                {"$add": [{"$max": "$completed_days"}, 1]},
+                1
+            ]},
+            "is_completed": {"$gte": [days_done, total_days]}
+        }},
+        {"$set": {
+            "completed_at": {"$cond": ["$is_completed", now, None]},
+            "points_earned": points_earned,
+            "last_points_delta": {"$subtract": [points_earned, {"$ifNull": ["$points_earned", 0]}]},
+            # Изменение проводится через журнал - перенос исторических баллов его не учитывает
+            "ledger_points": {"$add": [
+                {"$ifNull": ["$ledger_points", 0]},
+                {"$subtract": [points_earned, {"$ifNull": ["$points_earned", 0]}]}
+            ]}
+        }}
+    ]
+
+
+# Заметки челленджей для администратора: challenge_notes - по документу на (попытка, день),
+# дублируют непустые daily_notes попыток. Перестройка - POST /api/admin/challenge-notes/rebuild
+
+async def record_challenge_note(
+    progress_id: str,
+    user_id: str,
+    lesson_id: str,
+    challenge_id: str,
+    day: int,
+    note: str,
+    completed_at: datetime,
+    is_challenge_completed: bool
+):
+    """Записать заметку дня в challenge_notes (пустая заметка удаляется)"""
+    note_id = f"{progress_id}:{day}"
+    if note:
+        operations = [UpdateOne(
+            {"id": note_id},
+            {"$set": {
+                "note": note,
+                "completed_at": completed_at,
+                "is_challenge_completed": is_challenge_completed
+            },
+            "$setOnInsert": {
+                "progress_id": progress_id,
+                "user_id": user_id,
+                "lesson_id": lesson_id,
+                "challenge_id": challenge_id,
+                "day": day
+            }},
+            upsert=True
+        )]
+    else:
+        operations = [DeleteOne({"id": note_id})]
+    if is_challenge_completed:
+        operations.append(UpdateMany(
+            {"progress_id": progress_id, "is_challenge_completed": False},
+            {"$set": {"is_challenge_completed": True}}
+        ))
+    await db.challenge_notes.bulk_write(operations)
+
+
+async def rebuild_challenge_notes(lesson_ids: Optional[List[str]] = None) -> int:
+    """Перестроить challenge_notes из daily_notes попыток (всех или уроков lesson_ids).
+    Выполняется параллельно с сохранением дней: снимок записывается upsert-ами по id
+    "{progress_id}:{day}", заметка, сохраненная после снимка, не перезаписывается, а удаляются
+    только заметки, которых нет в снимке и которые не менялись после него"""
+    match = {"lesson_id": {"$in": lesson_ids}} if lesson_ids is not None else {}
+    started = datetime.utcnow()
+    rebuild_id = str(uuid.uuid4())
+    notes = await db.challenge_progress.aggregate([
+        {"$match": match},
+        {"$unwind": "$daily_notes"},
+        {"$match": {"daily_notes.note": {"$nin": [None, ""]}}},
+        {"$project": {
+            "_id": 0,
+            "id": {"$concat": ["$id", ":", {"$toString": "$daily_notes.day"}]},
+            "progress_id": "$id",
+            "user_id": 1,
+            "lesson_id": 1,
+            "challenge_id": 1,
+            "day": "$daily_notes.day",
+            "note": "$daily_notes.note",
+            "completed_at": "$daily_notes.completed_at",
+            "is_challenge_completed": {"$eq": ["$is_completed", True]}
+        }}
+    ]).to_list(length=None)
+    
+    operations = [
+        UpdateOne(
+            # Заметка, сохраненная после снимка, не совпадает с условием - upsert получает
+            # ошибку уникального id и заметка остается как есть
+            {"id": note["id"], "completed_at": {"$not": {"$gt": started}}},
+            {
+                "$set": {"note": note["note"], "completed_at": note["completed_at"], "rebuild_id": rebuild_id},
+                # Завершенная попытка не становится незавершенной
+                "$max": {"is_challenge_completed": note["is_challenge_completed"]},
+                "$setOnInsert": {
+                    field: note.get(field)
+                    for field in ("progress_id", "user_id", "lesson_id", "challenge_id", "day")
+                }
+            },
+            upsert=True
+        )
+        for note in notes
+    ]
+    for start in range(0, len(operations), 1000):
+        try:
+            await db.challenge_notes.bulk_write(operations[start:start + 1000], ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    
+    # Заметки, которых нет в снимке, и заметки, очищенные после снимка
+    await db.challenge_notes.delete_many(dict(
+        match,
+        rebuild_id={"$ne": rebuild_id},
+        completed_at={"$not": {"$gt": started}}
+    ))
+    cleared = await db.challenge_progress.aggregate([
+        {"$match": match},
+        {"$unwind": "$daily_notes"},
+        {"$match": {"daily_notes.note": {"$in": [None, ""]}, "daily_notes.completed_at": {"$gt": started}}},
+        {"$project": {"_id": 0, "id": {"$concat": ["$id", ":", {"$toString": "$daily_notes.day"}]}}}
+    ]).to_list(length=None)
+    if cleared:
+        await db.challenge_notes.delete_many({"id": {"$in": [note["id"] for note in cleared]}})
+    return len(notes)
+
+
 @app_v2.post("/api/student/challenge-progress")
 async def save_challenge_progress(
     request: ChallengeProgressRequest,
@@ -1221,85 +2597,50 @@ async def save_challenge_progress(
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
         
         # Получаем урок для определения длительности челленджа и баллов
-        lesson = await db.lessons_v2.find_one({"id": lesson_id})
+        lesson = await get_cached_lesson(lesson_id)
         challenge = lesson.get("challenge", {}) if lesson else {}
         total_days = challenge.get("duration_days", 7)
         points_per_day = challenge.get("points_per_day", 10)  # Баллы за день
         bonus_points = challenge.get("bonus_points", 50)  # Бонус за завершение
         
-        # Проверяем существующий АКТИВНЫЙ прогресс (незавершенный)
-        existing_progress = await db.challenge_progress.find_one({
+        active_filter = {
             "user_id": user_id,
             "lesson_id": lesson_id,
             "challenge_id": challenge_id,
             "is_completed": False
-        })
+        }
         
-        if existing_progress:
-            # Обновляем существующий прогресс
-            daily_notes = existing_progress.get("daily_notes", [])
-            completed_days = existing_progress.get("completed_days", [])
-            
-            # Обновляем или добавляем заметку для дня
-            note_found = False
-            for i, note_item in enumerate(daily_notes):
-                if note_item.get("day") == day:
-                    daily_notes[i] = {
-                        "day": day,
-                        "note": note,
-                        "completed_at": datetime.utcnow()
-                    }
-                    note_found = True
-                    break
-            
-            if not note_found:
-                daily_notes.append({
-                    "day": day,
-                    "note": note,
-                    "completed_at": datetime.utcnow()
-                })
-            
-            # Обновляем список завершенных дней
-            if completed and day not in completed_days:
-                completed_days.append(day)
-            
-            # Определяем текущий день (максимальный завершенный + 1)
-            current_day = max(completed_days) + 1 if completed_days else 1
-            
-            is_completed = len(completed_days) >= total_days
-            
-            # Подсчет баллов
-            points_earned = 0
-            if is_completed:
-                points_earned = (len(completed_days) * points_per_day) + bonus_points
-            else:
-                points_earned = len(completed_days) * points_per_day
+        for _ in range(3):
+            now = datetime.utcnow()
             
-            # Получаем номер попытки
-            total_attempts = await db.challenge_progress.count_documents({
-                "user_id": user_id,
-                "lesson_id": lesson_id,
-                "challenge_id": challenge_id
-            })
-            
-            await db.challenge_progress.update_one(
-                {"_id": existing_progress["_id"]},
-                {"$set": {
-                    "current_day": current_day,
-                    "completed_days": completed_days,
-                    "daily_notes": daily_notes,
-                    "is_completed": is_completed,
-                    "completed_at": datetime.utcnow() if is_completed else None,
-                    "points_earned": points_earned,
-                    "attempt_number": total_attempts
-                }}
+            # Обновляем АКТИВНЫЙ прогресс (незавершенный) одним атомарным конвейером
+            progress = await db.challenge_progress.find_one_and_update(
+                active_filter,
+                build_challenge_day_pipeline(day, note, completed, total_days, points_per_day, bonus_points, now),
+                projection={"id": 1, "is_completed": 1, "last_points_delta": 1},
+                return_document=ReturnDocument.AFTER
             )
             
-            # Обновляем прогресс урока
-            await update_lesson_progress_with_challenge(user_id, lesson_id, is_completed)
+            if progress:
+                is_completed = progress.get("is_completed", False)
+                
+                # Независимые побочные записи выполняются параллельно; прогресс урока меняется
+                # только в момент завершения (обновляется лишь активная попытка)
+                side_writes = [record_challenge_note(progress["id"], user_id, lesson_id, challenge_id, day, note, now, is_completed)]
+                if progress.get("last_points_delta"):
+                    side_writes.append(award_points(user_id, lesson_id, "challenges", progress["last_points_delta"], progress.get("id")))
+                if is_completed:
+                    side_writes.append(apply_lesson_progress_delta(
+                        user_id,
+                        lesson_id,
+                        set_fields={"challenge_completed": True},
+                        analytics_increments={"total_challenges_completed": 1},
+                        analytics_daily={"challenges": 1}
+                    ))
+                await asyncio.gather(*side_writes)
+                break
             
-        else:
-            # Получаем номер попытки
+            # Активного прогресса нет - создаем новую попытку; номер попытки фиксируется при создании
             total_attempts = await db.challenge_progress.count_documents({
                 "user_id": user_id,
                 "lesson_id": lesson_id,
@@ -1319,15 +2660,31 @@ async def save_challenge_progress(
                 "daily_notes": [{
                     "day": day,
                     "note": note,
-                    "completed_at": datetime.utcnow()
+                    "completed_at": now
                 }],
                 "is_completed": False,
-                "started_at": datetime.utcnow(),
+                "started_at": now,
                 "completed_at": None,
                 "points_earned": points_earned,
+                "last_points_delta": points_earned,
+                "ledger_points": points_earned,
                 "attempt_number": total_attempts + 1
             }
-            await db.challenge_progress.insert_one(progress_data)
+            try:
+                await db.challenge_progress.insert_one(progress_data)
+            except DuplicateKeyError:
+                # Параллельный запрос (другое устройство) уже создал активную попытку - обновляем ее
+                continue
+            await asyncio.gather(
+                record_student_activity(user_id, {"total_challenge_attempts": 1}),
+                award_points(user_id, lesson_id, "challenges", points_earned, progress_data["id"]),
+                record_challenge_note(progress_data["id"], user_id, lesson_id, challenge_id, day, note, now, False)
+            )
+            break
+        else:
+            # Активная попытка все время создавалась и завершалась параллельно - день не сохранен
+            logger.warning(f"Challenge progress not saved after retries: user={user_id}, lesson={lesson_id}, day={day}")
+            raise HTTPException(status_code=409, detail="Прогресс не сохранен из-за параллельного изменения, повторите попытку")
         
         logger.info(f"Challenge progress saved: user={user_id}, lesson={lesson_id}, day={day}")
         
@@ -1337,6 +2694,8 @@ async def save_challenge_progress(
             "completed": completed
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         logger.error(f"Error saving challenge progress: {str(e)}")
@@ -1344,44 +2703,108 @@ async def save_challenge_progress(
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении прогресса: {str(e)}")
 
 
+CHALLENGE_HISTORY_PAGE_DEFAULT_LIMIT = 50
+CHALLENGE_HISTORY_PAGE_MAX_LIMIT = 200
+
+CHALLENGE_ATTEMPT_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "attempt_number": 1,
+    "completed_days": 1,
+    "is_completed": 1,
+    "points_earned": 1,
+    "started_at": 1,
+    "completed_at": 1
+}
+
+
+async def get_challenge_state(
+    user_id: str,
+    lesson_id: str,
+    challenge_id: str,
+    history_skip: int = 0,
+    history_limit: int = 0
+) -> dict:
+    """Состояние челленджа студента одной агрегацией по индексу (user_id, lesson_id, challenge_id):
+    текущая попытка (активная, иначе последняя), число попыток, суммы баллов и страница истории"""
+    facets = {
+        "current": [
+            {"$sort": {"is_completed": 1, "started_at": -1}},
+            {"$limit": 1},
+            {"$project": {
+                "_id": 0,
+                "current_day": 1,
+                "completed_days": 1,
+                "daily_notes": 1,
+                "is_completed": 1,
+                "started_at": 1,
+                "points_earned": 1
+            }}
+        ],
+        "totals": [{"$group": {
+            "_id": None,
+            "attempts": {"$sum": 1},
+            "points": {"$sum": {"$ifNull": ["$points_earned", 0]}},
+            "completed_points": {"$sum": {"$cond": [
+                {"$eq": ["$is_completed", True]}, {"$ifNull": ["$points_earned", 0]}, 0
+            ]}}
+        }}]
+    }
+    if history_limit > 0:
+        facets["history"] = [
+            {"$sort": {"started_at": -1}},  # Новые первые
+            {"$skip": history_skip},
+            {"$limit": history_limit},
+            {"$project": CHALLENGE_ATTEMPT_PROJECTION}
+        ]
+    
+    state = await aggregate_first(db.challenge_progress, [
+        {"$match": {"user_id": user_id, "lesson_id": lesson_id, "challenge_id": challenge_id}},
+        {"$facet": facets}
+    ])
+    current = state.get("current") or [None]
+    totals = state.get("totals") or [{}]
+    return {
+        "current": current[0],
+        "total_attempts": totals[0].get("attempts", 0),
+        "total_points": totals[0].get("points", 0),
+        "completed_points": totals[0].get("completed_points", 0),
+        "history": [format_challenge_attempt(attempt) for attempt in state.get("history", [])]
+    }
+
+
+def format_challenge_attempt(attempt: dict) -> dict:
+    """Попытка челленджа для истории"""
+    return {
+        "id": attempt.get("id"),
+        "attempt_number": attempt.get("attempt_number", 0),
+        "completed_days": attempt.get("completed_days", []),
+        "is_completed": attempt.get("is_completed", False),
+        "points_earned": attempt.get("points_earned", 0),
+        "started_at": attempt.get("started_at").isoformat() if attempt.get("started_at") else None,
+        "completed_at": attempt.get("completed_at").isoformat() if attempt.get("completed_at") else None
+    }
+
+
 @app_v2.get("/api/student/challenge-progress/{lesson_id}/{challenge_id}")
 async def get_challenge_progress(
     lesson_id: str,
     challenge_id: str,
+    history_limit: int = 0,
     current_user: dict = Depends(get_current_user)
 ):
-    """Получить текущий прогресс студента по челленджу"""
+    """Получить текущий прогресс студента по челленджу.
+    history_limit > 0 добавляет в ответ первую страницу истории прохождений"""
     try:
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
         
-        # Ищем активный (незавершенный) прогресс или последний прогресс
-        progress = await db.challenge_progress.find_one({
-            "user_id": user_id,
-            "lesson_id": lesson_id,
-            "challenge_id": challenge_id,
-            "is_completed": False
-        })
-        
-        # Если нет активного, берем последний завершенный
-        if not progress:
-            progress_cursor = db.challenge_progress.find({
-                "user_id": user_id,
-                "lesson_id": lesson_id,
-                "challenge_id": challenge_id
-            }).sort("started_at", -1).limit(1)
-            
-            progress_list = await progress_cursor.to_list(length=1)
-            progress = progress_list[0] if progress_list else None
+        history_limit = max(0, min(history_limit, CHALLENGE_HISTORY_PAGE_MAX_LIMIT))
+        state = await get_challenge_state(user_id, lesson_id, challenge_id, history_limit=history_limit)
+        progress = state["current"]
+        total_attempts = state["total_attempts"]
         
         if not progress:
-            # Получаем количество прохождений
-            total_attempts = await db.challenge_progress.count_documents({
-                "user_id": user_id,
-                "lesson_id": lesson_id,
-                "challenge_id": challenge_id
-            })
-            
-            return {
+            result = {
                 "current_day": 1,
                 "completed_days": [],
                 "daily_notes": [],
@@ -1390,41 +2813,23 @@ async def get_challenge_progress(
                 "total_attempts": total_attempts,
                 "total_points": 0
             }
+        else:
+            result = {
+                "current_day": progress.get("current_day", 1),
+                "completed_days": progress.get("completed_days", []),
+                "daily_notes": progress.get("daily_notes", []),
+                "is_completed": progress.get("is_completed", False),
+                "started_at": progress.get("started_at").isoformat() if progress.get("started_at") else None,
+                "attempt_number": total_attempts,
+                "total_attempts": total_attempts,
+                "points_earned": progress.get("points_earned", 0),
+                # Сумма баллов за завершенные прохождения
+                "total_points": state["completed_points"]
+            }
         
-        # Получаем общее количество прохождений
-        total_attempts = await db.challenge_progress.count_documents({
-            "user_id": user_id,
-            "lesson_id": lesson_id,
-            "challenge_id": challenge_id
-        })
-        
-        # Получаем сумму баллов за все прохождения
-        pipeline = [
-            {"$match": {
-                "user_id": user_id,
-                "lesson_id": lesson_id,
-                "challenge_id": challenge_id,
-                "is_completed": True
-            }},
-            {"$group": {
-                "_id": None,
-                "total_points": {"$sum": "$points_earned"}
-            }}
-        ]
-        points_result = await db.challenge_progress.aggregate(pipeline).to_list(length=1)
-        total_points = points_result[0]["total_points"] if points_result else 0
-        
-        return {
-            "current_day": progress.get("current_day", 1),
-            "completed_days": progress.get("completed_days", []),
-            "daily_notes": progress.get("daily_notes", []),
-            "is_completed": progress.get("is_completed", False),
-            "started_at": progress.get("started_at").isoformat() if progress.get("started_at") else None,
-            "attempt_number": total_attempts,
-            "total_attempts": total_attempts,
-            "points_earned": progress.get("points_earned", 0),
-            "total_points": total_points
-        }
+        if history_limit:
+            result["history"] = state["history"]
+        return result
         
     except Exception as e:
         logger.error(f"Error getting challenge progress: {str(e)}")
@@ -1435,45 +2840,27 @@ async def get_challenge_progress(
 async def get_challenge_history(
     lesson_id: str,
     challenge_id: str,
+    skip: int = 0,
+    limit: int = CHALLENGE_HISTORY_PAGE_DEFAULT_LIMIT,
     current_user: dict = Depends(get_current_user)
 ):
-    """Получить историю всех прохождений челленджа студентом"""
+    """Получить историю прохождений челленджа студентом (постранично, новые первые)"""
     try:
         user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
         
-        # Получаем все прохождения
-        attempts_cursor = db.challenge_progress.find({
-            "user_id": user_id,
-            "lesson_id": lesson_id,
-            "challenge_id": challenge_id
-        }).sort("started_at", -1)  # Новые первые
-        
-        attempts = await attempts_cursor.to_list(length=None)
-        
-        # Форматируем данные
-        formatted_attempts = []
-        total_points = 0
-        
-        for attempt in attempts:
-            points = attempt.get("points_earned", 0)
-            total_points += points
-            
-            formatted_attempts.append({
-                "id": attempt.get("id"),
-                "attempt_number": attempt.get("attempt_number", 0),
-                "completed_days": attempt.get("completed_days", []),
-                "is_completed": attempt.get("is_completed", False),
-                "points_earned": points,
-                "started_at": attempt.get("started_at").isoformat() if attempt.get("started_at") else None,
-                "completed_at": attempt.get("completed_at").isoformat() if attempt.get("completed_at") else None
-            })
+        skip = max(0, skip)
+        limit = max(1, min(limit, CHALLENGE_HISTORY_PAGE_MAX_LIMIT))
+        state = await get_challenge_state(user_id, lesson_id, challenge_id, history_skip=skip, history_limit=limit)
         
         return {
             "lesson_id": lesson_id,
             "challenge_id": challenge_id,
-            "total_attempts": len(attempts),
-            "total_points": total_points,
-            "attempts": formatted_attempts
+            "total_attempts": state["total_attempts"],
+            "total_points": state["total_points"],
+            "attempts": state["history"],
+            "skip": skip,
+            "limit": limit,
+            "has_more": skip + len(state["history"]) < state["total_attempts"]
         }
         
     except Exception as e:
@@ -1481,31 +2868,6 @@ async def get_challenge_history(
         raise HTTPException(status_code=500, detail=f"Ошибка при получении истории: {str(e)}")
 
 
-async def update_lesson_progress_with_challenge(user_id: str, lesson_id: str, challenge_completed: bool):
-    """Обновить прогресс урока с учетом челленджа"""
-    try:
-        # Получаем существующий прогресс
-        progress = await db.lesson_progress.find_one({
-            "user_id": user_id,
-            "lesson_id": lesson_id
-        })
-        
-        if progress:
-            await db.lesson_progress.update_one(
-                {"_id": progress["_id"]},
-                {"$set": {
-                    "challenge_completed": challenge_completed,
-                    "last_activity_at": datetime.utcnow()
-                }}
-            )
-            
-            # Пересчитываем процент завершения
-            await update_lesson_progress(user_id, lesson_id)
-        
-    except Exception as e:
-        logger.error(f"Error updating lesson progress with challenge: {str(e)}")
-
-
 # ===== ENDPOINTS ДЛЯ АНАЛИТИКИ (АДМИНИСТРАТОР) =====
 
 @app_v2.get("/api/admin/analytics/lesson/{lesson_id}")
@@ -1520,106 +2882,131 @@ async def get_lesson_analytics(
             raise HTTPException(status_code=403, detail="Доступ запрещен")
         
         # Получаем урок
-        lesson = await db.lessons_v2.find_one({"id": lesson_id})
+        lesson = await get_cached_lesson(lesson_id)
         if not lesson:
             raise HTTPException(status_code=404, detail="Урок не найден")
         
-        # Статистика по ответам на упражнения
-        exercise_responses = await db.exercise_responses.find({
-            "lesson_id": lesson_id
-        }).to_list(length=None)
-        
-        # Группируем ответы по студентам
-        students_responses = {}
-        for response in exercise_responses:
-            user_id = response.get("user_id")
-            if user_id not in students_responses:
-                students_responses[user_id] = []
-            students_responses[user_id].append({
-                "exercise_id": response.get("exercise_id"),
-                "response_text": response.get("response_text"),
-                "submitted_at": response.get("submitted_at").isoformat() if response.get("submitted_at") else None,
-                "reviewed": response.get("reviewed", False),
-                "admin_comment": response.get("admin_comment")
-            })
-        
-        # Статистика по прогрессу
-        lesson_progress_list = await db.lesson_progress.find({
-            "lesson_id": lesson_id
-        }).to_list(length=None)
+        # Все показатели считаются в MongoDB: группировки и $facet по индексу lesson_id,
+        # без загрузки ответов, попыток и прогресса (и их текстов) в память сервера
+        match_lesson = {"$match": {"lesson_id": lesson_id}}
+        count_users = [{"$group": {"_id": "$user_id"}}, {"$count": "count"}]
+        progress, responses, quizzes, challenges = await asyncio.gather(
+            aggregate_first(db.lesson_progress, [
+                match_lesson,
+                {"$facet": {
+                    "totals": [{"$group": {
+                        "_id": None,
+                        "completed": {"$sum": {"$cond": [{"$eq": ["$is_completed", True]}, 1, 0]}},
+                        "avg_completion": {"$avg": {"$ifNull": ["$completion_percentage", 0]}}
+                    }}],
+                    "users": count_users,
+                    "timeline": [
+                        {"$match": {"started_at": {"$type": "date"}}},
+                        {"$group": {
+                            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$started_at"}},
+                            "started": {"$sum": 1},
+                            "completed": {"$sum": {"$cond": [{"$eq": ["$is_completed", True]}, 1, 0]}}
+                        }},
+                        {"$sort": {"_id": 1}}
+                    ]
+                }}
+            ]),
+            aggregate_first(db.exercise_responses, [
+                match_lesson,
+                {"$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "reviewed": {"$sum": {"$cond": [{"$eq": ["$reviewed", True]}, 1, 0]}}
+                }}
+            ]),
+            aggregate_first(db.quiz_attempts, [
+                match_lesson,
+                {"$facet": {
+                    "totals": [{"$group": {
+                        "_id": None,
+                        "count": {"$sum": 1},
+                        "passed": {"$sum": {"$cond": [{"$eq": ["$passed", True]}, 1, 0]}},
+                        "avg_score": {"$avg": {"$ifNull": ["$score", 0]}},
+                        "points": {"$sum": "$points_earned"}
+                    }}],
+                    # Топ 10 по тестам
+                    "leaderboard": [
+                        {"$group": {
+                            "_id": "$user_id",
+                            "total_points": {"$sum": "$points_earned"},
+                            "attempts": {"$sum": 1},
+                            "passed": {"$sum": {"$cond": [{"$eq": ["$passed", True]}, 1, 0]}},
+                            "best_score": {"$max": {"$ifNull": ["$score", 0]}}
+                        }},
+                        {"$sort": {"total_points": -1, "_id": 1}},
+                        {"$limit": 10}
+                    ]
+                }}
+            ]),
+            aggregate_first(db.challenge_progress, [
+                match_lesson,
+                {"$facet": {
+                    "totals": [{"$group": {
+                        "_id": None,
+                        "count": {"$sum": 1},
+                        "completed": {"$sum": {"$cond": [{"$eq": ["$is_completed", True]}, 1, 0]}},
+                        "notes": {"$sum": {"$size": {"$ifNull": ["$daily_notes", []]}}},
+                        "points": {"$sum": "$points_earned"}
+                    }}],
+                    "users": count_users,
+                    # Топ 10 по челленджам
+                    "leaderboard": [
+                        {"$group": {
+                            "_id": "$user_id",
+                            "total_points": {"$sum": "$points_earned"},
+                            "attempts": {"$sum": 1},
+                            "completed": {"$sum": {"$cond": [{"$eq": ["$is_completed", True]}, 1, 0]}}
+                        }},
+                        {"$sort": {"total_points": -1, "_id": 1}},
+                        {"$limit": 10}
+                    ]
+                }}
+            ])
+        )
         
-        # Статистика по тестам
-        quiz_attempts = await db.quiz_attempts.find({
-            "lesson_id": lesson_id
-        }).to_list(length=None)
+        def first_of(facet_result, name):
+            return (facet_result.get(name) or [{}])[0]
         
-        # Статистика по челленджам
-        challenge_progress_list = await db.challenge_progress.find({
-            "lesson_id": lesson_id
-        }).to_list(length=None)
+        def leaderboard(facet_result):
+            return [
+                dict({key: value for key, value in entry.items() if key != "_id"}, user_id=entry["_id"])
+                for entry in facet_result.get("leaderboard", [])
+            ]
         
         # Общая статистика
-        total_students = len(set([p.get("user_id") for p in lesson_progress_list]))
-        completed_students = len([p for p in lesson_progress_list if p.get("is_completed")])
-        avg_completion = sum([p.get("completion_percentage", 0) for p in lesson_progress_list]) / len(lesson_progress_list) if lesson_progress_list else 0
+        progress_totals = first_of(progress, "totals")
+        total_students = first_of(progress, "users").get("count", 0)
+        completed_students = progress_totals.get("completed", 0)
+        avg_completion = progress_totals.get("avg_completion") or 0
         
-        total_exercise_responses = len(exercise_responses)
-        reviewed_responses = len([r for r in exercise_responses if r.get("reviewed")])
+        total_exercise_responses = responses.get("count", 0)
+        reviewed_responses = responses.get("reviewed", 0)
         
-        total_quiz_attempts = len(quiz_attempts)
-        passed_quizzes = len([q for q in quiz_attempts if q.get("passed")])
-        avg_quiz_score = sum([q.get("score", 0) for q in quiz_attempts]) / len(quiz_attempts) if quiz_attempts else 0
+        quiz_totals = first_of(quizzes, "totals")
+        total_quiz_attempts = quiz_totals.get("count", 0)
+        passed_quizzes = quiz_totals.get("passed", 0)
+        avg_quiz_score = quiz_totals.get("avg_score") or 0
         
         # Баллы за тесты
-        total_quiz_points = sum([q.get("points_earned", 0) for q in quiz_attempts])
+        total_quiz_points = quiz_totals.get("points", 0)
         avg_quiz_points = total_quiz_points / total_quiz_attempts if total_quiz_attempts > 0 else 0
         
-        # Топ студентов по баллам за тесты
-        user_quiz_points = {}
-        for q in quiz_attempts:
-            user_id = q.get("user_id")
-            points = q.get("points_earned", 0)
-            if user_id not in user_quiz_points:
-                user_quiz_points[user_id] = {"total_points": 0, "attempts": 0, "passed": 0, "best_score": 0}
-            user_quiz_points[user_id]["total_points"] += points
-            user_quiz_points[user_id]["attempts"] += 1
-            if q.get("passed"):
-                user_quiz_points[user_id]["passed"] += 1
-            user_quiz_points[user_id]["best_score"] = max(user_quiz_points[user_id]["best_score"], q.get("score", 0))
-        
         # Расширенная статистика по челленджам
-        unique_challenge_users = len(set([c.get("user_id") for c in challenge_progress_list]))
-        total_challenge_attempts = len(challenge_progress_list)
-        completed_challenges = len([c for c in challenge_progress_list if c.get("is_completed")])
-        total_challenge_notes = sum([len(c.get("daily_notes", [])) for c in challenge_progress_list])
+        challenge_totals = first_of(challenges, "totals")
+        unique_challenge_users = first_of(challenges, "users").get("count", 0)
+        total_challenge_attempts = challenge_totals.get("count", 0)
+        completed_challenges = challenge_totals.get("completed", 0)
+        total_challenge_notes = challenge_totals.get("notes", 0)
         
         # Баллы за челленджи
-        total_points_earned = sum([c.get("points_earned", 0) for c in challenge_progress_list])
+        total_points_earned = challenge_totals.get("points", 0)
         avg_points_per_attempt = total_points_earned / total_challenge_attempts if total_challenge_attempts > 0 else 0
         
-        # Топ студентов по баллам челленджа
-        user_points = {}
-        for c in challenge_progress_list:
-            user_id = c.get("user_id")
-            points = c.get("points_earned", 0)
-            if user_id not in user_points:
-                user_points[user_id] = {"total_points": 0, "attempts": 0, "completed": 0}
-            user_points[user_id]["total_points"] += points
-            user_points[user_id]["attempts"] += 1
-            if c.get("is_completed"):
-                user_points[user_id]["completed"] += 1
-        
-        # Прогресс по дням (для графика)
-        progress_by_date = {}
-        for progress in lesson_progress_list:
-            if progress.get("started_at"):
-                date_key = progress.get("started_at").strftime("%Y-%m-%d")
-                if date_key not in progress_by_date:
-                    progress_by_date[date_key] = {"started": 0, "completed": 0}
-                progress_by_date[date_key]["started"] += 1
-                if progress.get("is_completed"):
-                    progress_by_date[date_key]["completed"] += 1
-        
         return {
             "lesson_id": lesson_id,
             "lesson_title": lesson.get("title"),
@@ -1642,17 +3029,71 @@ async def get_lesson_analytics(
                 "total_points_earned": total_points_earned,
                 "avg_points_per_attempt": round(avg_points_per_attempt, 2)
             },
-            "quiz_leaderboard": sorted(
-                [{"user_id": uid, **data} for uid, data in user_quiz_points.items()],
-                key=lambda x: x["total_points"],
-                reverse=True
-            )[:10],  # Топ 10 по тестам
-            "challenge_leaderboard": sorted(
-                [{"user_id": uid, **data} for uid, data in user_points.items()],
-                key=lambda x: x["total_points"],
-                reverse=True
-            )[:10],  # Топ 10 по челленджам
-            "progress_timeline": sorted(progress_by_date.items()),
+            "quiz_leaderboard": leaderboard(quizzes),
+            "challenge_leaderboard": leaderboard(challenges),
+            "progress_timeline": [
+                [day["_id"], {"started": day["started"], "completed": day["completed"]}]
+                for day in progress.get("timeline", [])
+            ]
+            # Прогресс студентов - постранично: /api/admin/analytics/lesson/{lesson_id}/students
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting lesson analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении аналитики: {str(e)}")
+
+
+LESSON_STUDENTS_PAGE_DEFAULT_LIMIT = 100
+LESSON_STUDENTS_PAGE_MAX_LIMIT = 1000
+
+
+@app_v2.get("/api/admin/analytics/lesson/{lesson_id}/students")
+async def get_lesson_analytics_students(
+    lesson_id: str,
+    limit: int = LESSON_STUDENTS_PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Прогресс студентов по уроку для аналитики (постранично)
+    
+    Студенты упорядочены по user_id; next_cursor передается в параметр cursor.
+    """
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_admin') and not current_user.get('is_super_admin'):
+            raise HTTPException(status_code=403, detail="Доступ запрещен")
+        
+        limit = max(1, min(limit, LESSON_STUDENTS_PAGE_MAX_LIMIT))
+        query = {"lesson_id": lesson_id}
+        if cursor:
+            try:
+                query["user_id"] = {"$gt": base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")}
+            except Exception:
+                raise HTTPException(status_code=400, detail="Некорректный курсор")
+        
+        progress_list = await db.lesson_progress.find(
+            query,
+            {
+                "_id": 0,
+                "user_id": 1,
+                "completion_percentage": 1,
+                "exercises_completed": 1,
+                "quiz_completed": 1,
+                "quiz_passed": 1,
+                "last_activity_at": 1
+            }
+        ).sort("user_id", 1).limit(limit + 1).to_list(length=limit + 1)
+        
+        next_cursor = None
+        if len(progress_list) > limit:
+            progress_list = progress_list[:limit]
+            next_cursor = base64.urlsafe_b64encode(progress_list[-1]["user_id"].encode("utf-8")).decode("ascii")
+        
+        return {
+            "lesson_id": lesson_id,
             "students_data": [
                 {
                     "user_id": progress.get("user_id"),
@@ -1662,15 +3103,16 @@ async def get_lesson_analytics(
                     "quiz_passed": progress.get("quiz_passed", False),
                     "last_activity_at": progress.get("last_activity_at").isoformat() if progress.get("last_activity_at") else None
                 }
-                for progress in lesson_progress_list
-            ]
+                for progress in progress_list
+            ],
+            "next_cursor": next_cursor
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error getting lesson analytics: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ошибка при получении аналитики: {str(e)}")
+        logger.error(f"Error getting lesson students analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении списка студентов: {str(e)}")
 
 
 @app_v2.get("/api/admin/analytics/student-responses/{lesson_id}")
@@ -1685,7 +3127,7 @@ async def get_student_responses_for_lesson(
             raise HTTPException(status_code=403, detail="Доступ запрещен")
         
         # Получаем урок
-        lesson = await db.lessons_v2.find_one({"id": lesson_id})
+        lesson = await get_cached_lesson(lesson_id)
         if not lesson:
             raise HTTPException(status_code=404, detail="Урок не найден")
         
@@ -1694,10 +3136,8 @@ async def get_student_responses_for_lesson(
             "lesson_id": lesson_id
         }).sort("submitted_at", -1).to_list(length=None)
         
-        # Получаем информацию о пользователях
-        user_ids = list(set([r.get("user_id") for r in responses]))
-        users = await db.users.find({"username": {"$in": user_ids}}).to_list(length=None)
-        users_map = {u.get("username"): u.get("full_name", u.get("username")) for u in users}
+        # Получаем имена пользователей
+        users_map = await resolve_user_names(r.get("user_id") for r in responses)
         
         # Формируем данные по упражнениям
         exercises_map = {ex.get("id"): ex for ex in lesson.get("exercises", [])}
@@ -1777,52 +3217,104 @@ async def review_student_response(
         raise HTTPException(status_code=500, detail=f"Ошибка при добавлении комментария: {str(e)}")
 
 
+CHALLENGE_NOTES_PAGE_DEFAULT_LIMIT = 100
+CHALLENGE_NOTES_PAGE_MAX_LIMIT = 500
+
+
+def encode_challenge_notes_cursor(note: dict) -> str:
+    """Курсор страницы заметок: (completed_at, id) последней заметки"""
+    completed_at = note.get("completed_at")
+    payload = {"t": completed_at.isoformat() if completed_at else None, "id": note["id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+def decode_challenge_notes_cursor(cursor: str) -> dict:
+    """Условие keyset-пагинации для сортировки (completed_at desc, id desc)"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        completed_at = datetime.fromisoformat(payload["t"]) if payload["t"] else None
+        note_id = str(payload["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    
+    if completed_at is None:
+        # null сортируется последним при убывании - дальше только заметки без даты
+        return {"completed_at": None, "id": {"$lt": note_id}}
+    return {"$or": [
+        {"completed_at": {"$lt": completed_at}},
+        {"completed_at": None},
+        {"completed_at": completed_at, "id": {"$lt": note_id}}
+    ]}
+
+
 @app_v2.get("/api/admin/analytics/challenge-notes/{lesson_id}")
 async def get_challenge_notes_for_lesson(
     lesson_id: str,
+    limit: int = CHALLENGE_NOTES_PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+    day: Optional[int] = None,
+    user_id: Optional[str] = None,
+    search: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Получить все заметки студентов по челленджу урока"""
+    """
+    Заметки студентов по челленджу урока (постранично, новые первые)
+    
+    Фильтры: day - день челленджа, user_id - студент, search - полнотекстовый поиск по заметкам.
+    next_cursor передается в параметр cursor.
+    """
     try:
         # Проверка прав администратора
         if not current_user.get('is_admin') and not current_user.get('is_super_admin'):
             raise HTTPException(status_code=403, detail="Доступ запрещен")
         
         # Получаем урок
-        lesson = await db.lessons_v2.find_one({"id": lesson_id})
+        lesson = await get_cached_lesson(lesson_id)
         if not lesson:
             raise HTTPException(status_code=404, detail="Урок не найден")
         
-        # Получаем все прогрессы по челленджу
-        challenge_progresses = await db.challenge_progress.find({
-            "lesson_id": lesson_id
-        }).sort("started_at", -1).to_list(length=None)
+        limit = max(1, min(limit, CHALLENGE_NOTES_PAGE_MAX_LIMIT))
+        query = {"lesson_id": lesson_id}
+        if day is not None:
+            query["day"] = day
+        if user_id:
+            query["user_id"] = user_id
+        if search and search.strip():
+            query["$text"] = {"$search": search.strip()}
+        page_query = dict(query, **decode_challenge_notes_cursor(cursor)) if cursor else query
+        
+        notes, total_notes = await asyncio.gather(
+            db.challenge_notes.find(
+                page_query,
+                {"_id": 0, "id": 1, "user_id": 1, "day": 1, "note": 1, "completed_at": 1, "is_challenge_completed": 1}
+            ).sort([("completed_at", -1), ("id", -1)]).limit(limit + 1).to_list(length=limit + 1),
+            db.challenge_notes.count_documents(query)
+        )
         
-        # Получаем информацию о пользователях
-        user_ids = list(set([p.get("user_id") for p in challenge_progresses]))
-        users = await db.users.find({"username": {"$in": user_ids}}).to_list(length=None)
-        users_map = {u.get("username"): u.get("full_name", u.get("username")) for u in users}
+        next_cursor = None
+        if len(notes) > limit:
+            notes = notes[:limit]
+            next_cursor = encode_challenge_notes_cursor(notes[-1])
         
-        # Формируем данные
-        result = []
-        for progress in challenge_progresses:
-            daily_notes = progress.get("daily_notes", [])
-            for note_item in daily_notes:
-                if note_item.get("note"):  # Только если есть текст заметки
-                    result.append({
-                        "user_id": progress.get("user_id"),
-                        "user_name": users_map.get(progress.get("user_id"), progress.get("user_id")),
-                        "day": note_item.get("day"),
-                        "note": note_item.get("note"),
-                        "completed_at": note_item.get("completed_at").isoformat() if note_item.get("completed_at") else None,
-                        "is_challenge_completed": progress.get("is_completed", False)
-                    })
+        # Получаем имена пользователей
+        users_map = await resolve_user_names(note.get("user_id") for note in notes)
         
         return {
             "lesson_id": lesson_id,
             "lesson_title": lesson.get("title"),
-            "total_notes": len(result),
-            "notes": result
+            "total_notes": total_notes,
+            "notes": [
+                {
+                    "user_id": note.get("user_id"),
+                    "user_name": users_map.get(note.get("user_id"), note.get("user_id")),
+                    "day": note.get("day"),
+                    "note": note.get("note"),
+                    "completed_at": note.get("completed_at").isoformat() if note.get("completed_at") else None,
+                    "is_challenge_completed": note.get("is_challenge_completed", False)
+                }
+                for note in notes
+            ],
+            "next_cursor": next_cursor
         }
         
     except HTTPException:
@@ -1832,6 +3324,32 @@ async def get_challenge_notes_for_lesson(
         raise HTTPException(status_code=500, detail=f"Ошибка при получении заметок: {str(e)}")
 
 
+@app_v2.post("/api/admin/challenge-notes/rebuild")
+async def rebuild_challenge_notes_endpoint(
+    current_user: dict = Depends(get_current_user)
+):
+    """Перестроить challenge_notes из попыток челленджей (миграция и восстановление)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        notes_count = await rebuild_challenge_notes()
+        
+        logger.info(f"Challenge notes rebuilt: {notes_count} notes")
+        
+        return {
+            "message": "Заметки челленджей перестроены",
+            "notes": notes_count
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rebuilding challenge notes: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при перестройке заметок челленджей: {str(e)}")
+
+
 @app_v2.get("/api/admin/analytics/overview")
 async def get_analytics_overview(
     current_user: dict = Depends(get_current_user)
@@ -1848,26 +3366,19 @@ async def get_analytics_overview(
         total_responses = await db.exercise_responses.count_documents({})
         pending_reviews = await db.exercise_responses.count_documents({"reviewed": False})
         
-        # Подсчет выданных баллов
-        challenge_points_cursor = await db.challenge_progress.aggregate([
-            {"$group": {"_id": None, "total": {"$sum": {"$ifNull": ["$points_earned", 0]}}}}
-        ]).to_list(length=None)
-        total_challenge_points = challenge_points_cursor[0]["total"] if challenge_points_cursor else 0
-        
-        quiz_points_cursor = await db.quiz_attempts.aggregate([
-            {"$group": {"_id": None, "total": {"$sum": {"$ifNull": ["$points_earned", 0]}}}}
-        ]).to_list(length=None)
-        total_quiz_points = quiz_points_cursor[0]["total"] if quiz_points_cursor else 0
-        
-        time_points_cursor = await db.time_activity.aggregate([
-            {"$group": {"_id": None, "total": {"$sum": {"$ifNull": ["$total_points", 0]}}}}
-        ]).to_list(length=None)
-        total_time_points = time_points_cursor[0]["total"] if time_points_cursor else 0
-        
-        video_points_cursor = await db.video_watch_time.aggregate([
-            {"$group": {"_id": None, "total": {"$sum": {"$ifNull": ["$total_points", 0]}}}}
-        ]).to_list(length=None)
-        total_video_points = video_points_cursor[0]["total"] if video_points_cursor else 0
+        # Подсчет выданных баллов - по общим балансам студентов
+        points_totals = await db.points_balances.aggregate([
+            {"$match": {"lesson_id": None}},
+            {"$group": dict(
+                {"_id": None},
+                **{source: {"$sum": {"$ifNull": [f"$by_source.{source}", 0]}} for source in POINTS_SOURCES}
+            )}
+        ]).to_list(length=1)
+        points_totals = points_totals[0] if points_totals else {}
+        total_challenge_points = points_totals.get("challenges", 0)
+        total_quiz_points = points_totals.get("quizzes", 0)
+        total_time_points = points_totals.get("time", 0)
+        total_video_points = points_totals.get("videos", 0)
         
         total_points_awarded = total_challenge_points + total_quiz_points + total_time_points + total_video_points
         
@@ -1875,11 +3386,13 @@ async def get_analytics_overview(
         active_students = await db.lesson_progress.distinct("user_id")
         active_students_count = len(active_students)
         
-        # Активность за последние 7 дней
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        recent_activity = await db.lesson_progress.count_documents({
-            "last_activity_at": {"$gte": seven_days_ago}
-        })
+        # Активность за последние 7 дней - сумма дневных сводок студентов
+        seven_days_ago = get_day_start(datetime.utcnow() - timedelta(days=7))
+        recent_activity_totals = await db.activity_daily.aggregate([
+            {"$match": {"scope": "user", "date": {"$gte": seven_days_ago}}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}}}
+        ]).to_list(length=1)
+        recent_activity = recent_activity_totals[0]["total"] if recent_activity_totals else 0
         
         # Топ уроков по популярности
         pipeline = [
@@ -1895,8 +3408,8 @@ async def get_analytics_overview(
         
         # Получаем названия уроков
         lesson_ids = [l.get("_id") for l in top_lessons]
-        lessons = await db.lessons_v2.find({"id": {"$in": lesson_ids}}).to_list(length=None)
-        lessons_map = {l.get("id"): l.get("title") for l in lessons}
+        lessons = await get_cached_lessons(lesson_ids)
+        lessons_map = {l_id: l.get("title") for l_id, l in lessons.items()}
         
         top_lessons_formatted = [
             {
@@ -1913,19 +3426,15 @@ async def get_analytics_overview(
         pending_responses_list = await pending_responses_cursor.to_list(length=None)
         
         lesson_ids = list(set([resp.get("lesson_id") for resp in pending_responses_list if resp.get("lesson_id")]))
-        lessons_docs = await db.lessons_v2.find({"id": {"$in": lesson_ids}}).to_list(length=None)
-        lessons_map = {lesson.get("id"): lesson for lesson in lessons_docs}
+        lessons_map = await get_cached_lessons(lesson_ids)
         
-        user_ids = list(set([resp.get("user_id") for resp in pending_responses_list if resp.get("user_id")]))
-        users_docs = await db.users.find({"username": {"$in": user_ids}}).to_list(length=None)
-        users_map = {user.get("username"): user for user in users_docs}
+        users_map = await resolve_user_names(resp.get("user_id") for resp in pending_responses_list)
         
         pending_reviews_details = []
         for response in pending_responses_list:
             lesson_id = response.get("lesson_id")
             exercise_id = response.get("exercise_id")
             lesson_doc = lessons_map.get(lesson_id, {})
-            user_doc = users_map.get(response.get("user_id"), {})
             
             exercise_title = None
             exercises = lesson_doc.get("exercises", []) if lesson_doc else []
@@ -1937,7 +3446,7 @@ async def get_analytics_overview(
             pending_reviews_details.append({
                 "response_id": response.get("id") or str(response.get("_id")),
                 "user_id": response.get("user_id"),
-                "user_name": user_doc.get("full_name") or user_doc.get("username") or response.get("user_id"),
+                "user_name": users_map.get(response.get("user_id"), response.get("user_id")),
                 "lesson_id": lesson_id,
                 "lesson_title": lesson_doc.get("title", "Неизвестный урок"),
                 "exercise_id": exercise_id,
@@ -1973,8 +3482,8 @@ async def get_analytics_overview(
 
 # ===== ENDPOINTS ДЛЯ ЗАГРУЗКИ ФАЙЛОВ (АДМИНИСТРАТОР) =====
 
-# Монтируем папку uploads для доступа к файлам
-app_v2.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Папка uploads не раздается статически: файлы (в том числе хранилище blobs и части
+# незавершенных загрузок) доступны только через /api/download-file и /api/stream-file
 
 @app_v2.get("/api/download-file/{file_id}")
 async def download_file(
@@ -1983,8 +3492,8 @@ async def download_file(
 ):
     """Скачать файл с заголовком Content-Disposition: attachment (доступно всем авторизованным пользователям)"""
     try:
-        # Находим файл в базе данных
-        file_doc = await db.files.find_one({"id": file_id})
+        # Находим файл (метаданные кэшируются)
+        file_doc = await get_cached_file_doc(file_id)
         if not file_doc:
             raise HTTPException(status_code=404, detail="Файл не найден")
         
@@ -2029,6 +3538,402 @@ async def download_file(
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка при скачивании файла: {str(e)}")
 
+# ===== ПОТОКОВАЯ ОТДАЧА ФАЙЛОВ (HTTP RANGE) =====
+# Метаданные файлов кэшируются в памяти процесса: плеер при перемотке шлет много
+# Range-запросов к одному и тому же файлу, и каждый из них не должен ходить в MongoDB.
+
+FILE_DOC_CACHE_TTL_SECONDS = int(os.environ.get('FILE_DOC_CACHE_TTL_SECONDS', '300'))
+FILE_STREAM_CHUNK_SIZE = 256 * 1024  # 256 КБ
+
+file_doc_cache = {}  # file_id -> {"doc": dict, "expires_at": float}
+
+
+async def get_cached_file_doc(file_id: str) -> Optional[dict]:
+    """Получить метаданные файла (из кэша или из БД)"""
+    entry = file_doc_cache.get(file_id)
+    if entry and entry["expires_at"] > time.monotonic():
+        return entry["doc"]
+    
+    file_doc = await db.files.find_one({"id": file_id}, {"_id": 0})
+    if file_doc:
+        file_doc_cache[file_id] = {
+            "doc": file_doc,
+            "expires_at": time.monotonic() + FILE_DOC_CACHE_TTL_SECONDS
+        }
+    else:
+        file_doc_cache.pop(file_id, None)
+    return file_doc
+
+
+def invalidate_file_doc_cache(file_id: Optional[str] = None):
+    """Сбросить кэш метаданных файла (или весь кэш)"""
+    if file_id is None:
+        file_doc_cache.clear()
+    else:
+        file_doc_cache.pop(file_id, None)
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[tuple]:
+    """Разобрать заголовок Range (один диапазон). Возвращает (start, end) включительно,
+    None если заголовок не поддерживается (отдаем файл целиком), 416 если диапазон вне файла"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, sep, end_str = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_str == "":
+            # Суффиксный диапазон: последние N байт
+            suffix = int(end_str)
+            if suffix <= 0:
+                raise ValueError
+            start = max(file_size - suffix, 0)
+            end = file_size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+            end = min(end, file_size - 1)
+    except ValueError:
+        return None
+    if start < 0 or start >= file_size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Запрошенный диапазон недоступен",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, end
+
+
+def build_file_etag(file_doc: dict, stat_result: os.stat_result) -> str:
+    checksum = file_doc.get("checksum_sha256")
+    if checksum:
+        return f'"{checksum}"'
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(header_value: Optional[str], etag: str) -> bool:
+    if not header_value:
+        return False
+    candidates = [tag.strip() for tag in header_value.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def is_not_modified_since(header_value: Optional[str], mtime: float) -> bool:
+    if not header_value:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(header_value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+async def iter_file_range(file_path: str, start: int, length: int):
+    """Читать диапазон файла блоками в пуле потоков"""
+    handle = await asyncio.to_thread(open, file_path, "rb")
+    try:
+        await asyncio.to_thread(handle.seek, start)
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.to_thread(handle.read, min(FILE_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(handle.close)
+
+
+@app_v2.get("/api/stream-url/{file_id}")
+async def get_stream_url(
+    file_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Подписанная ссылка на просмотр файла (для <video>/<img>/<iframe>): действует
+    только для этого файла и MEDIA_URL_TTL_SECONDS секунд"""
+    try:
+        file_doc = await get_cached_file_doc(file_id)
+        if not file_doc:
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        
+        params = create_media_url_params(file_id)
+        return {
+            "url": f"/api/stream-file/{file_id}?expires={params['expires']}&signature={params['signature']}",
+            "expires_at": datetime.utcfromtimestamp(params["expires"]).isoformat(),
+            "ttl_seconds": MEDIA_URL_TTL_SECONDS
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating stream url for {file_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении ссылки на файл: {str(e)}")
+
+
+@app_v2.get("/api/stream-file/{file_id}")
+async def stream_file(
+    file_id: str,
+    request: Request,
+    access: dict = Depends(get_file_access)
+):
+    """
+    Потоковая отдача файла для просмотра (видео, изображения, PDF) с поддержкой
+    Range / If-Range / ETag / Last-Modified. Доступ - по заголовку Authorization
+    или по подписанной ссылке из /api/stream-url/{file_id}
+    """
+    try:
+        file_doc = await get_cached_file_doc(file_id)
+        if not file_doc:
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        
+        file_path = file_doc.get("file_path")
+        try:
+            stat_result = await asyncio.to_thread(os.stat, file_path)
+        except (OSError, TypeError):
+            invalidate_file_doc_cache(file_id)
+            raise HTTPException(status_code=404, detail=f"Физический файл не найден: {file_path}")
+        
+        file_size = stat_result.st_size
+        mime_type = file_doc.get("mime_type") or "application/octet-stream"
+        etag = build_file_etag(file_doc, stat_result)
+        last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        
+        from urllib.parse import quote
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Cache-Control": "private, max-age=3600",
+            "Content-Disposition": f"inline; filename*=UTF-8''{quote(file_doc.get('original_name') or file_id)}",
+            # Подписанная ссылка не должна уходить в Referer из открытого документа
+            "Referrer-Policy": "no-referrer"
+        }
+        
+        # Условные запросы: у браузера уже есть актуальная копия
+        if_none_match = request.headers.get("if-none-match")
+        if etag_matches(if_none_match, etag) or (
+            if_none_match is None and is_not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime)
+        ):
+            return Response(status_code=304, headers=headers)
+        
+        byte_range = None
+        range_header = request.headers.get("range")
+        if range_header:
+            # If-Range: отдаем диапазон только если файл не изменился, иначе - файл целиком
+            if_range = request.headers.get("if-range")
+            if not if_range or if_range.strip() == etag or if_range.strip() == last_modified:
+                byte_range = parse_range_header(range_header, file_size)
+        
+        if byte_range is None:
+            return FileResponse(
+                path=file_path,
+                media_type=mime_type,
+                headers=headers,
+                stat_result=stat_result
+            )
+        
+        start, end = byte_range
+        length = end - start + 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(length)
+        return StreamingResponse(
+            iter_file_range(file_path, start, length),
+            status_code=206,
+            media_type=mime_type,
+            headers=headers
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error streaming file {file_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при отдаче файла: {str(e)}")
+
+
+# ===== ПОТОКОВАЯ ЗАПИСЬ ЗАГРУЖАЕМЫХ ФАЙЛОВ =====
+
+UPLOAD_DIR = "uploads/learning_v2"
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 МБ
+VIDEO_EXTENSIONS = ['mp4', 'avi', 'mov', 'wmv', 'flv', 'mkv', 'webm']
+MAX_VIDEO_SIZE = 2 * 1024 * 1024 * 1024  # 2 ГБ
+
+
+def copy_upload_to_temp(source_file, upload_dir: str, max_size: Optional[int]):
+    """
+    Скопировать загруженный файл во временный файл в upload_dir блоками по UPLOAD_CHUNK_SIZE.
+    Выполняется в пуле потоков. Возвращает (путь, размер, sha256).
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix=".upload-", suffix=".tmp")
+    checksum = hashlib.sha256()
+    file_size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = source_file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if max_size is not None and file_size > max_size:
+                    raise HTTPException(status_code=413, detail="Размер видео не должен превышать 2 ГБ")
+                checksum.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, file_size, checksum.hexdigest()
+
+
+# ===== ХРАНИЛИЩЕ ФАЙЛОВ ПО СОДЕРЖИМОМУ =====
+# Содержимое хранится один раз: uploads/blobs/<sha256[:2]>/<sha256>.
+# Документы files ссылаются на blob, счетчик ссылок - в коллекции file_blobs.
+# Файлы, загруженные до появления хранилища (без storage="blob"), удаляются как раньше.
+
+BLOB_DIR = "uploads/blobs"
+
+
+def get_blob_path(checksum: str) -> str:
+    return os.path.join(BLOB_DIR, checksum[:2], checksum)
+
+
+def place_blob_file(tmp_path: str, blob_path: str) -> bool:
+    """Перенести временный файл в хранилище (в пуле потоков, после добавления ссылки в file_blobs).
+    Если такое содержимое уже лежит на диске - временный файл удаляется. Возвращает True, если blob записан.
+    Удаление blob сначала убирает файл в надгробие, поэтому наличие файла здесь, при уже добавленной
+    ссылке, означает, что он не будет удален; отсутствующий файл записывается заново"""
+    if os.path.exists(blob_path):
+        os.remove(tmp_path)
+        return False
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.replace(tmp_path, blob_path)
+    return True
+
+
+def bury_blob_file(blob_path: str) -> Optional[str]:
+    """Переименовать blob в надгробие перед удалением записи; возвращает путь надгробия"""
+    tombstone_path = f"{blob_path}.deleted-{uuid.uuid4().hex}"
+    try:
+        os.replace(blob_path, tombstone_path)
+    except FileNotFoundError:
+        return None
+    return tombstone_path
+
+
+def restore_blob_file(tombstone_path: str, blob_path: str):
+    """Вернуть blob из надгробия (на blob снова есть ссылка); если его уже записали заново -
+    надгробие удаляется"""
+    if os.path.exists(blob_path):
+        remove_blob_file(tombstone_path)
+    else:
+        os.replace(tombstone_path, blob_path)
+
+
+def remove_blob_file(blob_path: str):
+    try:
+        os.remove(blob_path)
+    except FileNotFoundError:
+        pass
+
+
+async def acquire_file_blob(tmp_path: str, checksum: str, file_size: int) -> tuple:
+    """Добавить ссылку на blob (создав его при первой загрузке). Возвращает (путь, записан_ли_файл)"""
+    blob_path = get_blob_path(checksum)
+    await db.file_blobs.update_one(
+        {"sha256": checksum},
+        {
+            "$inc": {"ref_count": 1},
+            "$setOnInsert": {
+                "sha256": checksum,
+                "file_path": blob_path,
+                "file_size": file_size,
+                "created_at": datetime.utcnow()
+            }
+        },
+        upsert=True
+    )
+    try:
+        written = await asyncio.to_thread(place_blob_file, tmp_path, blob_path)
+    except BaseException:
+        await release_file_blob(checksum)
+        raise
+    return blob_path, written
+
+
+async def release_file_blob(checksum: str):
+    """Убрать ссылку на blob; при нуле ссылок удалить запись и файл"""
+    blob = await db.file_blobs.find_one_and_update(
+        {"sha256": checksum},
+        {"$inc": {"ref_count": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None or blob.get("ref_count", 0) > 0:
+        return
+    # Файл сначала убирается в надгробие: параллельная загрузка того же содержимого,
+    # добавив ссылку, не найдет blob и запишет его заново, а не будет ссылаться на удаляемый файл
+    blob_path = blob.get("file_path") or get_blob_path(checksum)
+    tombstone_path = await asyncio.to_thread(bury_blob_file, blob_path)
+    # Удаляем запись только если за это время никто не добавил новую ссылку
+    removed = await db.file_blobs.find_one_and_delete({"sha256": checksum, "ref_count": {"$lte": 0}})
+    if tombstone_path is None:
+        return
+    if removed:
+        await asyncio.to_thread(remove_blob_file, tombstone_path)
+        logger.info(f"Blob deleted: {checksum}")
+    else:
+        await asyncio.to_thread(restore_blob_file, tombstone_path, blob_path)
+
+
+async def register_uploaded_file(
+    tmp_path: str,
+    checksum: str,
+    file_size: int,
+    file_id: str,
+    lesson_id: str,
+    section: str,
+    file_type: str,
+    original_name: str,
+    mime_type: Optional[str],
+    extension: str,
+    uploaded_by: str
+) -> dict:
+    """Поместить загруженное содержимое в хранилище и сохранить метаданные в коллекцию files.
+    Повторная загрузка того же содержимого создает только запись метаданных"""
+    blob_path, written = await acquire_file_blob(tmp_path, checksum, file_size)
+    file_metadata = {
+        "id": file_id,
+        "lesson_id": lesson_id,
+        "section": section,
+        "file_type": file_type,
+        "original_name": original_name,
+        "stored_name": original_name,
+        "file_path": blob_path,
+        "storage": "blob",
+        "file_size": file_size,
+        "checksum_sha256": checksum,
+        "mime_type": mime_type,
+        "extension": extension,
+        "uploaded_by": uploaded_by,
+        "uploaded_at": datetime.utcnow()
+    }
+    try:
+        await db.files.insert_one(file_metadata)
+    except BaseException:
+        await release_file_blob(checksum)
+        raise
+    if not written:
+        logger.info(f"Upload deduplicated: {original_name} -> blob {checksum}")
+    return file_metadata
+
+
+async def remove_stored_file(file_metadata: dict):
+    """Удалить содержимое файла с диска с учетом общих blob"""
+    if file_metadata.get("storage") == "blob":
+        await release_file_blob(file_metadata["checksum_sha256"])
+        return
+    file_path = file_metadata.get("file_path")
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+        logger.info(f"Physical file deleted: {file_path}")
+
+
 @app_v2.post("/api/admin/upload-file")
 async def upload_file(
     file: UploadFile = File(...),
@@ -2050,64 +3955,38 @@ async def upload_file(
         if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
             raise HTTPException(status_code=403, detail="Недостаточно прав")
         
-        # Проверка размера файла для видео
-        file_size = 0
-        content = await file.read()
-        file_size = len(content)
-        await file.seek(0)  # Возвращаем указатель в начало
-        
         # Определяем тип файла по расширению
         file_ext = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
         
-        # Проверка размера для видео (2 ГБ = 2 * 1024 * 1024 * 1024 байт)
-        video_extensions = ['mp4', 'avi', 'mov', 'wmv', 'flv', 'mkv', 'webm']
-        if file_ext in video_extensions and file_size > 2 * 1024 * 1024 * 1024:
-            raise HTTPException(status_code=413, detail="Размер видео не должен превышать 2 ГБ")
-        
-        # Создаем уникальное имя файла с защитой от конфликтов
+        # Уникальный идентификатор файла
         file_id = str(uuid.uuid4())
         
         # Определяем папку для сохранения
-        upload_dir = "uploads/learning_v2"
+        upload_dir = UPLOAD_DIR
         os.makedirs(upload_dir, exist_ok=True)
         
-        # Получаем оригинальное имя и расширение
-        original_name = file.filename
-        name_parts = os.path.splitext(original_name)
-        base_name = name_parts[0]
-        extension = name_parts[1]
-        
-        # Проверяем конфликты и добавляем суффикс при необходимости
-        safe_filename = original_name
-        file_path = os.path.join(upload_dir, safe_filename)
-        counter = 1
-        
-        while os.path.exists(file_path):
-            safe_filename = f"{base_name}({counter}){extension}"
-            file_path = os.path.join(upload_dir, safe_filename)
-            counter += 1
-        
-        # Сохраняем файл
-        with open(file_path, "wb") as f:
-            f.write(content)
-        
-        # Сохраняем метаданные в БД
-        file_metadata = {
-            "id": file_id,
-            "lesson_id": lesson_id,
-            "section": section,
-            "file_type": file_type,
-            "original_name": safe_filename,  # Используем финальное имя (с суффиксом при конфликте)
-            "stored_name": safe_filename,
-            "file_path": file_path,
-            "file_size": file_size,
-            "mime_type": file.content_type,
-            "extension": file_ext,
-            "uploaded_by": current_user.get('user_id', current_user.get('id', 'unknown')),
-            "uploaded_at": datetime.utcnow()
-        }
+        # Потоково копируем файл на диск (в пуле потоков): лимит размера и контрольная сумма
+        # проверяются по ходу копирования, содержимое целиком в память не загружается
+        max_size = MAX_VIDEO_SIZE if file_ext in VIDEO_EXTENSIONS else None
+        await file.seek(0)
+        tmp_path, file_size, checksum = await asyncio.to_thread(
+            copy_upload_to_temp, file.file, upload_dir, max_size
+        )
         
-        await db.files.insert_one(file_metadata)
+        # Кладем содержимое в хранилище (или переиспользуем существующее) и сохраняем метаданные в БД
+        await register_uploaded_file(
+            tmp_path=tmp_path,
+            checksum=checksum,
+            file_size=file_size,
+            file_id=file_id,
+            lesson_id=lesson_id,
+            section=section,
+            file_type=file_type,
+            original_name=file.filename,
+            mime_type=file.content_type,
+            extension=file_ext,
+            uploaded_by=current_user.get('user_id', current_user.get('id', 'unknown'))
+        )
         
         logger.info(f"File uploaded: {file.filename} ({file_size} bytes) for lesson {lesson_id}, section {section}")
         
@@ -2126,6 +4005,446 @@ async def upload_file(
         raise HTTPException(status_code=500, detail=f"Ошибка при загрузке файла: {str(e)}")
 
 
+# ===== ВОЗОБНОВЛЯЕМАЯ ЗАГРУЗКА ФАЙЛОВ ПО ЧАСТЯМ =====
+# Сессия: init -> PUT пронумерованных частей (можно параллельно и повторно) -> complete.
+# Части хранятся в uploads/learning_v2/.partial/<session_id>/, состояние - в upload_sessions.
+# Каждое обращение продлевает expires_at; просроченные сессии удаляются фоновой очисткой
+# вместе с частями (TTL-индекс по expires_at - страховка для документов)
+
+UPLOAD_PARTIAL_DIR = os.path.join(UPLOAD_DIR, ".partial")
+UPLOAD_SESSION_DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8 МБ
+UPLOAD_SESSION_MIN_CHUNK_SIZE = 1024 * 1024  # 1 МБ
+UPLOAD_SESSION_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # 64 МБ
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS = 3600
+# Сессия в статусе assembling дольше этого срока считается брошенной (процесс упал во время
+# склейки) и может быть захвачена повторным вызовом complete
+UPLOAD_SESSION_ASSEMBLY_TIMEOUT_SECONDS = int(os.getenv("UPLOAD_SESSION_ASSEMBLY_TIMEOUT_SECONDS", "900"))
+upload_session_sweep_task = None
+
+
+def get_upload_session_dir(session_id: str) -> str:
+    return os.path.join(UPLOAD_PARTIAL_DIR, session_id)
+
+
+def upload_session_expires_at(now: datetime) -> datetime:
+    return now + timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)
+
+
+def get_upload_chunk_path(session_id: str, index: int) -> str:
+    return os.path.join(get_upload_session_dir(session_id), f"{index}.part")
+
+
+def expected_chunk_size(session: dict, index: int) -> int:
+    """Ожидаемый размер части (последняя часть может быть короче)"""
+    if index < session["total_chunks"] - 1:
+        return session["chunk_size"]
+    return session["file_size"] - session["chunk_size"] * (session["total_chunks"] - 1)
+
+
+def assemble_upload_chunks(session: dict, upload_dir: str):
+    """Склеить части сессии во временный файл в upload_dir (в пуле потоков). Возвращает (путь, размер, sha256)"""
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix=".upload-", suffix=".tmp")
+    checksum = hashlib.sha256()
+    file_size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for index in range(session["total_chunks"]):
+                with open(get_upload_chunk_path(session["id"], index), "rb") as part:
+                    while True:
+                        chunk = part.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        file_size += len(chunk)
+                        checksum.update(chunk)
+                        out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, file_size, checksum.hexdigest()
+
+
+def format_upload_session(session: dict) -> dict:
+    received = sorted(session.get("received_chunks", []))
+    received_set = set(received)
+    return {
+        "session_id": session.get("id"),
+        "filename": session.get("filename"),
+        "file_size": session.get("file_size"),
+        "chunk_size": session.get("chunk_size"),
+        "total_chunks": session.get("total_chunks"),
+        "received_chunks": received,
+        "missing_chunks": [i for i in range(session.get("total_chunks", 0)) if i not in received_set],
+        "status": session.get("status"),
+        "file_id": session.get("file_id"),
+        "created_at": session.get("created_at").isoformat() if session.get("created_at") else None,
+        "updated_at": session.get("updated_at").isoformat() if session.get("updated_at") else None
+    }
+
+
+async def get_upload_session_or_404(session_id: str) -> dict:
+    session = await db.upload_sessions.find_one({"id": session_id})
+    if not session:
+        raise HTTPException(status_code=404, detail="Сессия загрузки не найдена")
+    return session
+
+
+class UploadSessionInitRequest(BaseModel):
+    """Модель для создания сессии загрузки файла по частям"""
+    filename: str
+    file_size: int
+    lesson_id: str
+    section: str  # theory, exercises, challenge, quiz
+    file_type: str  # media, document
+    mime_type: Optional[str] = None
+    chunk_size: Optional[int] = None
+
+
+@app_v2.post("/api/admin/upload-sessions")
+async def create_upload_session(
+    request: UploadSessionInitRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Создать сессию возобновляемой загрузки файла по частям"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        if request.file_size <= 0:
+            raise HTTPException(status_code=400, detail="Размер файла должен быть больше нуля")
+        
+        file_ext = request.filename.split('.')[-1].lower() if '.' in request.filename else ''
+        if file_ext in VIDEO_EXTENSIONS and request.file_size > MAX_VIDEO_SIZE:
+            raise HTTPException(status_code=413, detail="Размер видео не должен превышать 2 ГБ")
+        
+        chunk_size = request.chunk_size or UPLOAD_SESSION_DEFAULT_CHUNK_SIZE
+        chunk_size = max(UPLOAD_SESSION_MIN_CHUNK_SIZE, min(chunk_size, UPLOAD_SESSION_MAX_CHUNK_SIZE))
+        total_chunks = (request.file_size + chunk_size - 1) // chunk_size
+        
+        now = datetime.utcnow()
+        session = {
+            "id": str(uuid.uuid4()),
+            "filename": request.filename,
+            "file_size": request.file_size,
+            "chunk_size": chunk_size,
+            "total_chunks": total_chunks,
+            "received_chunks": [],
+            "lesson_id": request.lesson_id,
+            "section": request.section,
+            "file_type": request.file_type,
+            "mime_type": request.mime_type,
+            "extension": file_ext,
+            "status": "active",  # active, assembling, completed, aborted
+            "file_id": None,
+            "created_by": current_user.get('user_id', current_user.get('id', 'unknown')),
+            "created_at": now,
+            "updated_at": now,
+            "expires_at": upload_session_expires_at(now)
+        }
+        
+        await asyncio.to_thread(os.makedirs, get_upload_session_dir(session["id"]), exist_ok=True)
+        await db.upload_sessions.insert_one(session)
+        
+        logger.info(f"Upload session created: {session['id']} for {request.filename} ({request.file_size} bytes, {total_chunks} chunks)")
+        
+        return format_upload_session(session)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating upload session: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при создании сессии загрузки: {str(e)}")
+
+
+@app_v2.get("/api/admin/upload-sessions/{session_id}")
+async def get_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Получить состояние сессии загрузки (для возобновления: какие части еще не получены)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        session = await get_upload_session_or_404(session_id)
+        return format_upload_session(session)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting upload session: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении сессии загрузки: {str(e)}")
+
+
+@app_v2.put("/api/admin/upload-sessions/{session_id}/chunks/{index}")
+async def upload_session_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Загрузить часть файла (тело запроса - сырые байты части). Повторная загрузка части перезаписывает ее"""
+    tmp_path = None
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        session = await get_upload_session_or_404(session_id)
+        if session.get("status") != "active":
+            raise HTTPException(status_code=409, detail=f"Сессия загрузки в состоянии {session.get('status')}")
+        if index < 0 or index >= session["total_chunks"]:
+            raise HTTPException(status_code=400, detail="Некорректный номер части")
+        
+        expected_size = expected_chunk_size(session, index)
+        chunk_path = get_upload_chunk_path(session_id, index)
+        tmp_path = f"{chunk_path}.{uuid.uuid4().hex}.tmp"
+        
+        # Пишем тело запроса на диск блоками, не накапливая часть целиком в памяти
+        received = 0
+        buffer = bytearray()
+        out = await asyncio.to_thread(open, tmp_path, "wb")
+        try:
+            async for piece in request.stream():
+                received += len(piece)
+                if received > expected_size:
+                    raise HTTPException(status_code=413, detail="Часть больше ожидаемого размера")
+                buffer.extend(piece)
+                if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                    await asyncio.to_thread(out.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await asyncio.to_thread(out.write, bytes(buffer))
+        finally:
+            await asyncio.to_thread(out.close)
+        
+        if received != expected_size:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Неполная часть: получено {received} из {expected_size} байт"
+            )
+        
+        await asyncio.to_thread(os.replace, tmp_path, chunk_path)
+        tmp_path = None
+        
+        now = datetime.utcnow()
+        updated = await db.upload_sessions.find_one_and_update(
+            {"id": session_id, "status": "active"},
+            {
+                "$addToSet": {"received_chunks": index},
+                "$set": {"updated_at": now, "expires_at": upload_session_expires_at(now)}
+            },
+            projection={"received_chunks": 1, "total_chunks": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated is None:
+            raise HTTPException(status_code=409, detail="Сессия загрузки больше не активна")
+        
+        return {
+            "session_id": session_id,
+            "index": index,
+            "received": received,
+            "received_chunks_count": len(updated.get("received_chunks", [])),
+            "total_chunks": updated.get("total_chunks")
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error uploading chunk {index} for session {session_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при загрузке части файла: {str(e)}")
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@app_v2.post("/api/admin/upload-sessions/{session_id}/complete")
+async def complete_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Завершить сессию: склеить части и зарегистрировать файл урока"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        session = await get_upload_session_or_404(session_id)
+        if session.get("status") == "completed":
+            # Повторный вызов (например, после обрыва связи) возвращает тот же результат
+            return {
+                "message": "Файл успешно загружен",
+                "file_id": session.get("file_id"),
+                "filename": session.get("filename"),
+                "file_size": session.get("file_size"),
+                "file_type": session.get("file_type")
+            }
+        
+        missing = format_upload_session(session)["missing_chunks"]
+        if missing:
+            raise HTTPException(status_code=409, detail=f"Не получены части: {missing[:20]}")
+        
+        # Захватываем сессию, чтобы параллельный вызов complete не склеивал файл повторно;
+        # зависшую склейку (нет изменений дольше таймаута) можно захватить заново
+        now = datetime.utcnow()
+        claimed_at = now
+        session = await db.upload_sessions.find_one_and_update(
+            {"id": session_id, "$or": [
+                {"status": "active"},
+                {"status": "assembling",
+                 "updated_at": {"$lt": now - timedelta(seconds=UPLOAD_SESSION_ASSEMBLY_TIMEOUT_SECONDS)}}
+            ]},
+            {"$set": {"status": "assembling", "updated_at": claimed_at, "expires_at": upload_session_expires_at(now)}},
+            return_document=ReturnDocument.AFTER
+        )
+        if session is None:
+            raise HTTPException(status_code=409, detail="Сессия загрузки уже завершается")
+        
+        try:
+            tmp_path, file_size, checksum = await asyncio.to_thread(
+                assemble_upload_chunks, session, UPLOAD_DIR
+            )
+            if file_size != session["file_size"]:
+                await asyncio.to_thread(os.remove, tmp_path)
+                raise HTTPException(status_code=400, detail="Размер собранного файла не совпадает с заявленным")
+            
+            file_id = str(uuid.uuid4())
+            await register_uploaded_file(
+                tmp_path=tmp_path,
+                checksum=checksum,
+                file_size=file_size,
+                file_id=file_id,
+                lesson_id=session["lesson_id"],
+                section=session["section"],
+                file_type=session["file_type"],
+                original_name=session["filename"],
+                mime_type=session.get("mime_type"),
+                extension=session.get("extension", ""),
+                uploaded_by=session.get("created_by", "unknown")
+            )
+        except BaseException:
+            # Возвращаем сессию, только если ее не захватил заново другой вызов complete
+            now = datetime.utcnow()
+            await db.upload_sessions.update_one(
+                {"id": session_id, "status": "assembling", "updated_at": claimed_at},
+                {"$set": {"status": "active", "updated_at": now, "expires_at": upload_session_expires_at(now)}}
+            )
+            raise
+        
+        # Завершенная сессия хранится до expires_at - повторный complete вернет тот же файл
+        now = datetime.utcnow()
+        result = await db.upload_sessions.update_one(
+            {"id": session_id, "status": "assembling", "updated_at": claimed_at},
+            {"$set": {"status": "completed", "file_id": file_id, "updated_at": now, "expires_at": upload_session_expires_at(now)}}
+        )
+        if result.matched_count:
+            await asyncio.to_thread(shutil.rmtree, get_upload_session_dir(session_id), True)
+        else:
+            # Части теперь читает вызов, захвативший сессию заново, - их не удаляем
+            logger.warning(f"Upload session {session_id} was reclaimed while assembling; file {file_id} registered anyway")
+        
+        logger.info(f"Upload session completed: {session_id} -> file {file_id} ({file_size} bytes)")
+        
+        return {
+            "message": "Файл успешно загружен",
+            "file_id": file_id,
+            "filename": session["filename"],
+            "file_size": file_size,
+            "file_type": session["file_type"]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error completing upload session {session_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при завершении загрузки: {str(e)}")
+
+
+@app_v2.delete("/api/admin/upload-sessions/{session_id}")
+async def abort_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Отменить сессию загрузки и удалить полученные части"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        result = await db.upload_sessions.update_one(
+            {"id": session_id, "status": "active"},
+            {"$set": {"status": "aborted", "updated_at": datetime.utcnow()}}
+        )
+        if result.matched_count == 0:
+            await get_upload_session_or_404(session_id)
+            raise HTTPException(status_code=409, detail="Сессию загрузки нельзя отменить")
+        
+        await asyncio.to_thread(shutil.rmtree, get_upload_session_dir(session_id), True)
+        
+        logger.info(f"Upload session aborted: {session_id}")
+        
+        return {"message": "Загрузка отменена", "session_id": session_id}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error aborting upload session {session_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при отмене загрузки: {str(e)}")
+
+
+async def sweep_expired_upload_sessions() -> dict:
+    """Удалить просроченные сессии загрузки с их частями, а также каталоги частей без сессии
+    (документ уже удален TTL-индексом или сессия не была создана), не изменявшиеся дольше TTL"""
+    now = datetime.utcnow()
+    expired_before = now - timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)
+    sessions = 0
+    async for session in db.upload_sessions.find(
+        {"$or": [
+            {"expires_at": {"$lt": now}},
+            # Сессии, созданные до появления expires_at
+            {"expires_at": None, "updated_at": {"$lt": expired_before}}
+        ]},
+        {"_id": 0, "id": 1, "updated_at": 1}
+    ):
+        # Удаляем, только если сессию не продлили параллельно
+        result = await db.upload_sessions.delete_one({"id": session["id"], "updated_at": session.get("updated_at")})
+        if result.deleted_count:
+            await asyncio.to_thread(shutil.rmtree, get_upload_session_dir(session["id"]), True)
+            sessions += 1
+    
+    def list_stale_dirs():
+        if not os.path.isdir(UPLOAD_PARTIAL_DIR):
+            return []
+        stale = []
+        for entry in os.scandir(UPLOAD_PARTIAL_DIR):
+            if entry.is_dir() and datetime.utcfromtimestamp(entry.stat().st_mtime) < expired_before:
+                stale.append(entry.name)
+        return stale
+    
+    stale_dirs = await asyncio.to_thread(list_stale_dirs)
+    if stale_dirs:
+        known = set(await db.upload_sessions.distinct("id", {"id": {"$in": stale_dirs}}))
+        stale_dirs = [name for name in stale_dirs if name not in known]
+        for name in stale_dirs:
+            await asyncio.to_thread(shutil.rmtree, get_upload_session_dir(name), True)
+    
+    if sessions or stale_dirs:
+        logger.info(f"Upload sessions swept: {sessions} expired sessions, {len(stale_dirs)} orphaned directories")
+    return {"sessions": sessions, "directories": len(stale_dirs)}
+
+
+async def run_upload_session_sweeper():
+    """Фоновая задача: очистка просроченных сессий загрузки при запуске и затем раз в час"""
+    while True:
+        try:
+            await sweep_expired_upload_sessions()
+        except Exception as e:
+            logger.error(f"Error sweeping upload sessions: {str(e)}")
+        await asyncio.sleep(UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS)
+
+
 @app_v2.get("/api/admin/files")
 async def get_files(
     lesson_id: str = None,
@@ -2198,14 +4517,13 @@ async def delete_file(
         if not file_metadata:
             raise HTTPException(status_code=404, detail="Файл не найден")
         
-        # Удаляем физический файл
-        file_path = file_metadata.get("file_path")
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Physical file deleted: {file_path}")
+        # Удаляем метаданные из БД; повторный запрос на удаление не должен второй раз уменьшать счетчик ссылок
+        result = await db.files.delete_one({"id": file_id})
+        invalidate_file_doc_cache(file_id)
         
-        # Удаляем метаданные из БД
-        await db.files.delete_one({"id": file_id})
+        # Удаляем физический файл (общий blob - только когда на него не осталось ссылок)
+        if result.deleted_count:
+            await remove_stored_file(file_metadata)
         
         logger.info(f"File deleted: {file_id}")
         
@@ -2228,8 +4546,8 @@ async def get_lesson_files_for_student(
 ):
     """Получить список файлов урока для студента"""
     try:
-        lesson = await db.lessons_v2.find_one({"id": lesson_id, "is_active": True})
-        if not lesson:
+        lesson = await get_cached_lesson(lesson_id)
+        if not lesson or not lesson.get("is_active"):
             raise HTTPException(status_code=404, detail="Урок не найден или недоступен")
 
         files_cursor = db.files.find({"lesson_id": lesson_id}).sort("uploaded_at", 1)
@@ -2266,41 +4584,337 @@ async def get_lesson_files_for_student(
 
 # ===== ENDPOINTS ДЛЯ АНАЛИТИКИ ФАЙЛОВ =====
 
+# ===== БУФЕР СОБЫТИЙ АНАЛИТИКИ ФАЙЛОВ =====
+# Просмотры и скачивания приходят тысячами в минуту. События копятся в памяти процесса
+# и записываются пачкой insert_many(ordered=False): при достижении FILE_ANALYTICS_FLUSH_SIZE
+# или раз в FILE_ANALYTICS_FLUSH_INTERVAL_SECONDS, а также при остановке сервера.
+# Отчеты по аналитике файлов видят новые события с задержкой не больше интервала сброса.
+
+FILE_ANALYTICS_FLUSH_SIZE = int(os.environ.get('FILE_ANALYTICS_FLUSH_SIZE', '500'))
+FILE_ANALYTICS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('FILE_ANALYTICS_FLUSH_INTERVAL_SECONDS', '2'))
+FILE_ANALYTICS_BUFFER_MAX = FILE_ANALYTICS_FLUSH_SIZE * 20  # предел при недоступной БД
+FILE_ANALYTICS_BATCH_MAX = 100  # максимум событий в одном запросе
+
+file_analytics_buffer = []
+file_analytics_flush_lock = asyncio.Lock()
+file_analytics_flush_requested = asyncio.Event()
+# Остановка фоновой записи: задача не отменяется (отмена посреди insert_many теряет пачку),
+# а завершается после текущего сброса
+file_analytics_flusher_stopping = asyncio.Event()
+file_analytics_flush_task = None
+
+
+async def get_cached_file_docs(file_ids: List[str]) -> dict:
+    """Получить метаданные нескольких файлов: из кэша, недостающие - одним запросом"""
+    now = time.monotonic()
+    result = {}
+    missing = []
+    for file_id in set(file_ids):
+        entry = file_doc_cache.get(file_id)
+        if entry and entry["expires_at"] > now:
+            result[file_id] = entry["doc"]
+        else:
+            missing.append(file_id)
+    if missing:
+        async for file_doc in db.files.find({"id": {"$in": missing}}, {"_id": 0}):
+            file_doc_cache[file_doc["id"]] = {
+                "doc": file_doc,
+                "expires_at": now + FILE_DOC_CACHE_TTL_SECONDS
+            }
+            result[file_doc["id"]] = file_doc
+    return result
+
+
+def enqueue_file_analytics(events: List[dict]):
+    """Добавить события в буфер; при достижении порога - разбудить фоновую запись"""
+    file_analytics_buffer.extend(events)
+    if len(file_analytics_buffer) >= FILE_ANALYTICS_FLUSH_SIZE:
+        file_analytics_flush_requested.set()
+
+
+async def flush_file_analytics_buffer():
+    """Записать накопленные события аналитики файлов одной пачкой"""
+    global file_analytics_buffer
+    async with file_analytics_flush_lock:
+        if not file_analytics_buffer:
+            return
+        batch, file_analytics_buffer = file_analytics_buffer, []
+        written = batch
+        try:
+            await db.file_analytics.insert_many(batch, ordered=False)
+            logger.info(f"File analytics flushed: {len(batch)} events")
+        except BulkWriteError as e:
+            # ordered=False: остальные события пачки записаны - счетчики считаем только по ним
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            written = [event for index, event in enumerate(batch) if index not in failed]
+            logger.error(f"File analytics flush partially failed: {len(failed)} of {len(batch)} events")
+        except Exception as e:
+            # БД недоступна - возвращаем события в буфер, не превышая предела
+            logger.error(f"Error flushing file analytics: {str(e)}")
+            file_analytics_buffer = (batch + file_analytics_buffer)[-FILE_ANALYTICS_BUFFER_MAX:]
+            return
+        if not written:
+            return
+        # События уже записаны: ошибка счетчиков не должна возвращать их в буфер (двойной учет),
+        # счетчики восстанавливаются перестройкой из file_analytics
+        try:
+            await apply_file_analytics_to_students(written)
+        except Exception as e:
+            logger.error(f"Error applying file analytics to student analytics: {str(e)}")
+        try:
+            await apply_file_analytics_to_file_stats(written)
+        except Exception as e:
+            logger.error(f"Error applying file analytics to file stats: {str(e)}")
+
+
+async def apply_file_analytics_to_students(batch: List[dict]):
+    """Прибавить просмотры/скачивания из записанной пачки к аналитике студентов одним bulk_write.
+    Студенты без документа аналитики пропускаются: документ будет построен из file_analytics"""
+    counts = {}
+    for event in batch:
+        user_counts = counts.setdefault(event["user_id"], {"file_views": 0, "file_downloads": 0})
+        if event.get("action") == "view":
+            user_counts["file_views"] += 1
+        elif event.get("action") == "download":
+            user_counts["file_downloads"] += 1
+    operations = [
+        UpdateOne({"user_id": user_id}, build_student_analytics_pipeline(datetime.utcnow(), user_counts))
+        for user_id, user_counts in counts.items()
+        if user_counts["file_views"] or user_counts["file_downloads"]
+    ]
+    if not operations:
+        return
+    try:
+        await db.student_analytics.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.error(f"Error applying file analytics to student analytics: {str(e)}")
+
+
+# Счетчики файлов: file_user_stats - по паре (файл, студент), file_stats - по файлу
+# (просмотры, скачивания, уникальные студенты с любым действием). Увеличиваются при каждом
+# сбросе буфера; заполняются из истории при первом запуске (перенос file_stats_v1),
+# перестройка из file_analytics - POST /api/admin/file-stats/rebuild
+
+async def apply_file_analytics_to_file_stats(batch: List[dict]):
+    """Прибавить события записанной пачки к счетчикам файлов (два bulk_write).
+    Новая пара (файл, студент) - создана upsert'ом - увеличивает unique_users файла"""
+    pairs = {}
+    for event in batch:
+        pair = pairs.setdefault((event["file_id"], event["user_id"]), {
+            "lesson_id": event.get("lesson_id"),
+            "views": 0,
+            "downloads": 0,
+            "last_action_at": event.get("created_at")
+        })
+        if event.get("action") == "view":
+            pair["views"] += 1
+        elif event.get("action") == "download":
+            pair["downloads"] += 1
+        if event.get("created_at") and (pair["last_action_at"] is None or event["created_at"] > pair["last_action_at"]):
+            pair["last_action_at"] = event["created_at"]
+    if not pairs:
+        return
+    
+    now = datetime.utcnow()
+    pair_keys = list(pairs)
+    operations = [
+        UpdateOne(
+            {"file_id": file_id, "user_id": user_id},
+            {
+                "$inc": {"views": pairs[(file_id, user_id)]["views"], "downloads": pairs[(file_id, user_id)]["downloads"]},
+                "$max": {"last_action_at": pairs[(file_id, user_id)]["last_action_at"] or now},
+                "$setOnInsert": {"lesson_id": pairs[(file_id, user_id)]["lesson_id"], "first_action_at": now}
+            },
+            upsert=True
+        )
+        for file_id, user_id in pair_keys
+    ]
+    try:
+        try:
+            result = await db.file_user_stats.bulk_write(operations, ordered=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as e:
+            # Пара создана параллельно другим процессом: повторяем как обновление существующей
+            upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+            retry = [operations[error["index"]] for error in e.details.get("writeErrors", []) if error.get("code") == 11000]
+            if len(retry) != len(e.details.get("writeErrors", [])):
+                raise
+            await db.file_user_stats.bulk_write(retry, ordered=False)
+        
+        files = {}
+        for index, (file_id, user_id) in enumerate(pair_keys):
+            pair = pairs[(file_id, user_id)]
+            file_counts = files.setdefault(file_id, {"lesson_id": pair["lesson_id"], "views": 0, "downloads": 0, "unique_users": 0})
+            file_counts["views"] += pair["views"]
+            file_counts["downloads"] += pair["downloads"]
+            if index in upserted:
+                file_counts["unique_users"] += 1
+        
+        await bulk_increment_activity_counters(db.file_stats, [
+            UpdateOne(
+                {"file_id": file_id},
+                {
+                    "$inc": {
+                        "views": counts["views"],
+                        "downloads": counts["downloads"],
+                        "unique_users": counts["unique_users"]
+                    },
+                    "$set": {"updated_at": now},
+                    "$setOnInsert": {"lesson_id": counts["lesson_id"]}
+                },
+                upsert=True
+            )
+            for file_id, counts in files.items()
+        ])
+    except Exception as e:
+        logger.error(f"Error updating file stats: {str(e)}")
+
+
+async def rebuild_file_stats() -> int:
+    """Перестроить счетчики файлов из file_analytics"""
+    pairs = await db.file_analytics.aggregate([
+        {"$group": {
+            "_id": {"file_id": "$file_id", "user_id": "$user_id"},
+            "lesson_id": {"$first": "$lesson_id"},
+            "views": {"$sum": {"$cond": [{"$eq": ["$action", "view"]}, 1, 0]}},
+            "downloads": {"$sum": {"$cond": [{"$eq": ["$action", "download"]}, 1, 0]}},
+            "first_action_at": {"$min": "$created_at"},
+            "last_action_at": {"$max": "$created_at"}
+        }}
+    ]).to_list(length=None)
+    
+    now = datetime.utcnow()
+    files = {}
+    for pair in pairs:
+        file_counts = files.setdefault(pair["_id"]["file_id"], {
+            "lesson_id": pair.get("lesson_id"),
+            "views": 0,
+            "downloads": 0,
+            "unique_users": 0
+        })
+        file_counts["views"] += pair["views"]
+        file_counts["downloads"] += pair["downloads"]
+        file_counts["unique_users"] += 1
+    
+    await db.file_user_stats.delete_many({})
+    await db.file_stats.delete_many({})
+    pair_docs = [
+        {
+            "file_id": pair["_id"]["file_id"],
+            "user_id": pair["_id"]["user_id"],
+            "lesson_id": pair.get("lesson_id"),
+            "views": pair["views"],
+            "downloads": pair["downloads"],
+            "first_action_at": pair.get("first_action_at"),
+            "last_action_at": pair.get("last_action_at")
+        }
+        for pair in pairs
+    ]
+    file_docs = [dict(counts, file_id=file_id, updated_at=now) for file_id, counts in files.items()]
+    for collection, docs in ((db.file_user_stats, pair_docs), (db.file_stats, file_docs)):
+        for start in range(0, len(docs), 1000):
+            await collection.insert_many(docs[start:start + 1000], ordered=False)
+    return len(file_docs)
+
+
+@app_v2.post("/api/admin/file-stats/rebuild")
+async def rebuild_file_stats_endpoint(
+    current_user: dict = Depends(get_current_user)
+):
+    """Перестроить счетчики файлов из file_analytics (миграция и восстановление)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        # Сначала записываем накопленные события, чтобы они вошли в перестройку
+        await flush_file_analytics_buffer()
+        async with file_analytics_flush_lock:
+            files_count = await rebuild_file_stats()
+        
+        logger.info(f"File stats rebuilt for {files_count} files")
+        
+        return {
+            "message": "Счетчики файлов перестроены",
+            "files": files_count
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rebuilding file stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при перестройке счетчиков файлов: {str(e)}")
+
+
+async def run_file_analytics_flusher():
+    """Фоновая задача: сброс буфера по таймеру или по заполнению (до остановки сервера)"""
+    while not file_analytics_flusher_stopping.is_set():
+        try:
+            await asyncio.wait_for(
+                file_analytics_flush_requested.wait(),
+                timeout=FILE_ANALYTICS_FLUSH_INTERVAL_SECONDS
+            )
+        except asyncio.TimeoutError:
+            pass
+        file_analytics_flush_requested.clear()
+        try:
+            await flush_file_analytics_buffer()
+        except Exception as e:
+            logger.error(f"File analytics flusher error: {str(e)}")
+
+
 @app_v2.post("/api/student/file-analytics")
 async def track_file_action(
-    request: FileAnalyticsRequest,
+    request: Union[FileAnalyticsRequest, List[FileAnalyticsRequest]],
     current_user: dict = Depends(get_current_user)
 ):
-    """Записать просмотр или скачивание файла"""
+    """Записать просмотр или скачивание файла (одно событие или массив событий)"""
     try:
         user_id = current_user.get('user_id', current_user.get('id'))
         
-        # Проверяем существование файла
-        file_doc = await db.files.find_one({"id": request.file_id})
-        if not file_doc:
+        is_batch = isinstance(request, list)
+        events = request if is_batch else [request]
+        if len(events) > FILE_ANALYTICS_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"Не больше {FILE_ANALYTICS_BATCH_MAX} событий за запрос")
+        
+        # Проверяем существование файлов по кэшу метаданных
+        file_docs = await get_cached_file_docs([event.file_id for event in events])
+        if not is_batch and request.file_id not in file_docs:
             raise HTTPException(status_code=404, detail="Файл не найден")
         
-        # Создаем запись аналитики
-        analytics_id = str(uuid.uuid4())
-        analytics_data = {
-            "id": analytics_id,
-            "file_id": request.file_id,
-            "user_id": user_id,
-            "lesson_id": request.lesson_id,
-            "action": request.action,  # 'view' или 'download'
-            "file_name": file_doc.get("original_name"),
-            "file_type": file_doc.get("file_type"),
-            "mime_type": file_doc.get("mime_type"),
-            "created_at": datetime.utcnow()
-        }
+        now = datetime.utcnow()
+        accepted = []
+        rejected = []
+        for event in events:
+            file_doc = file_docs.get(event.file_id)
+            if not file_doc:
+                rejected.append(event.file_id)
+                continue
+            accepted.append({
+                "id": str(uuid.uuid4()),
+                "file_id": event.file_id,
+                "user_id": user_id,
+                "lesson_id": event.lesson_id,
+                "action": event.action,  # 'view' или 'download'
+                "file_name": file_doc.get("original_name"),
+                "file_type": file_doc.get("file_type"),
+                "mime_type": file_doc.get("mime_type"),
+                "created_at": now
+            })
         
-        await db.file_analytics.insert_one(analytics_data)
+        enqueue_file_analytics(accepted)
         
-        logger.info(f"File action tracked: {request.action} - file_id: {request.file_id}, user_id: {user_id}")
+        if not is_batch:
+            return {
+                "message": "Действие записано",
+                "analytics_id": accepted[0]["id"]
+            }
         
         return {
-            "message": "Действие записано",
-            "analytics_id": analytics_id
+            "message": "Действия записаны",
+            "accepted": len(accepted),
+            "analytics_ids": [event["id"] for event in accepted],
+            "rejected_file_ids": rejected
         }
     except HTTPException:
         raise
@@ -2311,81 +4925,124 @@ async def track_file_action(
 
 @app_v2.post("/api/student/video-watch-time")
 async def track_video_watch_time(
-    request: VideoWatchTimeRequest,
+    request: Union[VideoWatchTimeRequest, List[VideoWatchTimeRequest]],
     current_user: dict = Depends(get_current_user)
 ):
-    """Отслеживать время просмотра видео и начислять баллы (10 баллов за минуту)"""
+    """Отслеживать время просмотра видео и начислять баллы (10 баллов за минуту).
+    Принимает одну запись или массив записей (по нескольким видео)"""
     try:
         user_id = current_user.get('user_id', current_user.get('id'))
+        now = datetime.utcnow()
         
-        # Проверяем существование файла
-        file_doc = await db.files.find_one({"id": request.file_id})
-        if not file_doc:
-            raise HTTPException(status_code=404, detail="Файл не найден")
-        
-        # Проверяем, что это видео
-        mime_type = file_doc.get("mime_type", "")
-        if not mime_type.startswith("video/"):
-            raise HTTPException(status_code=400, detail="Файл не является видео")
-        
-        # Вычисляем баллы (10 баллов за минуту)
-        points_earned = request.minutes_watched * 10
-        
-        # Обновляем или создаем запись о просмотре видео
-        existing_watch = await db.video_watch_time.find_one({
-            "file_id": request.file_id,
-            "user_id": user_id
-        })
-        
-        if existing_watch:
-            # Обновляем существующую запись
-            new_total_minutes = existing_watch.get("total_minutes", 0) + request.minutes_watched
-            new_total_points = new_total_minutes * 10
+        is_batch = isinstance(request, list)
+        items = request if is_batch else [request]
+        if len(items) > ACTIVITY_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"Не больше {ACTIVITY_BATCH_MAX} записей за запрос")
+        
+        # Проверяем существование файлов и что это видео
+        file_docs = await get_cached_file_docs([item.file_id for item in items])
+        for item in items:
+            file_doc = file_docs.get(item.file_id)
+            if not file_doc:
+                raise HTTPException(status_code=404, detail="Файл не найден")
+            if not (file_doc.get("mime_type") or "").startswith("video/"):
+                raise HTTPException(status_code=400, detail="Файл не является видео")
+        
+        if not is_batch:
+            file_doc = file_docs[request.file_id]
             
-            await db.video_watch_time.update_one(
+            # Вычисляем баллы (10 баллов за минуту)
+            points_earned = request.minutes_watched * 10
+            
+            previous = await increment_activity_counter(
+                db.video_watch_time,
                 {"file_id": request.file_id, "user_id": user_id},
+                {"total_minutes": request.minutes_watched, "total_points": points_earned, "ledger_points": points_earned},
+                {"last_updated": now},
                 {
-                    "$set": {
-                        "total_minutes": new_total_minutes,
-                        "total_points": new_total_points,
-                        "last_updated": datetime.utcnow()
-                    }
+                    "id": str(uuid.uuid4()),
+                    "lesson_id": request.lesson_id,
+                    "file_name": file_doc.get("original_name"),
+                    "created_at": now
                 }
             )
             
-            logger.info(f"Video watch time updated: file_id: {request.file_id}, user_id: {user_id}, total_minutes: {new_total_minutes}, total_points: {new_total_points}")
+            new_total_minutes = (previous or {}).get("total_minutes", 0) + request.minutes_watched
+            new_total_points = (previous or {}).get("total_points", 0) + points_earned
+            await asyncio.gather(
+                record_student_activity(user_id, {"total_video_minutes": request.minutes_watched}),
+                award_points(user_id, request.lesson_id, "videos", points_earned, request.file_id)
+            )
+            
+            logger.info(f"Video watch time tracked: file_id: {request.file_id}, user_id: {user_id}, total_minutes: {new_total_minutes}, total_points: {new_total_points}")
             
             return {
-                "message": "Время просмотра обновлено",
+                "message": "Время просмотра обновлено" if previous else "Время просмотра записано",
                 "total_minutes": new_total_minutes,
                 "total_points": new_total_points,
                 "points_earned": points_earned
             }
-        else:
-            # Создаем новую запись
-            watch_id = str(uuid.uuid4())
-            watch_data = {
-                "id": watch_id,
-                "file_id": request.file_id,
-                "user_id": user_id,
-                "lesson_id": request.lesson_id,
-                "file_name": file_doc.get("original_name"),
-                "total_minutes": request.minutes_watched,
-                "total_points": points_earned,
-                "created_at": datetime.utcnow(),
-                "last_updated": datetime.utcnow()
-            }
-            
-            await db.video_watch_time.insert_one(watch_data)
-            
-            logger.info(f"Video watch time created: file_id: {request.file_id}, user_id: {user_id}, minutes: {request.minutes_watched}, points: {points_earned}")
-            
-            return {
-                "message": "Время просмотра записано",
-                "total_minutes": request.minutes_watched,
-                "total_points": points_earned,
-                "points_earned": points_earned
-            }
+        
+        # Складываем минуты по видео, чтобы на каждое видео был один инкремент
+        watched = {}
+        for item in items:
+            entry = watched.setdefault(item.file_id, {"lesson_id": item.lesson_id, "minutes": 0})
+            entry["minutes"] += item.minutes_watched
+        
+        if watched:
+            await bulk_increment_activity_counters(db.video_watch_time, [
+                UpdateOne(
+                    {"file_id": file_id, "user_id": user_id},
+                    {
+                        "$inc": {
+                            "total_minutes": entry["minutes"],
+                            "total_points": entry["minutes"] * 10,
+                            "ledger_points": entry["minutes"] * 10
+                        },
+                        "$set": {"last_updated": now},
+                        "$setOnInsert": {
+                            "id": str(uuid.uuid4()),
+                            "lesson_id": entry["lesson_id"],
+                            "file_name": file_docs[file_id].get("original_name"),
+                            "created_at": now
+                        }
+                    },
+                    upsert=True
+                )
+                for file_id, entry in watched.items()
+            ])
+        
+        watched_minutes = sum(entry["minutes"] for entry in watched.values())
+        await asyncio.gather(
+            record_student_activity(user_id, {"total_video_minutes": watched_minutes}),
+            award_points_many([
+                {"user_id": user_id, "lesson_id": entry["lesson_id"], "source": "videos", "points": entry["minutes"] * 10, "ref_id": file_id}
+                for file_id, entry in watched.items()
+            ])
+        )
+        
+        totals = {}
+        async for watch in db.video_watch_time.find(
+            {"user_id": user_id, "file_id": {"$in": list(watched.keys())}},
+            {"_id": 0, "file_id": 1, "total_minutes": 1, "total_points": 1}
+        ):
+            totals[watch["file_id"]] = watch
+        
+        logger.info(f"Video watch time batch tracked: user_id: {user_id}, files: {len(watched)}")
+        
+        return {
+            "message": "Время просмотра обновлено",
+            "points_earned": watched_minutes * 10,
+            "files": [
+                {
+                    "file_id": file_id,
+                    "total_minutes": totals.get(file_id, {}).get("total_minutes", 0),
+                    "total_points": totals.get(file_id, {}).get("total_points", 0),
+                    "points_earned": entry["minutes"] * 10
+                }
+                for file_id, entry in watched.items()
+            ]
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -2419,18 +5076,17 @@ async def get_file_analytics(
         unique_viewers = len(set(a.get("user_id") for a in analytics if a.get("action") == "view"))
         unique_downloaders = len(set(a.get("user_id") for a in analytics if a.get("action") == "download"))
         
-        # Получаем информацию о пользователях
+        # Имена пользователей - одним запросом (user_id = username)
+        users_map = await resolve_user_names(a.get("user_id") for a in analytics)
+        
         user_actions = {}
         for action in analytics:
             user_id = action.get("user_id")
             if user_id not in user_actions:
-                # Получаем имя пользователя
-                user_doc = await db.users.find_one({"_id": user_id})
-                username = user_doc.get("username", "Неизвестный") if user_doc else "Неизвестный"
-                
                 user_actions[user_id] = {
                     "user_id": user_id,
-                    "username": username,
+                    "username": user_id if user_id in users_map else "Неизвестный",
+                    "user_name": users_map.get(user_id, "Неизвестный"),
                     "views": 0,
                     "downloads": 0,
                     "last_action": None
@@ -2491,23 +5147,28 @@ async def get_student_files_stats(
     try:
         user_id = current_user.get('user_id')
         
-        # Получаем все файлы урока
-        files_cursor = db.files.find({"lesson_id": lesson_id})
-        files = await files_cursor.to_list(length=None)
-        
-        # Получаем аналитику студента по файлам
-        analytics_cursor = db.file_analytics.find({
-            "lesson_id": lesson_id,
-            "user_id": user_id
-        })
-        analytics = await analytics_cursor.to_list(length=None)
-        
-        # Получаем статистику просмотра видео
-        video_stats_cursor = db.video_watch_time.find({
-            "lesson_id": lesson_id,
-            "user_id": user_id
-        })
-        video_stats = await video_stats_cursor.to_list(length=None)
+        # Файлы урока, счетчики действий студента по файлам (группировка по file_id,
+        # покрывается индексом) и время просмотра видео - параллельно
+        files, action_groups, video_stats = await asyncio.gather(
+            db.files.find(
+                {"lesson_id": lesson_id},
+                {"_id": 0, "id": 1, "original_name": 1, "file_type": 1, "section": 1, "mime_type": 1}
+            ).to_list(length=None),
+            db.file_analytics.aggregate([
+                {"$match": {"user_id": user_id, "lesson_id": lesson_id}},
+                {"$group": {
+                    "_id": "$file_id",
+                    "views": {"$sum": {"$cond": [{"$eq": ["$action", "view"]}, 1, 0]}},
+                    "downloads": {"$sum": {"$cond": [{"$eq": ["$action", "download"]}, 1, 0]}}
+                }}
+            ]).to_list(length=None),
+            db.video_watch_time.find(
+                {"lesson_id": lesson_id, "user_id": user_id},
+                {"_id": 0, "file_id": 1, "total_minutes": 1, "total_points": 1}
+            ).to_list(length=None)
+        )
+        actions_by_file = {group["_id"]: group for group in action_groups}
+        video_by_file = {video.get("file_id"): video for video in video_stats}
         
         # Группируем по файлам
         files_data = []
@@ -2520,16 +5181,17 @@ async def get_student_files_stats(
             file_id = file_doc.get("id")
             
             # Подсчет просмотров и скачиваний
-            file_views = sum(1 for a in analytics if a.get("file_id") == file_id and a.get("action") == "view")
-            file_downloads = sum(1 for a in analytics if a.get("file_id") == file_id and a.get("action") == "download")
+            actions = actions_by_file.get(file_id, {})
+            file_views = actions.get("views", 0)
+            file_downloads = actions.get("downloads", 0)
             
             total_views += file_views
             total_downloads += file_downloads
             
             # Статистика видео
             video_data = None
-            if file_doc.get("mime_type", "").startswith("video/"):
-                video_stat = next((v for v in video_stats if v.get("file_id") == file_id), None)
+            if (file_doc.get("mime_type") or "").startswith("video/"):
+                video_stat = video_by_file.get(file_id)
                 if video_stat:
                     minutes = video_stat.get("total_minutes", 0)
                     points = video_stat.get("total_points", 0)
@@ -2577,36 +5239,49 @@ async def get_lesson_files_analytics(
         if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
             raise HTTPException(status_code=403, detail="Недостаточно прав")
         
-        # Получаем все файлы урока
-        files_cursor = db.files.find({"lesson_id": lesson_id})
-        files = await files_cursor.to_list(length=None)
+        # Получаем все файлы урока (без лишних полей)
+        files = await db.files.find(
+            {"lesson_id": lesson_id},
+            {"_id": 0, "id": 1, "original_name": 1, "file_type": 1, "section": 1, "mime_type": 1}
+        ).to_list(length=None)
+        file_ids = [file_doc.get("id") for file_doc in files]
+        video_file_ids = [
+            file_doc.get("id") for file_doc in files
+            if (file_doc.get("mime_type") or "").startswith("video/")
+        ]
         
-        files_analytics = []
+        # Счетчики файлов (один запрос) и статистика видео (одна группировка)
+        stats_docs, video_groups = await asyncio.gather(
+            db.file_stats.find(
+                {"file_id": {"$in": file_ids}},
+                {"_id": 0, "file_id": 1, "views": 1, "downloads": 1, "unique_users": 1}
+            ).to_list(length=None),
+            db.video_watch_time.aggregate([
+                {"$match": {"file_id": {"$in": video_file_ids}}},
+                {"$group": {
+                    "_id": "$file_id",
+                    "total_watch_minutes": {"$sum": "$total_minutes"},
+                    "total_points_earned": {"$sum": "$total_points"},
+                    "unique_watchers": {"$sum": 1}
+                }}
+            ]).to_list(length=None) if video_file_ids else []
+        )
+        stats_by_file = {doc["file_id"]: doc for doc in stats_docs}
+        video_by_file = {group["_id"]: group for group in video_groups}
         
+        files_analytics = []
         for file_doc in files:
             file_id = file_doc.get("id")
-            
-            # Получаем аналитику по файлу
-            analytics_cursor = db.file_analytics.find({"file_id": file_id})
-            analytics = await analytics_cursor.to_list(length=None)
-            
-            total_views = sum(1 for a in analytics if a.get("action") == "view")
-            total_downloads = sum(1 for a in analytics if a.get("action") == "download")
-            unique_users = len(set(a.get("user_id") for a in analytics))
+            stats = stats_by_file.get(file_id, {})
             
             # Статистика видео (если применимо)
             video_stats = None
-            if file_doc.get("mime_type", "").startswith("video/"):
-                video_watch_cursor = db.video_watch_time.find({"file_id": file_id})
-                video_watches = await video_watch_cursor.to_list(length=None)
-                
-                total_watch_minutes = sum(v.get("total_minutes", 0) for v in video_watches)
-                total_points = sum(v.get("total_points", 0) for v in video_watches)
-                
+            if file_id in video_file_ids:
+                video = video_by_file.get(file_id, {})
                 video_stats = {
-                    "total_watch_minutes": total_watch_minutes,
-                    "total_points_earned": total_points,
-                    "unique_watchers": len(video_watches)
+                    "total_watch_minutes": video.get("total_watch_minutes", 0),
+                    "total_points_earned": video.get("total_points_earned", 0),
+                    "unique_watchers": video.get("unique_watchers", 0)
                 }
             
             files_analytics.append({
@@ -2615,9 +5290,9 @@ async def get_lesson_files_analytics(
                 "file_type": file_doc.get("file_type"),
                 "section": file_doc.get("section"),
                 "mime_type": file_doc.get("mime_type"),
-                "total_views": total_views,
-                "total_downloads": total_downloads,
-                "unique_users": unique_users,
+                "total_views": stats.get("views", 0),
+                "total_downloads": stats.get("downloads", 0),
+                "unique_users": stats.get("unique_users", 0),
                 "video_stats": video_stats
             })
         
@@ -2633,6 +5308,1029 @@ async def get_lesson_files_analytics(
         raise HTTPException(status_code=500, detail=f"Ошибка при получении аналитики урока: {str(e)}")
 
 
+# ===== БАЛЛЫ: ЖУРНАЛ НАЧИСЛЕНИЙ И БАЛАНСЫ =====
+# Каждое начисление записывается в points_ledger (только добавление) и сразу прибавляется
+# к балансам в points_balances: общему (lesson_id = null) и по уроку. Уровень студента
+# вычисляется при записи. Рейтинги и итоги читаются по индексу {lesson_id: 1, balance: -1}.
+# Журнал и балансы можно перестроить из исходных коллекций (POST /api/admin/points/rebuild).
+# Запись журнала и обновление балансов - независимые операции (MongoDB без реплики не
+# поддерживает транзакции): запись создается уже помеченной applied (applied_points - сколько
+# из points прибавлено к балансам), а если балансы не обновились, пометка снимается. Фоновая
+# задача прибавляет к балансам не примененный остаток таких записей через $inc, забирая каждую
+# запись условным обновлением - балансы никогда не перестраиваются поверх живых начислений.
+
+POINTS_SOURCES = ["challenges", "quizzes", "time", "videos"]
+# Частые начисления (heartbeat времени и просмотра) копятся в одной записи журнала
+# на (студент, урок, источник, день) - журнал не растет на каждый heartbeat
+COALESCED_POINTS_SOURCES = ("time", "videos")
+POINTS_RECONCILE_INTERVAL_SECONDS = 60
+POINTS_RECONCILE_BATCH = 500
+points_reconcile_task = None
+
+# Пороги уровней: (минимум баллов, уровень, название, баллы следующего уровня)
+STUDENT_LEVELS = [
+    (1000, 5, "Мастер", 2000),
+    (500, 4, "Эксперт", 1000),
+    (250, 3, "Продвинутый", 500),
+    (100, 2, "Ученик", 250),
+    (0, 1, "Новичок", 100),
+]
+
+
+def get_student_level(points: float) -> dict:
+    """Уровень студента по количеству баллов"""
+    for threshold, level, level_name, next_level_points in STUDENT_LEVELS:
+        if points >= threshold:
+            break
+    return {"level": level, "level_name": level_name, "next_level_points": next_level_points}
+
+
+def build_level_fields(balance_expr) -> dict:
+    """Выражения уровня для конвейера MongoDB (те же пороги, что в get_student_level)"""
+    def switch(index):
+        return {"$switch": {
+            "branches": [
+                {"case": {"$gte": [balance_expr, entry[0]]}, "then": entry[index]}
+                for entry in STUDENT_LEVELS[:-1]
+            ],
+            "default": STUDENT_LEVELS[-1][index]
+        }}
+    return {"level": switch(1), "level_name": switch(2), "next_level_points": switch(3)}
+
+
+def get_points_balance_id(user_id: str, lesson_id: Optional[str]) -> str:
+    return f"{user_id}:{lesson_id or 'all'}"
+
+
+def build_points_balance_pipeline(user_id: str, lesson_id: Optional[str], points_by_source: dict, now: datetime) -> list:
+    """Конвейер upsert баланса: прибавить баллы по источникам и пересчитать уровень"""
+    apply_stage = {
+        "id": {"$ifNull": ["$id", get_points_balance_id(user_id, lesson_id)]},
+        "balance": {"$add": [{"$ifNull": ["$balance", 0]}, sum(points_by_source.values())]},
+        "created_at": {"$ifNull": ["$created_at", now]},
+        "updated_at": now
+    }
+    for source, points in points_by_source.items():
+        apply_stage[f"by_source.{source}"] = {"$add": [{"$ifNull": [f"$by_source.{source}", 0]}, points]}
+    return [{"$set": apply_stage}, {"$set": build_level_fields("$balance")}]
+
+
+async def apply_points_to_balances(awards: List[dict], now: datetime):
+    """Прибавить начисления к балансам (общему и по уроку) атомарными upsert-конвейерами"""
+    balances = {}
+    for award in awards:
+        for lesson_key in (None, award.get("lesson_id")):
+            by_source = balances.setdefault((award["user_id"], lesson_key), {})
+            by_source[award["source"]] = by_source.get(award["source"], 0) + award["points"]
+    
+    await bulk_increment_activity_counters(db.points_balances, [
+        UpdateOne(
+            {"user_id": user_id, "lesson_id": lesson_id},
+            build_points_balance_pipeline(user_id, lesson_id, by_source, now),
+            upsert=True
+        )
+        for (user_id, lesson_id), by_source in balances.items()
+    ])
+
+
+def get_coalesced_ledger_id(user_id: str, lesson_id: Optional[str], source: str, day: datetime) -> str:
+    return f"{source}:{user_id}:{lesson_id or 'all'}:{day.strftime('%Y-%m-%d')}"
+
+
+async def award_points_many(awards: List[dict]):
+    """Записать начисления в журнал и прибавить их к балансам (общему и по уроку).
+    Начисление: {"user_id", "lesson_id", "source", "points", "ref_id"}; points может быть
+    отрицательным (корректировка). Начисления COALESCED_POINTS_SOURCES прибавляются к дневной
+    записи журнала (upsert $inc), остальные добавляются отдельными записями. Ошибки не прерывают
+    основную операцию - записи, балансы которых не обновились, помечаются не примененными и их
+    доводит reconcile_unapplied_points"""
+    awards = [award for award in awards if award.get("points")]
+    if not awards:
+        return
+    try:
+        now = datetime.utcnow()
+        day = get_day_start(now)
+        entries = []
+        coalesced = {}
+        for award in awards:
+            if award["source"] in COALESCED_POINTS_SOURCES:
+                entry_id = get_coalesced_ledger_id(award["user_id"], award.get("lesson_id"), award["source"], day)
+                entry = coalesced.setdefault(entry_id, dict(award, points=0))
+                entry["points"] += award["points"]
+                continue
+            entries.append({
+                "id": str(uuid.uuid4()),
+                "user_id": award["user_id"],
+                "lesson_id": award.get("lesson_id"),
+                "source": award["source"],
+                "points": award["points"],
+                "ref_id": award.get("ref_id"),
+                "created_at": now,
+                "applied": True,
+                "applied_points": award["points"]
+            })
+        
+        if entries:
+            await db.points_ledger.insert_many(entries, ordered=False)
+        if coalesced:
+            # Остаток дневной записи, не дошедший до балансов, не меняется: points и applied_points растут вместе
+            await bulk_increment_activity_counters(db.points_ledger, [
+                UpdateOne(
+                    {"id": entry_id},
+                    {
+                        "$inc": {"points": entry["points"], "applied_points": entry["points"]},
+                        "$set": {"updated_at": now},
+                        "$setOnInsert": {
+                            "user_id": entry["user_id"],
+                            "lesson_id": entry.get("lesson_id"),
+                            "source": entry["source"],
+                            "ref_id": entry.get("lesson_id"),
+                            "date": day,
+                            "created_at": now,
+                            "applied": True
+                        }
+                    },
+                    upsert=True
+                )
+                for entry_id, entry in coalesced.items()
+            ])
+        
+        try:
+            await apply_points_to_balances(awards, now)
+        except Exception:
+            operations = [
+                UpdateOne({"id": entry["id"]}, {"$set": {"applied": False, "applied_points": 0}})
+                for entry in entries
+            ] + [
+                UpdateOne({"id": entry_id}, {"$set": {"applied": False}, "$inc": {"applied_points": -entry["points"]}})
+                for entry_id, entry in coalesced.items()
+            ]
+            await db.points_ledger.bulk_write(operations, ordered=False)
+            raise
+    except Exception as e:
+        logger.error(f"Error awarding points: {str(e)}")
+
+
+async def award_points(user_id: str, lesson_id: Optional[str], source: str, points: float, ref_id: Optional[str] = None):
+    """Начислить баллы студенту (одно начисление)"""
+    await award_points_many([{
+        "user_id": user_id,
+        "lesson_id": lesson_id,
+        "source": source,
+        "points": points,
+        "ref_id": ref_id
+    }])
+
+
+async def get_points_balance(user_id: str) -> dict:
+    """Общий баланс студента (с уровнем); для студента без начислений - нулевой"""
+    balance = await db.points_balances.find_one({"user_id": user_id, "lesson_id": None}, {"_id": 0})
+    if balance is None:
+        balance = dict({"user_id": user_id, "lesson_id": None, "balance": 0, "by_source": {}}, **get_student_level(0))
+    return balance
+
+
+async def rebuild_points_balances(user_ids: Optional[List[str]] = None):
+    """Перестроить балансы из журнала начислений (для указанных студентов или для всех).
+    Обслуживание после перестройки журнала: каждый баланс заменяется целиком, а балансы без
+    записей в журнале удаляются; начисления, пришедшие во время перестройки, могут потеряться"""
+    match = {"user_id": {"$in": list(user_ids)}} if user_ids is not None else {}
+    now = datetime.utcnow()
+    
+    async def group_balances(lesson_key):
+        return await db.points_ledger.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": {"user_id": "$user_id", "lesson_id": lesson_key, "source": "$source"},
+                # Не примененный остаток записи еще не в балансах - его доведет reconcile_unapplied_points
+                "points": {"$sum": {"$ifNull": ["$applied_points", "$points"]}}
+            }},
+            {"$group": {
+                "_id": {"user_id": "$_id.user_id", "lesson_id": "$_id.lesson_id"},
+                "balance": {"$sum": "$points"},
+                "by_source": {"$push": {"k": "$_id.source", "v": "$points"}}
+            }},
+            {"$project": {
+                "_id": 0,
+                "user_id": "$_id.user_id",
+                "lesson_id": "$_id.lesson_id",
+                "balance": 1,
+                "by_source": {"$arrayToObject": "$by_source"}
+            }},
+            {"$set": build_level_fields("$balance")}
+        ]).to_list(length=None)
+    
+    per_lesson, overall = await asyncio.gather(group_balances("$lesson_id"), group_balances(None))
+    
+    balances = [balance for balance in per_lesson + overall if balance.get("user_id")]
+    operations = [
+        ReplaceOne(
+            {"user_id": balance["user_id"], "lesson_id": balance.get("lesson_id")},
+            dict(
+                balance,
+                id=get_points_balance_id(balance["user_id"], balance.get("lesson_id")),
+                created_at=now,
+                updated_at=now
+            ),
+            upsert=True
+        )
+        for balance in balances
+    ]
+    for start in range(0, len(operations), 1000):
+        await db.points_balances.bulk_write(operations[start:start + 1000], ordered=False)
+    
+    # Балансы, для которых в журнале не осталось записей
+    await db.points_balances.delete_many(dict(
+        match,
+        id={"$nin": [get_points_balance_id(balance["user_id"], balance.get("lesson_id")) for balance in balances]}
+    ))
+    return len(operations)
+
+
+async def reconcile_unapplied_points() -> int:
+    """Довести до балансов записи журнала, не помеченные applied (балансы не обновились при
+    начислении). Каждая запись забирается одним условным обновлением (applied и
+    applied_points = points), и только остаток, который она вернула, прибавляется к балансам
+    через $inc - параллельные обработчики и живые начисления не учитываются дважды.
+    Возвращает число примененных записей"""
+    entry_ids = await db.points_ledger.find(
+        {"applied": False}, {"_id": 0, "id": 1}
+    ).sort("created_at", 1).limit(POINTS_RECONCILE_BATCH).to_list(length=POINTS_RECONCILE_BATCH)
+    
+    applied = 0
+    for entry_id in entry_ids:
+        entry = await db.points_ledger.find_one_and_update(
+            {"id": entry_id["id"], "applied": False},
+            [{"$set": {"applied": True, "applied_points": "$points"}}],
+            projection={"_id": 0, "id": 1, "user_id": 1, "lesson_id": 1, "source": 1, "points": 1, "applied_points": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        delta = (entry or {}).get("points", 0) - (entry or {}).get("applied_points", 0)
+        if not delta:
+            continue
+        try:
+            await apply_points_to_balances([dict(entry, points=delta)], datetime.utcnow())
+        except Exception:
+            await db.points_ledger.update_one(
+                {"id": entry["id"]},
+                {"$set": {"applied": False}, "$inc": {"applied_points": -delta}}
+            )
+            raise
+        applied += 1
+    
+    if applied:
+        logger.warning(f"Points reconciled: {applied} unapplied ledger entries")
+    return applied
+
+
+async def run_points_reconciler():
+    """Фоновая задача: применение зависших начислений при запуске и затем раз в минуту"""
+    while True:
+        try:
+            await reconcile_unapplied_points()
+        except Exception as e:
+            logger.error(f"Error reconciling points: {str(e)}")
+        await asyncio.sleep(POINTS_RECONCILE_INTERVAL_SECONDS)
+
+
+def build_points_ledger_pipeline(now: datetime, unledgered_only: bool) -> list:
+    """Записи журнала из исходных коллекций (по одной на исходный документ, id - источник:id
+    документа). unledgered_only - только баллы, еще не проведенные через журнал живыми
+    начислениями (поле ledger_points исходного документа)"""
+    def source_pipeline(source, points_field, ref_field, date_field):
+        points = f"${points_field}"
+        if unledgered_only:
+            points = {"$subtract": [points, {"$ifNull": ["$ledger_points", 0]}]}
+        entry = {
+            "_id": 0,
+            "id": {"$concat": [source, ":", {"$toString": {"$ifNull": ["$id", "$_id"]}}]},
+            "user_id": 1,
+            "lesson_id": 1,
+            "source": {"$literal": source},
+            "points": points,
+            "ref_id": f"${ref_field}",
+            "created_at": {"$ifNull": [f"${date_field}", now]},
+            "backfill": {"$literal": True}
+        }
+        if unledgered_only:
+            # Перенесенные записи доводятся до балансов через $inc, как не примененные
+            entry["applied"] = {"$literal": False}
+            entry["applied_points"] = {"$literal": 0}
+        return [
+            {"$match": {points_field: {"$type": "number"}}},
+            {"$project": entry},
+            {"$match": {"points": {"$ne": 0}}}
+        ]
+    
+    return source_pipeline("challenges", "points_earned", "id", "started_at") + [
+        {"$unionWith": {"coll": "quiz_attempts", "pipeline": source_pipeline("quizzes", "points_earned", "id", "attempted_at")}},
+        {"$unionWith": {"coll": "time_activity", "pipeline": source_pipeline("time", "total_points", "lesson_id", "started_at")}},
+        {"$unionWith": {"coll": "video_watch_time", "pipeline": source_pipeline("videos", "total_points", "file_id", "created_at")}}
+    ]
+
+
+async def rebuild_points_ledger():
+    """Перестроить журнал начислений из исходных коллекций целиком (обслуживание: начисления,
+    пришедшие во время перестройки, могут потеряться)"""
+    # $out заменяет журнал целиком, сохраняя его индексы
+    await db.challenge_progress.aggregate(
+        build_points_ledger_pipeline(datetime.utcnow(), unledgered_only=False) + [{"$out": "points_ledger"}]
+    ).to_list(length=None)
+
+
+async def backfill_points_ledger() -> int:
+    """Перенести в журнал баллы исходных коллекций, не проведенные живыми начислениями, и
+    прибавить их к балансам через $inc. Безопасно при параллельных начислениях: живые
+    начисления увеличивают ledger_points исходного документа тем же обновлением, что и его
+    баллы, поэтому перенос берет только остаток; записи добавляются $merge без замены
+    существующих (повторный запуск ничего не дублирует). Возвращает число примененных записей"""
+    await db.challenge_progress.aggregate(
+        build_points_ledger_pipeline(datetime.utcnow(), unledgered_only=True) + [
+            {"$merge": {"into": "points_ledger", "on": "id", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ]
+    ).to_list(length=None)
+    
+    # Перенесенные записи забираются пачками по метке (как в reconcile_unapplied_points -
+    # условием applied: false, поэтому параллельный обработчик не применит их второй раз)
+    applied = 0
+    while True:
+        pending = await db.points_ledger.find(
+            {"backfill": True, "applied": False, "applied_points": 0}, {"_id": 0, "id": 1}
+        ).limit(1000).to_list(length=1000)
+        if not pending:
+            return applied
+        claim_id = str(uuid.uuid4())
+        await db.points_ledger.update_many(
+            {"id": {"$in": [entry["id"] for entry in pending]}, "applied": False, "applied_points": 0},
+            [{"$set": {"applied": True, "applied_points": "$points", "claim_id": claim_id}}]
+        )
+        entries = await db.points_ledger.find(
+            {"claim_id": claim_id},
+            {"_id": 0, "id": 1, "user_id": 1, "lesson_id": 1, "source": 1, "points": 1}
+        ).to_list(length=None)
+        try:
+            await apply_points_to_balances(entries, datetime.utcnow())
+        except Exception:
+            await db.points_ledger.update_many(
+                {"claim_id": claim_id},
+                {"$set": {"applied": False, "applied_points": 0}}
+            )
+            raise
+        applied += len(entries)
+
+
+@app_v2.post("/api/admin/points/rebuild")
+async def rebuild_points_endpoint(
+    current_user: dict = Depends(get_current_user)
+):
+    """Перестроить журнал начислений и балансы из исходных коллекций (миграция и восстановление)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        await rebuild_points_ledger()
+        balances_count = await rebuild_points_balances()
+        ledger_count = await db.points_ledger.count_documents({})
+        
+        logger.info(f"Points rebuilt: {ledger_count} ledger entries, {balances_count} balances")
+        
+        return {
+            "message": "Баллы перестроены",
+            "ledger_entries": ledger_count,
+            "balances": balances_count
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rebuilding points: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при перестройке баллов: {str(e)}")
+
+
+async def get_leaderboard(lesson_id: Optional[str], user_id: str, limit: int) -> dict:
+    """Рейтинг по балансам (общий или по уроку) и место текущего студента"""
+    limit = max(1, min(limit, 100))
+    top, my_balance = await asyncio.gather(
+        db.points_balances.find(
+            {"lesson_id": lesson_id},
+            {"_id": 0, "user_id": 1, "balance": 1, "level": 1, "level_name": 1}
+        ).sort("balance", -1).limit(limit).to_list(length=limit),
+        db.points_balances.find_one({"user_id": user_id, "lesson_id": lesson_id}, {"_id": 0, "balance": 1})
+    )
+    
+    my_rank = None
+    if my_balance:
+        my_rank = await db.points_balances.count_documents({
+            "lesson_id": lesson_id,
+            "balance": {"$gt": my_balance.get("balance", 0)}
+        }) + 1
+    
+    users_map = await resolve_user_names(entry["user_id"] for entry in top)
+    
+    return {
+        "lesson_id": lesson_id,
+        "leaderboard": [
+            {
+                "rank": index + 1,
+                "user_id": entry["user_id"],
+                "user_name": users_map.get(entry["user_id"], entry["user_id"]),
+                "balance": entry.get("balance", 0),
+                "level": entry.get("level"),
+                "level_name": entry.get("level_name"),
+                "is_current_user": entry["user_id"] == user_id
+            }
+            for index, entry in enumerate(top)
+        ],
+        "my_rank": my_rank,
+        "my_balance": (my_balance or {}).get("balance", 0)
+    }
+
+
+@app_v2.get("/api/student/leaderboard")
+async def get_global_leaderboard(
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    """Общий рейтинг студентов по баллам"""
+    try:
+        user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
+        return await get_leaderboard(None, user_id, limit)
+    except Exception as e:
+        logger.error(f"Error getting leaderboard: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении рейтинга: {str(e)}")
+
+
+@app_v2.get("/api/student/leaderboard/{lesson_id}")
+async def get_lesson_leaderboard(
+    lesson_id: str,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    """Рейтинг студентов по баллам за урок"""
+    try:
+        user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
+        return await get_leaderboard(lesson_id, user_id, limit)
+    except Exception as e:
+        logger.error(f"Error getting lesson leaderboard: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении рейтинга урока: {str(e)}")
+
+
+# ===== ДНЕВНЫЕ СВОДКИ АКТИВНОСТИ (activity_daily) =====
+# Счетчики событий по дням: ответы на упражнения, попытки тестов, завершенные челленджи.
+# Один документ на (студент, день) - scope "user", и один на (урок, день) - scope "lesson".
+# Каждая отправка прибавляет к обоим документам; график дашборда, достижения, обзор и тепловая
+# карта читают сводки одним запросом по диапазону дат. Перестройка из истории:
+# POST /api/admin/activity-daily/rebuild
+
+ACTIVITY_SOURCES = ["challenges", "quizzes", "exercises"]
+ACTIVITY_HEATMAP_MAX_DAYS = 366
+
+# Источник: (счетчик, коллекция, поле даты события, условие события)
+ACTIVITY_SOURCE_COLLECTIONS = [
+    ("challenges", "challenge_progress", "completed_at", {"is_completed": True}),
+    ("quizzes", "quiz_attempts", "attempted_at", {}),
+    ("exercises", "exercise_responses", "submitted_at", {}),
+]
+
+
+def get_day_start(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def record_daily_activity(user_id: str, lesson_id: Optional[str], counts: Optional[dict], now: Optional[datetime] = None):
+    """Прибавить события к дневным сводкам студента и урока. Ошибки не прерывают основную
+    операцию: сводки восстанавливаются перестройкой"""
+    counts = {source: count for source, count in (counts or {}).items() if count}
+    if not counts:
+        return
+    now = now or datetime.utcnow()
+    day = get_day_start(now)
+    increments = dict(counts, total=sum(counts.values()))
+    operations = [
+        UpdateOne(
+            {"scope": scope, "scope_id": scope_id, "date": day},
+            {
+                "$inc": increments,
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"id": str(uuid.uuid4())}
+            },
+            upsert=True
+        )
+        for scope, scope_id in (("user", user_id), ("lesson", lesson_id))
+        if scope_id
+    ]
+    try:
+        await bulk_increment_activity_counters(db.activity_daily, operations)
+    except Exception as e:
+        logger.error(f"Error updating daily activity for {user_id}: {str(e)}")
+
+
+async def remove_daily_activity(user_id: str, lesson_id: Optional[str], counts_by_day: dict):
+    """Вычесть удаленные события из дневных сводок студента и (если lesson_id задан) урока.
+    counts_by_day: {начало дня: {"exercises"|"quizzes"|"challenges": число событий}}"""
+    now = datetime.utcnow()
+    operations = []
+    for day, counts in counts_by_day.items():
+        counts = {source: count for source, count in counts.items() if count}
+        if not counts:
+            continue
+        decrements = {source: -count for source, count in counts.items()}
+        decrements["total"] = -sum(counts.values())
+        for scope, scope_id in (("user", user_id), ("lesson", lesson_id)):
+            if scope_id:
+                operations.append(UpdateOne(
+                    {"scope": scope, "scope_id": scope_id, "date": day},
+                    {"$inc": decrements, "$set": {"updated_at": now}}
+                ))
+    if not operations:
+        return
+    try:
+        await db.activity_daily.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.error(f"Error updating daily activity for {user_id}: {str(e)}")
+
+
+async def aggregate_activity_daily(
+    scope_field: str,
+    match: dict,
+    until: Optional[datetime] = None,
+    sources: Optional[List[str]] = None
+) -> List[dict]:
+    """Дневные сводки из исходных коллекций, сгруппированные по полю scope_field (user_id или lesson_id).
+    until - только события раньше этого момента; sources - только указанные источники"""
+    def source_pipeline(source, date_field, condition):
+        date_match = {"$type": "date"}
+        if until is not None:
+            date_match["$lt"] = until
+        return [
+            {"$match": dict(match, **condition, **{date_field: date_match})},
+            {"$group": {
+                "_id": {
+                    "scope_id": f"${scope_field}",
+                    "date": {"$dateTrunc": {"date": f"${date_field}", "unit": "day"}}
+                },
+                source: {"$sum": 1}
+            }}
+        ]
+    
+    (first_source, first_collection, first_date, first_condition), *other_sources = [
+        entry for entry in ACTIVITY_SOURCE_COLLECTIONS if sources is None or entry[0] in sources
+    ]
+    pipeline = source_pipeline(first_source, first_date, first_condition)
+    for source, collection, date_field, condition in other_sources:
+        pipeline.append({"$unionWith": {"coll": collection, "pipeline": source_pipeline(source, date_field, condition)}})
+    pipeline.append({"$group": dict(
+        {"_id": "$_id"},
+        **{source: {"$sum": {"$ifNull": [f"${source}", 0]}} for source in ACTIVITY_SOURCES}
+    )})
+    return await db[first_collection].aggregate(pipeline).to_list(length=None)
+
+
+async def rebuild_activity_daily(user_ids: Optional[List[str]] = None, lesson_ids: Optional[List[str]] = None) -> int:
+    """Перестроить дневные сводки из истории: для указанных студентов и/или уроков,
+    без параметров - полностью. Перестраиваются только прошедшие дни (до начала текущего
+    дня): живые инкременты пишутся в сводки текущего дня, поэтому перестройка выполняется
+    параллельно с ними и ничего не затирает; сводки текущего дня не меняются"""
+    scopes = []
+    if user_ids is None and lesson_ids is None:
+        scopes = [("user", "user_id", None), ("lesson", "lesson_id", None)]
+    else:
+        if user_ids:
+            scopes.append(("user", "user_id", list(user_ids)))
+        if lesson_ids:
+            scopes.append(("lesson", "lesson_id", list(lesson_ids)))
+    
+    now = datetime.utcnow()
+    cutoff = get_day_start(now)
+    rebuilt = 0
+    for scope, scope_field, scope_ids in scopes:
+        match = {scope_field: {"$in": scope_ids}} if scope_ids is not None else {}
+        days = await aggregate_activity_daily(scope_field, match, until=cutoff)
+        
+        scope_filter = {"scope": scope, "date": {"$lt": cutoff}}
+        if scope_ids is not None:
+            scope_filter["scope_id"] = {"$in": scope_ids}
+        await db.activity_daily.delete_many(scope_filter)
+        
+        operations = [
+            UpdateOne(
+                {"scope": scope, "scope_id": day["_id"]["scope_id"], "date": day["_id"]["date"]},
+                {
+                    "$set": dict(
+                        {source: day.get(source, 0) for source in ACTIVITY_SOURCES},
+                        total=sum(day.get(source, 0) for source in ACTIVITY_SOURCES),
+                        updated_at=now
+                    ),
+                    "$setOnInsert": {"id": str(uuid.uuid4())}
+                },
+                upsert=True
+            )
+            for day in days
+            if day["_id"].get("scope_id")
+        ]
+        for start in range(0, len(operations), 1000):
+            await db.activity_daily.bulk_write(operations[start:start + 1000], ordered=False)
+        rebuilt += len(operations)
+    return rebuilt
+
+
+async def load_activity_days(scope: str, scope_id: str, since: datetime) -> List[dict]:
+    """Дневные сводки студента или урока начиная с даты (один запрос по индексу)"""
+    return await db.activity_daily.find(
+        {"scope": scope, "scope_id": scope_id, "date": {"$gte": since}},
+        {"_id": 0, "date": 1, "total": 1, **{source: 1 for source in ACTIVITY_SOURCES}}
+    ).sort("date", 1).to_list(length=None)
+
+
+async def count_activity_between(user_id: str, start: datetime, end: datetime) -> dict:
+    """Число событий студента по источникам в интервале [start, end) - из исходных коллекций.
+    Нужно для неполного первого дня скользящего окна, которого нет в дневных сводках"""
+    counts = await asyncio.gather(*[
+        db[collection].count_documents({"user_id": user_id, date_field: {"$gte": start, "$lt": end}, **condition})
+        for _, collection, date_field, condition in ACTIVITY_SOURCE_COLLECTIONS
+    ])
+    return {source: count for (source, _, _, _), count in zip(ACTIVITY_SOURCE_COLLECTIONS, counts)}
+
+
+async def build_activity_heatmap(scope: str, scope_id: str, days: int) -> dict:
+    """Тепловая карта активности за последние days дней (только дни с активностью)"""
+    days = max(1, min(days, ACTIVITY_HEATMAP_MAX_DAYS))
+    since = get_day_start(datetime.utcnow()) - timedelta(days=days - 1)
+    activity_days = await load_activity_days(scope, scope_id, since)
+    return {
+        "since": since.strftime('%Y-%m-%d'),
+        "days": days,
+        "total": sum(day.get("total", 0) for day in activity_days),
+        "max_day_total": max((day.get("total", 0) for day in activity_days), default=0),
+        "heatmap": [
+            dict(
+                {source: day.get(source, 0) for source in ACTIVITY_SOURCES},
+                date=day["date"].strftime('%Y-%m-%d'),
+                total=day.get("total", 0)
+            )
+            for day in activity_days
+        ]
+    }
+
+
+@app_v2.get("/api/student/activity-heatmap")
+async def get_student_activity_heatmap(
+    days: int = 365,
+    current_user: dict = Depends(get_current_user)
+):
+    """Тепловая карта активности студента (по умолчанию - за год)"""
+    try:
+        user_id = current_user.get('user_id', current_user.get('id', 'unknown'))
+        return await build_activity_heatmap("user", user_id, days)
+    except Exception as e:
+        logger.error(f"Error getting activity heatmap: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении активности: {str(e)}")
+
+
+@app_v2.get("/api/admin/analytics/lesson/{lesson_id}/activity-heatmap")
+async def get_lesson_activity_heatmap(
+    lesson_id: str,
+    days: int = 365,
+    current_user: dict = Depends(get_current_user)
+):
+    """Тепловая карта активности студентов по уроку (по умолчанию - за год)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_admin') and not current_user.get('is_super_admin'):
+            raise HTTPException(status_code=403, detail="Доступ запрещен")
+        
+        return await build_activity_heatmap("lesson", lesson_id, days)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting lesson activity heatmap: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении активности урока: {str(e)}")
+
+
+@app_v2.post("/api/admin/activity-daily/rebuild")
+async def rebuild_activity_daily_endpoint(
+    current_user: dict = Depends(get_current_user)
+):
+    """Перестроить дневные сводки активности из истории (миграция и восстановление)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        rebuilt = await rebuild_activity_daily()
+        
+        logger.info(f"Daily activity rebuilt: {rebuilt} documents")
+        
+        return {
+            "message": "Дневные сводки активности перестроены",
+            "documents": rebuilt
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rebuilding daily activity: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при перестройке активности: {str(e)}")
+
+
+# ===== МАТЕРИАЛИЗОВАННАЯ АНАЛИТИКА СТУДЕНТА (student_analytics) =====
+# Один документ на студента с накопленными итогами: уроки, упражнения, тесты, челленджи,
+# время и файлы. Пути записи прибавляют свои изменения одним конвейерным update_one; если
+# документа еще нет, он строится из исходных коллекций (rebuild_student_analytics).
+# Дашборд читает этот документ, баланс баллов и дневные сводки activity_daily.
+
+DASHBOARD_CHART_DAYS = 7
+
+# Счетчики документа (баллы хранятся отдельно - в points_balances)
+STUDENT_ANALYTICS_COUNTERS = [
+    "total_lessons_started",
+    "total_lessons_completed",
+    "total_exercises_completed",
+    "total_challenge_attempts",
+    "total_challenges_completed",
+    "total_quiz_attempts",
+    "total_quizzes_passed",
+    "quiz_score_sum",
+    "total_time_spent_minutes",
+    "total_video_minutes",
+    "file_views",
+    "file_downloads",
+]
+
+
+def build_student_analytics_pipeline(now: datetime, increments: Optional[dict] = None) -> list:
+    """Конвейер обновления student_analytics: прибавить счетчики и пересчитать производные поля"""
+    apply_stage = {
+        "updated_at": now,
+        "last_activity_at": now
+    }
+    for field, value in (increments or {}).items():
+        if value:
+            apply_stage[field] = {"$add": [{"$ifNull": [f"${field}", 0]}, value]}
+    pipeline = [{"$set": apply_stage}]
+    
+    pipeline.append({"$set": {
+        "average_quiz_score": {"$cond": [
+            {"$gt": [{"$ifNull": ["$total_quiz_attempts", 0]}, 0]},
+            {"$round": [{"$divide": [{"$ifNull": ["$quiz_score_sum", 0]}, "$total_quiz_attempts"]}, 2]},
+            0
+        ]}
+    }})
+    return pipeline
+
+
+async def aggregate_first(collection, pipeline: list) -> dict:
+    """Выполнить агрегацию, возвращающую один документ"""
+    result = await collection.aggregate(pipeline).to_list(length=1)
+    return result[0] if result else {}
+
+
+async def build_student_analytics_document(user_id: str) -> dict:
+    """Собрать документ student_analytics из исходных коллекций (параллельными агрегациями)"""
+    now = datetime.utcnow()
+    match_user = {"$match": {"user_id": user_id}}
+    count_totals = [{"$group": {"_id": None, "count": {"$sum": 1}}}]
+    
+    def total_minutes(collection):
+        return aggregate_first(collection, [
+            match_user,
+            {"$group": {"_id": None, "minutes": {"$sum": "$total_minutes"}}}
+        ])
+    
+    (
+        progress,
+        challenges,
+        quizzes,
+        exercises,
+        time_totals,
+        video_totals,
+        file_actions
+    ) = await asyncio.gather(
+        aggregate_first(db.lesson_progress, [
+            match_user,
+            {"$group": {
+                "_id": None,
+                "count": {"$sum": 1},
+                "completed": {"$sum": {"$cond": [{"$eq": ["$is_completed", True]}, 1, 0]}}
+            }}
+        ]),
+        aggregate_first(db.challenge_progress, [
+            match_user,
+            {"$facet": {
+                "totals": count_totals,
+                "completed": [{"$match": {"is_completed": True}}, {"$count": "count"}]
+            }}
+        ]),
+        aggregate_first(db.quiz_attempts, [
+            match_user,
+            {"$facet": {
+                "totals": count_totals,
+                "scores": [{"$group": {
+                    "_id": None,
+                    "score_sum": {"$sum": "$score"},
+                    "passed": {"$sum": {"$cond": [{"$eq": ["$passed", True]}, 1, 0]}}
+                }}]
+            }}
+        ]),
+        aggregate_first(db.exercise_responses, [match_user, {"$count": "count"}]),
+        total_minutes(db.time_activity),
+        total_minutes(db.video_watch_time),
+        db.file_analytics.aggregate([
+            match_user,
+            {"$group": {"_id": "$action", "count": {"$sum": 1}}}
+        ]).to_list(length=None)
+    )
+    
+    def first_of(facet_result, name):
+        return (facet_result.get(name) or [{}])[0]
+    
+    file_counts = {item["_id"]: item["count"] for item in file_actions}
+    quiz_attempts_count = first_of(quizzes, "totals").get("count", 0)
+    quiz_score_sum = first_of(quizzes, "scores").get("score_sum", 0)
+    
+    return {
+        "user_id": user_id,
+        "total_lessons_started": progress.get("count", 0),
+        "total_lessons_completed": progress.get("completed", 0),
+        "total_exercises_completed": exercises.get("count", 0),
+        "total_challenge_attempts": first_of(challenges, "totals").get("count", 0),
+        "total_challenges_completed": first_of(challenges, "completed").get("count", 0),
+        "total_quiz_attempts": quiz_attempts_count,
+        "total_quizzes_passed": first_of(quizzes, "scores").get("passed", 0),
+        "quiz_score_sum": quiz_score_sum,
+        "average_quiz_score": round(quiz_score_sum / quiz_attempts_count, 2) if quiz_attempts_count else 0,
+        "total_time_spent_minutes": time_totals.get("minutes", 0),
+        "total_video_minutes": video_totals.get("minutes", 0),
+        "file_views": file_counts.get("view", 0),
+        "file_downloads": file_counts.get("download", 0),
+        "updated_at": now,
+        "rebuilt_at": now
+    }
+
+
+async def rebuild_student_analytics(user_id: str) -> dict:
+    """Перестроить документ student_analytics студента из исходных коллекций"""
+    analytics = await build_student_analytics_document(user_id)
+    existing = await db.student_analytics.find_one({"user_id": user_id}, {"id": 1, "created_at": 1, "last_activity_at": 1})
+    analytics["id"] = (existing or {}).get("id") or str(uuid.uuid4())
+    analytics["created_at"] = (existing or {}).get("created_at") or analytics["updated_at"]
+    analytics["last_activity_at"] = (existing or {}).get("last_activity_at")
+    try:
+        await db.student_analytics.replace_one({"user_id": user_id}, analytics, upsert=True)
+    except DuplicateKeyError:
+        # Параллельная перестройка уже создала документ
+        await db.student_analytics.replace_one({"user_id": user_id}, analytics)
+    return analytics
+
+
+async def record_student_activity(user_id: str, increments: Optional[dict] = None):
+    """Прибавить изменения к аналитике студента. Ошибки не прерывают основную операцию:
+    расхождение исправляется перестройкой документа"""
+    try:
+        result = await db.student_analytics.update_one(
+            {"user_id": user_id},
+            build_student_analytics_pipeline(datetime.utcnow(), increments)
+        )
+        if result.matched_count == 0:
+            # Документа еще нет - строим его из исходных данных (они уже включают это изменение)
+            await rebuild_student_analytics(user_id)
+    except Exception as e:
+        logger.error(f"Error updating student analytics for {user_id}: {str(e)}")
+
+
+def lesson_progress_analytics_increments(progress: Optional[dict], now: datetime) -> dict:
+    """Изменения счетчиков уроков по результату обновления lesson_progress: урок начат
+    или завершен именно этим обновлением (метки времени совпадают с now с точностью MongoDB)"""
+    if not progress:
+        return {}
+    stored_now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    increments = {}
+    if progress.get("started_at") == stored_now and progress.get("version") == 1:
+        increments["total_lessons_started"] = 1
+    if progress.get("completed_at") == stored_now:
+        increments["total_lessons_completed"] = 1
+    return increments
+
+
+async def invalidate_student_analytics(user_ids: List[str]):
+    """Удалить документы аналитики после массовых изменений исходных данных
+    (сброс урока, удаление урока, изменение структуры); они перестроятся при следующем обращении"""
+    if user_ids:
+        await db.student_analytics.delete_many({"user_id": {"$in": list(user_ids)}})
+
+
+async def load_student_dashboard_data(user_id: str) -> dict:
+    """Данные дашборда студента: документ student_analytics, баланс баллов,
+    дневные сводки активности за 30 дней и последние события"""
+    now = datetime.utcnow()
+    # Окна скользящие (как раньше: от now - 30/7 дней). Полные дни берутся из сводок,
+    # неполный первый день окна досчитывается по исходным коллекциям
+    since_30 = now - timedelta(days=30)
+    since_7 = now - timedelta(days=7)
+    full_days_30 = get_day_start(since_30) + timedelta(days=1)
+    full_days_7 = get_day_start(since_7) + timedelta(days=1)
+    
+    (analytics, balance, activity_days, edge_30, edge_7,
+     total_lessons, latest_completed_lessons, latest_challenges) = await asyncio.gather(
+        db.student_analytics.find_one({"user_id": user_id}, {"_id": 0}),
+        get_points_balance(user_id),
+        load_activity_days("user", user_id, full_days_30),
+        count_activity_between(user_id, since_30, full_days_30),
+        count_activity_between(user_id, since_7, full_days_7),
+        db.lessons_v2.count_documents({}),
+        db.lesson_progress.find(
+            {"user_id": user_id, "is_completed": True},
+            {"_id": 0, "lesson_id": 1, "completed_at": 1}
+        ).sort("completed_at", -1).limit(3).to_list(length=3),
+        db.challenge_progress.find(
+            {"user_id": user_id},
+            {"_id": 0, "lesson_id": 1, "completed_at": 1, "points_earned": 1}
+        ).sort("completed_at", -1).limit(2).to_list(length=2)
+    )
+    if analytics is None:
+        analytics = await rebuild_student_analytics(user_id)
+    
+    recent_30 = dict(edge_30)
+    recent_7 = sum(edge_7.values())
+    activity_by_day = {}
+    for day in activity_days:
+        activity_by_day[day["date"]] = day.get("total", 0)
+        for source in ACTIVITY_SOURCES:
+            recent_30[source] += day.get(source, 0)
+        if day["date"] >= full_days_7:
+            recent_7 += day.get("total", 0)
+    
+    points = balance.get("by_source", {})
+    return {
+        "now": now,
+        "points_balance": balance,
+        "total_lessons": total_lessons,
+        "lesson_progress_count": analytics.get("total_lessons_started", 0),
+        "completed_lessons": analytics.get("total_lessons_completed", 0),
+        "total_challenge_attempts": analytics.get("total_challenge_attempts", 0),
+        "total_challenge_points": points.get("challenges", 0),
+        "total_quiz_attempts": analytics.get("total_quiz_attempts", 0),
+        "total_quiz_points": points.get("quizzes", 0),
+        "total_exercises_completed": analytics.get("total_exercises_completed", 0),
+        "total_time_points": points.get("time", 0),
+        "total_time_minutes": analytics.get("total_time_spent_minutes", 0),
+        "total_video_points": points.get("videos", 0),
+        "total_video_minutes": analytics.get("total_video_minutes", 0),
+        "file_views": analytics.get("file_views", 0),
+        "file_downloads": analytics.get("file_downloads", 0),
+        "recent_challenges": recent_30["challenges"],
+        "recent_quizzes": recent_30["quizzes"],
+        "recent_exercises": recent_30["exercises"],
+        "recent_activity_7_days": recent_7,
+        "activity_by_day": activity_by_day,
+        "latest_completed_lessons": latest_completed_lessons,
+        "latest_challenges": latest_challenges
+    }
+
+
+@app_v2.post("/api/admin/student-analytics/rebuild")
+async def rebuild_student_analytics_endpoint(
+    user_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Перестроить student_analytics из исходных коллекций (для одного студента или для всех)"""
+    try:
+        # Проверка прав администратора
+        if not current_user.get('is_super_admin', False) and not current_user.get('is_admin', False):
+            raise HTTPException(status_code=403, detail="Недостаточно прав")
+        
+        if user_id:
+            user_ids = [user_id]
+        else:
+            user_id_lists = await asyncio.gather(
+                db.lesson_progress.distinct("user_id"),
+                db.quiz_attempts.distinct("user_id"),
+                db.challenge_progress.distinct("user_id"),
+                db.time_activity.distinct("user_id"),
+                db.video_watch_time.distinct("user_id"),
+                db.student_analytics.distinct("user_id")
+            )
+            user_ids = sorted({uid for ids in user_id_lists for uid in ids if uid})
+        
+        for uid in user_ids:
+            await rebuild_student_analytics(uid)
+        
+        logger.info(f"Student analytics rebuilt for {len(user_ids)} students")
+        
+        return {
+            "message": "Аналитика студентов перестроена",
+            "rebuilt": len(user_ids)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rebuilding student analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при перестройке аналитики: {str(e)}")
+
+
 @app_v2.get("/api/student/dashboard-stats")
 async def get_student_dashboard_stats(
     current_user: dict = Depends(get_current_user)
@@ -2647,87 +6345,36 @@ async def get_student_dashboard_stats(
     try:
         user_id = current_user['user_id']
         
-        # 1. Получаем все уроки
-        lessons = await db['lessons_v2'].find().to_list(length=None)
-        total_lessons = len(lessons)
-        
-        # 2. Получаем прогресс по урокам
-        lesson_progress = await db['lesson_progress'].find({'user_id': user_id}).to_list(length=None)
-        completed_lessons = len([p for p in lesson_progress if p.get('is_completed', False)])
-        
-        # 3. Считаем общие баллы
-        # Баллы за челленджи
-        challenge_attempts = await db['challenge_progress'].find({'user_id': user_id}).to_list(length=None)
-        total_challenge_points = sum(attempt.get('points_earned', 0) for attempt in challenge_attempts)
-        total_challenge_attempts = len(challenge_attempts)
-        
-        # Баллы за тесты
-        quiz_attempts = await db['quiz_attempts'].find({'user_id': user_id}).to_list(length=None)
-        total_quiz_points = sum(attempt.get('points_earned', 0) for attempt in quiz_attempts)
-        total_quiz_attempts = len(quiz_attempts)
-        
-        # Баллы за время обучения (из time_activity)
-        time_activity_records = await db['time_activity'].find({'user_id': user_id}).to_list(length=None)
-        total_time_points = sum(record.get('total_points', 0) for record in time_activity_records)
-        total_time_minutes = sum(record.get('total_minutes', 0) for record in time_activity_records)
-        
-        # Баллы за просмотр видео
-        video_watch_records = await db['video_watch_time'].find({'user_id': user_id}).to_list(length=None)
-        total_video_points = sum(record.get('total_points', 0) for record in video_watch_records)
-        total_video_minutes = sum(record.get('total_minutes', 0) for record in video_watch_records)
+        # 1-6. Уроки, прогресс, упражнения, файлы - из student_analytics; баллы - из баланса;
+        # недавняя активность - из дневных сводок activity_daily
+        data = await load_student_dashboard_data(user_id)
+        now = data["now"]
+        
+        total_lessons = data["total_lessons"]
+        completed_lessons = data["completed_lessons"]
+        total_challenge_points = data["total_challenge_points"]
+        total_challenge_attempts = data["total_challenge_attempts"]
+        total_quiz_points = data["total_quiz_points"]
+        total_quiz_attempts = data["total_quiz_attempts"]
+        total_time_points = data["total_time_points"]
+        total_time_minutes = data["total_time_minutes"]
+        total_video_points = data["total_video_points"]
+        total_video_minutes = data["total_video_minutes"]
         
         # Общие баллы
         total_points = total_challenge_points + total_quiz_points + total_time_points + total_video_points
         
-        # 4. Считаем упражнения
-        exercise_responses = await db['exercise_responses'].find({'user_id': user_id}).to_list(length=None)
-        total_exercises_completed = len(exercise_responses)
-        
-        # 5. Считаем файлы
-        file_views = await db['file_analytics'].count_documents({'user_id': user_id, 'action': 'view'})
-        file_downloads = await db['file_analytics'].count_documents({'user_id': user_id, 'action': 'download'})
-        
-        # 6. Активность по дням (последние 30 дней)
-        from datetime import datetime, timedelta
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        
-        # Собираем активность из разных источников
-        recent_challenges = await db['challenge_progress'].count_documents({
-            'user_id': user_id,
-            'completed_at': {'$gte': thirty_days_ago}
-        })
-        
-        recent_quizzes = await db['quiz_attempts'].count_documents({
-            'user_id': user_id,
-            'attempted_at': {'$gte': thirty_days_ago}
-        })
-        
-        recent_exercises = await db['exercise_responses'].count_documents({
-            'user_id': user_id,
-            'submitted_at': {'$gte': thirty_days_ago}
-        })
-        
-        # 7. Определяем уровень студента на основе баллов
-        level = 1
-        level_name = "Новичок"
-        next_level_points = 100
+        total_exercises_completed = data["total_exercises_completed"]
+        file_views = data["file_views"]
+        file_downloads = data["file_downloads"]
+        recent_challenges = data["recent_challenges"]
+        recent_quizzes = data["recent_quizzes"]
+        recent_exercises = data["recent_exercises"]
         
-        if total_points >= 1000:
-            level = 5
-            level_name = "Мастер"
-            next_level_points = 2000
-        elif total_points >= 500:
-            level = 4
-            level_name = "Эксперт"
-            next_level_points = 1000
-        elif total_points >= 250:
-            level = 3
-            level_name = "Продвинутый"
-            next_level_points = 500
-        elif total_points >= 100:
-            level = 2
-            level_name = "Ученик"
-            next_level_points = 250
+        # 7. Уровень студента (вычисляется при начислении баллов и хранится в балансе)
+        level = data["points_balance"]["level"]
+        level_name = data["points_balance"]["level_name"]
+        next_level_points = data["points_balance"]["next_level_points"]
         
         # 8. Достижения (бейджи)
         achievements = []
@@ -2803,20 +6450,7 @@ async def get_student_dashboard_stats(
             })
         
         # Активный ученик (активность в последние 7 дней)
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        recent_challenge_count = await db['challenge_progress'].count_documents({
-            'user_id': user_id,
-            'completed_at': {'$gte': seven_days_ago}
-        })
-        recent_quiz_count = await db['quiz_attempts'].count_documents({
-            'user_id': user_id,
-            'attempted_at': {'$gte': seven_days_ago}
-        })
-        recent_exercise_count = await db['exercise_responses'].count_documents({
-            'user_id': user_id,
-            'submitted_at': {'$gte': seven_days_ago}
-        })
-        recent_activity = recent_challenge_count + recent_quiz_count + recent_exercise_count
+        recent_activity = data["recent_activity_7_days"]
         
         if recent_activity >= 5:
             achievements.append({
@@ -2829,24 +6463,10 @@ async def get_student_dashboard_stats(
         
         # 9. График активности (последние 7 дней)
         activity_chart = []
-        for i in range(7):
-            day = datetime.utcnow() - timedelta(days=6-i)
+        for i in range(DASHBOARD_CHART_DAYS):
+            day = now - timedelta(days=DASHBOARD_CHART_DAYS - 1 - i)
             day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-            day_end = day_start + timedelta(days=1)
-            
-            day_challenge_count = await db['challenge_progress'].count_documents({
-                'user_id': user_id,
-                'completed_at': {'$gte': day_start, '$lt': day_end}
-            })
-            day_quiz_count = await db['quiz_attempts'].count_documents({
-                'user_id': user_id,
-                'attempted_at': {'$gte': day_start, '$lt': day_end}
-            })
-            day_exercise_count = await db['exercise_responses'].count_documents({
-                'user_id': user_id,
-                'submitted_at': {'$gte': day_start, '$lt': day_end}
-            })
-            day_activity = day_challenge_count + day_quiz_count + day_exercise_count
+            day_activity = data["activity_by_day"].get(day_start, 0)
             
             activity_chart.append({
                 'date': day.strftime('%d.%m'),
@@ -2857,13 +6477,21 @@ async def get_student_dashboard_stats(
         # 10. Последние достижения (последние 5)
         recent_achievements = []
         
-        # Последние завершенные уроки
-        recent_lesson_progress = await db['lesson_progress'].find(
-            {'user_id': user_id, 'is_completed': True}
-        ).sort('completed_at', -1).limit(3).to_list(length=3)
+        # Названия уроков для последних завершенных уроков и челленджей - одним запросом
+        recent_lesson_progress = data["latest_completed_lessons"]
+        recent_challenge_attempts = data["latest_challenges"]
+        recent_lesson_ids = list({
+            item['lesson_id'] for item in recent_lesson_progress + recent_challenge_attempts
+            if item.get('lesson_id') is not None
+        })
+        lessons_by_key = {}
+        if recent_lesson_ids:
+            async for lesson in db['lessons_v2'].find({'_id': {'$in': recent_lesson_ids}}, {'_id': 1, 'title': 1}):
+                lessons_by_key[lesson['_id']] = lesson
         
+        # Последние завершенные уроки
         for progress in recent_lesson_progress:
-            lesson = await db['lessons_v2'].find_one({'_id': progress['lesson_id']})
+            lesson = lessons_by_key.get(progress.get('lesson_id'))
             if lesson:
                 recent_achievements.append({
                     'type': 'lesson',
@@ -2873,12 +6501,8 @@ async def get_student_dashboard_stats(
                 })
         
         # Последние челленджи
-        recent_challenge_attempts = await db['challenge_progress'].find(
-            {'user_id': user_id}
-        ).sort('completed_at', -1).limit(2).to_list(length=2)
-        
         for attempt in recent_challenge_attempts:
-            lesson = await db['lessons_v2'].find_one({'_id': attempt['lesson_id']})
+            lesson = lessons_by_key.get(attempt.get('lesson_id'))
             if lesson:
                 recent_achievements.append({
                     'type': 'challenge',
@@ -2927,7 +6551,7 @@ async def get_student_dashboard_stats(
                 'lessons': {
                     'total': total_lessons,
                     'completed': completed_lessons,
-                    'in_progress': len(lesson_progress) - completed_lessons,
+                    'in_progress': data["lesson_progress_count"] - completed_lessons,
                     'completion_percentage': int((completed_lessons / total_lessons * 100)) if total_lessons > 0 else 0
                 },
                 
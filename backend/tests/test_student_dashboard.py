@@ -0,0 +1,281 @@
+"""
+Эквивалентность дашборда студента исходной реализации.
+
+Эталон - прежний код /api/student/dashboard-stats (прямые запросы к исходным коллекциям),
+перенесенный сюда без изменений логики. Текущая реализация читает student_analytics,
+баланс баллов и дневные сводки activity_daily; сводки и баланс заполняются теми же
+функциями, что вызываются при отправке ответов.
+
+Запуск: cd backend && pip install -r requirements-dev.txt && python -m pytest tests
+"""
+import asyncio
+import random
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+from mongomock_motor import AsyncMongoMockClient
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+
+import server
+
+NOW = datetime(2026, 3, 18, 10, 30, 15)
+
+
+class FrozenDatetime(datetime):
+    @classmethod
+    def utcnow(cls):
+        return NOW
+
+
+async def baseline_dashboard_stats(db, user_id: str) -> dict:
+    """Прежняя реализация (последовательные запросы к исходным коллекциям)"""
+    lessons = await db['lessons_v2'].find().to_list(length=None)
+    total_lessons = len(lessons)
+
+    lesson_progress = await db['lesson_progress'].find({'user_id': user_id}).to_list(length=None)
+    completed_lessons = len([p for p in lesson_progress if p.get('is_completed', False)])
+
+    challenge_attempts = await db['challenge_progress'].find({'user_id': user_id}).to_list(length=None)
+    total_challenge_points = sum(attempt.get('points_earned', 0) for attempt in challenge_attempts)
+    total_challenge_attempts = len(challenge_attempts)
+
+    quiz_attempts = await db['quiz_attempts'].find({'user_id': user_id}).to_list(length=None)
+    total_quiz_points = sum(attempt.get('points_earned', 0) for attempt in quiz_attempts)
+    total_quiz_attempts = len(quiz_attempts)
+
+    time_activity_records = await db['time_activity'].find({'user_id': user_id}).to_list(length=None)
+    total_time_points = sum(record.get('total_points', 0) for record in time_activity_records)
+    total_time_minutes = sum(record.get('total_minutes', 0) for record in time_activity_records)
+
+    video_watch_records = await db['video_watch_time'].find({'user_id': user_id}).to_list(length=None)
+    total_video_points = sum(record.get('total_points', 0) for record in video_watch_records)
+    total_video_minutes = sum(record.get('total_minutes', 0) for record in video_watch_records)
+
+    total_points = total_challenge_points + total_quiz_points + total_time_points + total_video_points
+
+    exercise_responses = await db['exercise_responses'].find({'user_id': user_id}).to_list(length=None)
+    total_exercises_completed = len(exercise_responses)
+
+    file_views = await db['file_analytics'].count_documents({'user_id': user_id, 'action': 'view'})
+    file_downloads = await db['file_analytics'].count_documents({'user_id': user_id, 'action': 'download'})
+
+    def count_since(since):
+        return asyncio.gather(
+            db['challenge_progress'].count_documents({'user_id': user_id, 'completed_at': {'$gte': since}}),
+            db['quiz_attempts'].count_documents({'user_id': user_id, 'attempted_at': {'$gte': since}}),
+            db['exercise_responses'].count_documents({'user_id': user_id, 'submitted_at': {'$gte': since}})
+        )
+
+    recent_challenges, recent_quizzes, recent_exercises = await count_since(NOW - timedelta(days=30))
+    recent_activity = sum(await count_since(NOW - timedelta(days=7)))
+
+    activity_chart = []
+    for i in range(7):
+        day = NOW - timedelta(days=6 - i)
+        day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        day_end = day_start + timedelta(days=1)
+        day_activity = 0
+        for collection, field in (('challenge_progress', 'completed_at'), ('quiz_attempts', 'attempted_at'), ('exercise_responses', 'submitted_at')):
+            day_activity += await db[collection].count_documents({
+                'user_id': user_id,
+                field: {'$gte': day_start, '$lt': day_end}
+            })
+        activity_chart.append({
+            'date': day.strftime('%d.%m'),
+            'day_name': ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс'][day.weekday()],
+            'activity': day_activity
+        })
+
+    recent_achievements = []
+    recent_lesson_progress = await db['lesson_progress'].find(
+        {'user_id': user_id, 'is_completed': True}
+    ).sort('completed_at', -1).limit(3).to_list(length=3)
+    for progress in recent_lesson_progress:
+        lesson = await db['lessons_v2'].find_one({'_id': progress['lesson_id']})
+        if lesson:
+            recent_achievements.append({
+                'type': 'lesson',
+                'title': f"Урок завершен: {lesson['title']}",
+                'date': progress.get('completed_at', NOW).strftime('%d.%m.%Y'),
+                'icon': '✅'
+            })
+    recent_challenge_attempts = await db['challenge_progress'].find(
+        {'user_id': user_id}
+    ).sort('completed_at', -1).limit(2).to_list(length=2)
+    for attempt in recent_challenge_attempts:
+        lesson = await db['lessons_v2'].find_one({'_id': attempt['lesson_id']})
+        if lesson:
+            recent_achievements.append({
+                'type': 'challenge',
+                'title': f"Челлендж: {lesson['title']} (+{attempt.get('points_earned', 0)} баллов)",
+                'date': attempt.get('completed_at', NOW).strftime('%d.%m.%Y'),
+                'icon': '⚡'
+            })
+    recent_achievements = sorted(recent_achievements, key=lambda x: x['date'], reverse=True)[:5]
+
+    return {
+        'total_points': total_points,
+        'total_lessons': total_lessons,
+        'completed_lessons': completed_lessons,
+        'in_progress': len(lesson_progress) - completed_lessons,
+        'total_challenge_attempts': total_challenge_attempts,
+        'total_challenge_points': total_challenge_points,
+        'total_quiz_attempts': total_quiz_attempts,
+        'total_quiz_points': total_quiz_points,
+        'total_exercises_completed': total_exercises_completed,
+        'points_breakdown': {
+            'challenges': total_challenge_points,
+            'quizzes': total_quiz_points,
+            'time': total_time_points,
+            'time_minutes': total_time_minutes,
+            'videos': total_video_points,
+            'video_minutes': total_video_minutes
+        },
+        'file_views': file_views,
+        'file_downloads': file_downloads,
+        'recent_challenges': recent_challenges,
+        'recent_quizzes': recent_quizzes,
+        'recent_exercises': recent_exercises,
+        'active_learner': recent_activity >= 5,
+        'activity_chart': activity_chart,
+        'recent_achievements': recent_achievements
+    }
+
+
+def current_dashboard_stats(stats: dict) -> dict:
+    """Те же поля из ответа текущей реализации"""
+    return {
+        'total_points': stats['total_points'],
+        'total_lessons': stats['total_lessons'],
+        'completed_lessons': stats['completed_lessons'],
+        'in_progress': stats['lessons']['in_progress'],
+        'total_challenge_attempts': stats['total_challenge_attempts'],
+        'total_challenge_points': stats['total_challenge_points'],
+        'total_quiz_attempts': stats['total_quiz_attempts'],
+        'total_quiz_points': stats['total_quiz_points'],
+        'total_exercises_completed': stats['total_exercises_completed'],
+        'points_breakdown': stats['points_breakdown'],
+        'file_views': stats['activity']['file_views'],
+        'file_downloads': stats['activity']['file_downloads'],
+        'recent_challenges': stats['activity']['recent_challenges'],
+        'recent_quizzes': stats['activity']['recent_quizzes'],
+        'recent_exercises': stats['activity']['recent_exercises'],
+        'active_learner': any(item['id'] == 'active_learner' for item in stats['achievements']),
+        'activity_chart': stats['activity_chart'],
+        'recent_achievements': stats['recent_achievements']
+    }
+
+
+def event_time(rng: random.Random) -> datetime:
+    """Время события: чаще всего - рядом с границами окон 30 и 7 дней"""
+    boundary = rng.choice([NOW - timedelta(days=30), NOW - timedelta(days=7), None])
+    if boundary is None:
+        return NOW - timedelta(days=rng.randint(0, 40), hours=rng.randint(0, 23), minutes=rng.randint(0, 59))
+    return boundary + timedelta(minutes=rng.randint(-16 * 60, 16 * 60))
+
+
+async def seed(db, rng: random.Random, user_id: str):
+    """Исходные документы и те же обновления сводок и баллов, что делают эндпоинты"""
+    lesson_ids = [f"lesson-{i}" for i in range(6)]
+    for lesson_id in lesson_ids:
+        if not await db.lessons_v2.find_one({'_id': lesson_id}):
+            await db.lessons_v2.insert_one({'_id': lesson_id, 'id': lesson_id, 'title': f"Урок {lesson_id}"})
+
+    for lesson_id in rng.sample(lesson_ids, 4):
+        is_completed = rng.random() < 0.6
+        await db.lesson_progress.insert_one({
+            'user_id': user_id,
+            'lesson_id': lesson_id,
+            'is_completed': is_completed,
+            'completed_at': event_time(rng) if is_completed else None
+        })
+
+    for i in range(rng.randint(10, 25)):
+        lesson_id = rng.choice(lesson_ids)
+        is_completed = rng.random() < 0.8
+        completed_at = event_time(rng) if is_completed else None
+        points = rng.randint(1, 50) if is_completed else 0
+        attempt_id = f"{user_id}-challenge-{i}"
+        await db.challenge_progress.insert_one({
+            'id': attempt_id,
+            'user_id': user_id,
+            'lesson_id': lesson_id,
+            'is_completed': is_completed,
+            'completed_at': completed_at,
+            'points_earned': points
+        })
+        if is_completed:
+            await server.record_daily_activity(user_id, lesson_id, {'challenges': 1}, completed_at)
+            await server.award_points(user_id, lesson_id, 'challenges', points, attempt_id)
+
+    for i in range(rng.randint(10, 25)):
+        lesson_id = rng.choice(lesson_ids)
+        attempted_at = event_time(rng)
+        points = rng.randint(0, 10)
+        attempt_id = f"{user_id}-quiz-{i}"
+        await db.quiz_attempts.insert_one({
+            'id': attempt_id,
+            'user_id': user_id,
+            'lesson_id': lesson_id,
+            'attempted_at': attempted_at,
+            'score': points * 10,
+            'passed': points >= 7,
+            'points_earned': points
+        })
+        await server.record_daily_activity(user_id, lesson_id, {'quizzes': 1}, attempted_at)
+        await server.award_points(user_id, lesson_id, 'quizzes', points, attempt_id)
+
+    for i in range(rng.randint(5, 20)):
+        lesson_id = rng.choice(lesson_ids)
+        submitted_at = event_time(rng)
+        await db.exercise_responses.insert_one({'user_id': user_id, 'lesson_id': lesson_id, 'submitted_at': submitted_at})
+        await server.record_daily_activity(user_id, lesson_id, {'exercises': 1}, submitted_at)
+
+    for collection, source in ((db.time_activity, 'time'), (db.video_watch_time, 'videos')):
+        for lesson_id in rng.sample(lesson_ids, 2):
+            minutes = rng.randint(1, 40)
+            await collection.insert_one({'user_id': user_id, 'lesson_id': lesson_id, 'total_minutes': minutes, 'total_points': minutes})
+            await server.award_points(user_id, lesson_id, source, minutes, lesson_id)
+
+    for _ in range(rng.randint(0, 8)):
+        await db.file_analytics.insert_one({'user_id': user_id, 'file_id': 'file-1', 'action': rng.choice(['view', 'download'])})
+
+
+@pytest.mark.parametrize("seed_value", [1, 2, 3, 4, 5])
+def test_dashboard_matches_baseline(monkeypatch, seed_value):
+    db = AsyncMongoMockClient()[f"dashboard_{seed_value}"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "datetime", FrozenDatetime)
+    rng = random.Random(seed_value)
+
+    async def run():
+        await seed(db, rng, "student")
+        await seed(db, rng, "other-student")
+        response = await server.get_student_dashboard_stats(current_user={'user_id': 'student'})
+        expected = await baseline_dashboard_stats(db, 'student')
+        return current_dashboard_stats(response['stats']), expected
+
+    actual, expected = asyncio.run(run())
+    assert actual == expected
+
+
+def test_rolling_window_counts_partial_first_day(monkeypatch):
+    """Событие раньше now - 30 дней в тот же календарный день не входит в окно, позже - входит"""
+    db = AsyncMongoMockClient()["dashboard_window"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "datetime", FrozenDatetime)
+
+    async def run():
+        for attempted_at in (NOW - timedelta(days=30, hours=1), NOW - timedelta(days=30) + timedelta(hours=1)):
+            await db.quiz_attempts.insert_one({'user_id': 'student', 'lesson_id': 'lesson-1', 'attempted_at': attempted_at})
+            await server.record_daily_activity('student', 'lesson-1', {'quizzes': 1}, attempted_at)
+        return await server.load_student_dashboard_data('student')
+
+    data = asyncio.run(run())
+    assert data["recent_quizzes"] == 1
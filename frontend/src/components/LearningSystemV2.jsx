@@ -44,6 +44,7 @@ import {
 } from 'lucide-react';
 import { useAuth } from './AuthContextV2';
 import { getBackendUrl } from '../utils/backendUrl';
+import { fetchStreamUrl, openFileInNewTab } from '../utils/fileLinks';
 
 const LearningSystemV2 = () => {
   const { user, isAuthenticated, loading: authLoading, isInitialized } = useAuth();
@@ -68,6 +69,8 @@ const LearningSystemV2 = () => {
   // Состояния для файлов
   const [lessonFiles, setLessonFiles] = useState({ theory: [], exercises: [], challenge: [], quiz: [] });
   const [viewingFile, setViewingFile] = useState(null);
+  // Подписанная ссылка на просматриваемый файл (токен сессии в URL не передается)
+  const [viewingFileUrl, setViewingFileUrl] = useState(null);
   const [fileViewerOpen, setFileViewerOpen] = useState(false);
   const [isFullscreen, setIsFullscreen] = useState(false);
   const [imageRotation, setImageRotation] = useState(0); // Угол поворота изображения
@@ -85,6 +88,10 @@ const LearningSystemV2 = () => {
   const [quizAnswers, setQuizAnswers] = useState({});
   const [quizCompleted, setQuizCompleted] = useState(false);
   const [quizScore, setQuizScore] = useState(0);
+  // Результат последней отправки с сервера: { correct_count, total_questions, passed, results }
+  const [quizResult, setQuizResult] = useState(null);
+  const [quizError, setQuizError] = useState(null);
+  const [submittingQuiz, setSubmittingQuiz] = useState(false);
   
   // Состояния для отслеживания времени активности
   const [timeActivity, setTimeActivity] = useState({ total_minutes: 0, total_points: 0 });
@@ -140,18 +147,28 @@ const LearningSystemV2 = () => {
   const loadLessons = async () => {
     try {
       setLoading(true);
-      const response = await fetch(`${backendUrl}/api/learning-v2/lessons`, {
-        headers: {
-          'Authorization': `Bearer ${localStorage.getItem('token')}`,
-          'Content-Type': 'application/json'
-        }
-      });
 
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
+      // Список уроков приходит постранично в кратком режиме (без содержимого разделов)
+      const data = { lessons: [], user_level: null };
+      let cursor = null;
+      do {
+        const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+        const response = await fetch(`${backendUrl}/api/learning-v2/lessons${query}`, {
+          headers: {
+            'Authorization': `Bearer ${localStorage.getItem('token')}`,
+            'Content-Type': 'application/json'
+          }
+        });
 
-      const data = await response.json();
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        const page = await response.json();
+        data.lessons.push(...page.lessons);
+        data.user_level = page.user_level;
+        cursor = page.next_cursor;
+      } while (cursor);
       
       // Загружаем прогресс для каждого урока
       const lessonsWithProgress = await Promise.all(
@@ -366,7 +383,9 @@ const LearningSystemV2 = () => {
         await loadChallengeHistory(lesson.id, data.lesson.challenge.id);
       }
       
-      // Загружаем историю тестов если есть
+      // Загружаем историю тестов если есть (разбор ответов есть только у отправки в этой сессии)
+      setQuizResult(null);
+      setQuizError(null);
       if (data.lesson.quiz) {
         await loadQuizHistory(lesson.id);
       }
@@ -593,6 +612,30 @@ const LearningSystemV2 = () => {
     }
   };
 
+  // Ссылка на просматриваемый файл запрашивается при открытии просмотра
+  useEffect(() => {
+    setViewingFileUrl(null);
+    if (!viewingFile) return undefined;
+    let cancelled = false;
+    fetchStreamUrl(backendUrl, viewingFile.id)
+      .then(url => {
+        if (!cancelled) setViewingFileUrl(url);
+      })
+      .catch(error => console.error('Error getting file link:', error));
+    return () => {
+      cancelled = true;
+    };
+  }, [viewingFile]);
+
+  const handleOpenFileInNewTab = async (file) => {
+    try {
+      await openFileInNewTab(backendUrl, file.id);
+    } catch (error) {
+      console.error('Error opening file:', error);
+      alert('Ошибка при открытии файла');
+    }
+  };
+
   // Открытие файла на просмотр
   const handleViewFile = async (file) => {
     setViewingFile(file);
@@ -845,6 +888,8 @@ const LearningSystemV2 = () => {
     setQuizAnswers({});
     setQuizCompleted(false);
     setQuizScore(0);
+    setQuizResult(null);
+    setQuizError(null);
   };
 
   const handleQuizAnswer = (questionId, answer) => {
@@ -867,23 +912,11 @@ const LearningSystemV2 = () => {
   };
 
   const submitQuiz = async () => {
+    setSubmittingQuiz(true);
+    setQuizError(null);
     try {
-      // Подсчет правильных ответов
-      let correctCount = 0;
-      const questions = currentLesson.quiz.questions;
-      
-      questions.forEach(question => {
-        const userAnswer = quizAnswers[question.id];
-        if (userAnswer === question.correct_answer) {
-          correctCount++;
-        }
-      });
-
-      const score = Math.round((correctCount / questions.length) * 100);
-      const passingScore = currentLesson.quiz.passing_score || 70;
-      const passed = score >= passingScore;
-
-      // Сохраняем результат в БД
+      // Ответы оцениваются на сервере (регистр и пробелы в текстовых ответах не учитываются,
+      // процент - с учетом веса вопросов)
       const response = await fetch(
         `${backendUrl}/api/student/quiz-attempt`,
         {
@@ -895,22 +928,26 @@ const LearningSystemV2 = () => {
           body: JSON.stringify({
             lesson_id: currentLesson.id,
             quiz_id: currentLesson.quiz.id || currentLesson.id,
-            score: score,
-            passed: passed,
             answers: quizAnswers
           })
         }
       );
 
       if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
       }
 
       const data = await response.json();
       console.log('Quiz result saved:', data);
 
-      // Обновляем состояние с баллами
-      setQuizScore(score);
+      setQuizScore(data.score);
+      setQuizResult({
+        correct_count: data.correct_count,
+        total_questions: data.total_questions,
+        passed: data.passed,
+        results: data.results || []
+      });
       setQuizCompleted(true);
       
       // Сохраняем заработанные баллы
@@ -925,19 +962,10 @@ const LearningSystemV2 = () => {
 
     } catch (error) {
       console.error('Error submitting quiz:', error);
-      // Даже если сохранение не удалось, показываем результат
-      // Пересчитываем score локально
-      let localCorrectCount = 0;
-      const questions = currentLesson.quiz.questions;
-      questions.forEach(question => {
-        const userAnswer = quizAnswers[question.id];
-        if (userAnswer === question.correct_answer) {
-          localCorrectCount++;
-        }
-      });
-      const score = Math.round((localCorrectCount / questions.length) * 100);
-      setQuizScore(score);
-      setQuizCompleted(true);
+      // Без ответа сервера результат неизвестен - ответы остаются, тест можно отправить повторно
+      setQuizError(`Не удалось сохранить результат теста: ${error.message}`);
+    } finally {
+      setSubmittingQuiz(false);
     }
   };
 
@@ -947,6 +975,8 @@ const LearningSystemV2 = () => {
     setQuizAnswers({});
     setQuizCompleted(false);
     setQuizScore(0);
+    setQuizResult(null);
+    setQuizError(null);
   };
 
   const renderLessonCard = (lesson) => {
@@ -1046,22 +1076,22 @@ const LearningSystemV2 = () => {
             <div className="grid grid-cols-1 sm:grid-cols-2 gap-3">
               <div className="flex items-center">
                 <BookOpen className="w-4 h-4 mr-2 text-blue-600 flex-shrink-0" />
-                <span className="text-sm text-gray-700">{lesson.theory?.length || 0} блоков теории</span>
+                <span className="text-sm text-gray-700">{lesson.theory_count ?? lesson.theory?.length ?? 0} блоков теории</span>
               </div>
               <div className="flex items-center">
                 <Brain className="w-4 h-4 mr-2 text-blue-600 flex-shrink-0" />
-                <span className="text-sm text-gray-700">{lesson.exercises?.length || 0} интерактивных упражнений</span>
+                <span className="text-sm text-gray-700">{lesson.exercises_count ?? lesson.exercises?.length ?? 0} интерактивных упражнений</span>
               </div>
-              {lesson.challenge && (
+              {(lesson.has_challenge || lesson.challenge) && (
                 <div className="flex items-center">
                   <Calendar className="w-4 h-4 mr-2 text-blue-600 flex-shrink-0" />
-                  <span className="text-sm text-gray-700">{lesson.challenge.duration_days}-дневный челлендж</span>
+                  <span className="text-sm text-gray-700">{lesson.challenge_days ?? lesson.challenge?.duration_days}-дневный челлендж</span>
                 </div>
               )}
-              {lesson.quiz && (
+              {(lesson.has_quiz || lesson.quiz) && (
                 <div className="flex items-center">
                   <Target className="w-4 h-4 mr-2 text-blue-600 flex-shrink-0" />
-                  <span className="text-sm text-gray-700">Тест ({lesson.quiz.questions?.length || 0} вопросов)</span>
+                  <span className="text-sm text-gray-700">Тест ({lesson.quiz_questions_count ?? lesson.quiz?.questions?.length ?? 0} вопросов)</span>
                 </div>
               )}
               {lesson.analytics_enabled && (
@@ -1936,7 +1966,11 @@ const LearningSystemV2 = () => {
     // Если тест завершен - показываем результаты
     if (quizCompleted) {
       const passingScore = currentLesson.quiz.passing_score || 70;
-      const passed = quizScore >= passingScore;
+      const passed = quizResult ? quizResult.passed : quizScore >= passingScore;
+      // Правильность, правильные ответы и пояснения - из ответа сервера на отправку попытки
+      const resultsByQuestion = Object.fromEntries(
+        (quizResult?.results || []).map(result => [result.question_id, result])
+      );
 
       return (
         <Card>
@@ -1951,6 +1985,11 @@ const LearningSystemV2 = () => {
               <div className={`text-6xl font-bold mb-4 ${passed ? 'text-green-600' : 'text-red-600'}`}>
                 {quizScore}%
               </div>
+              {quizResult && (
+                <p className="text-gray-600 mb-4">
+                  Правильных ответов: {quizResult.correct_count} из {quizResult.total_questions}
+                </p>
+              )}
               {passed ? (
                 <div className="flex flex-col items-center gap-2">
                   <CheckCircle className="w-16 h-16 text-green-600" />
@@ -1966,34 +2005,40 @@ const LearningSystemV2 = () => {
               )}
             </div>
 
-            <div className="bg-gray-50 rounded-lg p-6">
-              <h4 className="font-semibold mb-4">Детальные результаты:</h4>
-              <div className="space-y-3">
-                {currentLesson.quiz.questions.map((question, index) => {
-                  const userAnswer = quizAnswers[question.id];
-                  const isCorrect = userAnswer === question.correct_answer;
+            {quizResult && (
+              <div className="bg-gray-50 rounded-lg p-6">
+                <h4 className="font-semibold mb-4">Детальные результаты:</h4>
+                <div className="space-y-3">
+                  {currentLesson.quiz.questions.map((question, index) => {
+                    const userAnswer = quizAnswers[question.id];
+                    const result = resultsByQuestion[question.id] || {};
+                    const isCorrect = result.is_correct === true;
                   
-                  return (
-                    <div key={question.id} className={`p-4 rounded-lg border ${isCorrect ? 'bg-green-50 border-green-200' : 'bg-red-50 border-red-200'}`}>
-                      <div className="flex items-start gap-3">
-                        {isCorrect ? (
-                          <CheckCircle className="w-5 h-5 text-green-600 flex-shrink-0 mt-1" />
-                        ) : (
-                          <Target className="w-5 h-5 text-red-600 flex-shrink-0 mt-1" />
-                        )}
-                        <div className="flex-1">
-                          <p className="font-medium mb-2">{index + 1}. {question.question}</p>
-                          <p className="text-sm text-gray-600">Ваш ответ: {userAnswer || 'Не отвечено'}</p>
-                          {!isCorrect && (
-                            <p className="text-sm text-green-700 mt-1">Правильный ответ: {question.correct_answer}</p>
+                    return (
+                      <div key={question.id} className={`p-4 rounded-lg border ${isCorrect ? 'bg-green-50 border-green-200' : 'bg-red-50 border-red-200'}`}>
+                        <div className="flex items-start gap-3">
+                          {isCorrect ? (
+                            <CheckCircle className="w-5 h-5 text-green-600 flex-shrink-0 mt-1" />
+                          ) : (
+                            <Target className="w-5 h-5 text-red-600 flex-shrink-0 mt-1" />
                           )}
+                          <div className="flex-1">
+                            <p className="font-medium mb-2">{index + 1}. {question.question}</p>
+                            <p className="text-sm text-gray-600">Ваш ответ: {userAnswer || 'Не отвечено'}</p>
+                            {!isCorrect && result.correct_answer && (
+                              <p className="text-sm text-green-700 mt-1">Правильный ответ: {result.correct_answer}</p>
+                            )}
+                            {result.explanation && (
+                              <p className="text-sm text-gray-600 mt-1">{result.explanation}</p>
+                            )}
+                          </div>
                         </div>
                       </div>
-                    </div>
-                  );
-                })}
+                    );
+                  })}
+                </div>
               </div>
-            </div>
+            )}
 
             <div className="flex justify-center gap-4">
               <Button onClick={restartQuiz} variant="outline">
@@ -2147,10 +2192,10 @@ const LearningSystemV2 = () => {
             {currentQuestionIndex === totalQuestions - 1 ? (
               <Button
                 onClick={submitQuiz}
-                disabled={!allQuestionsAnswered}
+                disabled={!allQuestionsAnswered || submittingQuiz}
                 className="flex items-center gap-2 bg-green-600 hover:bg-green-700"
               >
-                Завершить тест
+                {submittingQuiz ? 'Проверка...' : 'Завершить тест'}
                 <CheckCircle className="w-4 h-4" />
               </Button>
             ) : (
@@ -2171,6 +2216,12 @@ const LearningSystemV2 = () => {
               </AlertDescription>
             </Alert>
           )}
+
+          {quizError && (
+            <Alert variant="destructive">
+              <AlertDescription>{quizError}</AlertDescription>
+            </Alert>
+          )}
           
           {/* Файлы для теста */}
           {renderFilesSection('quiz')}
@@ -3241,7 +3292,7 @@ const LearningSystemV2 = () => {
                     style={{ transform: `rotate(${imageRotation}deg)`, transition: 'transform 0.3s ease' }}
                   >
                     <img
-                      src={`${backendUrl}/uploads/learning_v2/${viewingFile.stored_name}`}
+                      src={viewingFileUrl || undefined}
                       alt={viewingFile.original_name}
                       className="max-w-full max-h-full object-contain rounded-lg shadow-lg"
                     />
@@ -3255,7 +3306,7 @@ const LearningSystemV2 = () => {
                   <video
                     controls
                     className="max-w-full max-h-full rounded-lg shadow-lg"
-                    src={`${backendUrl}/uploads/learning_v2/${viewingFile.stored_name}`}
+                    src={viewingFileUrl || undefined}
                   >
                     Ваш браузер не поддерживает воспроизведение видео.
                   </video>
@@ -3265,7 +3316,7 @@ const LearningSystemV2 = () => {
               {/* PDF */}
               {viewingFile.extension === 'pdf' && (
                 <iframe
-                  src={`${backendUrl}/uploads/learning_v2/${viewingFile.stored_name}`}
+                  src={viewingFileUrl || undefined}
                   className="w-full h-full rounded-lg shadow-lg"
                   title={viewingFile.original_name}
                 />
@@ -3275,7 +3326,7 @@ const LearningSystemV2 = () => {
               {viewingFile.mime_type?.startsWith('text/') && (
                 <div className="bg-white p-6 rounded-lg shadow-lg h-full overflow-auto">
                   <iframe
-                    src={`${backendUrl}/uploads/learning_v2/${viewingFile.stored_name}`}
+                    src={viewingFileUrl || undefined}
                     className="w-full h-full border-0"
                     title={viewingFile.original_name}
                   />
@@ -3350,7 +3401,7 @@ const LearningSystemV2 = () => {
                 </Button>
                 <Button
                   onClick={() => {
-                    window.open(`${backendUrl}/uploads/learning_v2/${viewingFile.stored_name}`, '_blank');
+                    handleOpenFileInNewTab(viewingFile);
                   }}
                   className="bg-blue-600 hover:bg-blue-700 text-white"
                 >
@@ -7,6 +7,8 @@ import { Label } from './ui/label';
 import { Textarea } from './ui/textarea';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from './ui/select';
 import { Edit, Save, X, Plus, Trash2, BookOpen, Brain, Users, FileText, BarChart3, Upload, Calendar, Eye, Download, ExternalLink } from 'lucide-react';
+import { CHUNKED_UPLOAD_THRESHOLD, uploadFileInChunks } from '../utils/chunkedUpload';
+import { fetchStreamUrl, openFileInNewTab } from '../utils/fileLinks';
 
 const LessonEditModal = ({ 
   lesson, 
@@ -20,6 +22,11 @@ const LessonEditModal = ({
   const [analyticsData, setAnalyticsData] = useState(null);
   const [studentResponses, setStudentResponses] = useState([]);
   const [challengeNotes, setChallengeNotes] = useState([]);
+  const [challengeNotesTotal, setChallengeNotesTotal] = useState(0);
+  const [challengeNotesCursor, setChallengeNotesCursor] = useState(null);
+  const [challengeNotesSearch, setChallengeNotesSearch] = useState('');
+  const [challengeNotesQuery, setChallengeNotesQuery] = useState('');
+  const [loadingChallengeNotes, setLoadingChallengeNotes] = useState(false);
   const [loadingAnalytics, setLoadingAnalytics] = useState(false);
   const [reviewingResponse, setReviewingResponse] = useState(null);
   const [adminComment, setAdminComment] = useState('');
@@ -32,6 +39,8 @@ const LessonEditModal = ({
   
   // Состояния для модальных окон просмотра
   const [viewingFile, setViewingFile] = useState(null);
+  // Подписанная ссылка на просматриваемый файл (токен сессии в URL не передается)
+  const [viewingFileUrl, setViewingFileUrl] = useState(null);
   const [fileViewerOpen, setFileViewerOpen] = useState(false);
   
   // Состояния для трекинга видео
@@ -53,6 +62,46 @@ const LessonEditModal = ({
     }
   }, [activeTab, lesson?.id]);
 
+
+  // Заметки челленджа загружаются постранично: следующая страница - по next_cursor
+  const loadChallengeNotes = async ({ cursor = null, search = '' } = {}) => {
+    if (!lesson?.id) return;
+    
+    try {
+      setLoadingChallengeNotes(true);
+      const params = new URLSearchParams();
+      if (cursor) params.set('cursor', cursor);
+      if (search) params.set('search', search);
+      
+      const notesResponse = await fetch(
+        `http://localhost:8000/api/admin/analytics/challenge-notes/${lesson.id}?${params.toString()}`,
+        {
+          headers: {
+            'Authorization': `Bearer ${localStorage.getItem('token')}`,
+            'Content-Type': 'application/json'
+          }
+        }
+      );
+      
+      if (notesResponse.ok) {
+        const data = await notesResponse.json();
+        setChallengeNotes(prev => (cursor ? [...prev, ...(data.notes || [])] : (data.notes || [])));
+        setChallengeNotesTotal(data.total_notes || 0);
+        setChallengeNotesCursor(data.next_cursor || null);
+      }
+    } catch (error) {
+      console.error('Error loading challenge notes:', error);
+    } finally {
+      setLoadingChallengeNotes(false);
+    }
+  };
+
+  const searchChallengeNotes = () => {
+    const search = challengeNotesSearch.trim();
+    setChallengeNotesQuery(search);
+    loadChallengeNotes({ search });
+  };
+
   const loadAnalytics = async () => {
     try {
       setLoadingAnalytics(true);
@@ -89,21 +138,8 @@ const LessonEditModal = ({
         setStudentResponses(data.responses || []);
       }
       
-      // Загружаем заметки челленджа
-      const notesResponse = await fetch(
-        `http://localhost:8000/api/admin/analytics/challenge-notes/${lesson.id}`,
-        {
-          headers: {
-            'Authorization': `Bearer ${localStorage.getItem('token')}`,
-            'Content-Type': 'application/json'
-          }
-        }
-      );
-      
-      if (notesResponse.ok) {
-        const data = await notesResponse.json();
-        setChallengeNotes(data.notes || []);
-      }
+      // Загружаем заметки челленджа (первая страница)
+      await loadChallengeNotes({ search: challengeNotesQuery });
       
       // Загружаем аналитику файлов
       const filesResponse = await fetch(
@@ -212,6 +248,16 @@ const LessonEditModal = ({
       for (let i = 0; i < files.length; i++) {
         const file = files[i];
         
+        // Большие файлы загружаем по частям с возможностью докачки
+        if (file.size >= CHUNKED_UPLOAD_THRESHOLD) {
+          await uploadFileInChunks('http://localhost:8000', file, {
+            lessonId: lesson.id,
+            section,
+            fileType
+          });
+          continue;
+        }
+        
         // Создаем FormData
         const formData = new FormData();
         formData.append('file', file);
@@ -283,6 +329,30 @@ const LessonEditModal = ({
     }
   }, [activeTab, lesson?.id]);
 
+  // Ссылка на просматриваемый файл запрашивается при открытии просмотра
+  useEffect(() => {
+    setViewingFileUrl(null);
+    if (!viewingFile) return undefined;
+    let cancelled = false;
+    fetchStreamUrl('http://localhost:8000', viewingFile.id)
+      .then(url => {
+        if (!cancelled) setViewingFileUrl(url);
+      })
+      .catch(error => console.error('Error getting file link:', error));
+    return () => {
+      cancelled = true;
+    };
+  }, [viewingFile]);
+
+  const handleOpenFileInNewTab = async (file) => {
+    try {
+      await openFileInNewTab('http://localhost:8000', file.id);
+    } catch (error) {
+      console.error('Error opening file:', error);
+      alert('Ошибка при открытии файла');
+    }
+  };
+
   // Функция для открытия просмотра файла
   const handleViewFile = async (file) => {
     setViewingFile(file);
@@ -2388,13 +2458,33 @@ const LessonEditModal = ({
                   </div>
 
                   {/* Заметки челленджа - компактный дизайн */}
-                  {challengeNotes.length > 0 && (
+                  {(challengeNotesTotal > 0 || challengeNotesQuery) && (
                     <div className="bg-white p-5 rounded-lg border border-gray-200">
                       <h3 className="text-base font-semibold mb-3 flex items-center gap-2">
                         <Calendar className="w-4 h-4 text-purple-600" />
-                        Заметки челленджа ({challengeNotes.length})
+                        Заметки челленджа ({challengeNotesTotal})
                       </h3>
                       
+                      <div className="flex gap-2 mb-3">
+                        <Input
+                          value={challengeNotesSearch}
+                          onChange={(e) => setChallengeNotesSearch(e.target.value)}
+                          onKeyDown={(e) => {
+                            if (e.key === 'Enter') searchChallengeNotes();
+                          }}
+                          placeholder="Поиск по заметкам..."
+                          className="text-sm"
+                        />
+                        <Button
+                          size="sm"
+                          variant="outline"
+                          onClick={searchChallengeNotes}
+                          disabled={loadingChallengeNotes}
+                        >
+                          Найти
+                        </Button>
+                      </div>
+                      
                       <div className="space-y-2 max-h-96 overflow-y-auto">
                         {challengeNotes.map((note, index) => (
                           <div 
@@ -2425,6 +2515,24 @@ const LessonEditModal = ({
                             </div>
                           </div>
                         ))}
+                        
+                        {challengeNotes.length === 0 && (
+                          <p className="text-sm text-gray-500">Заметки не найдены</p>
+                        )}
+                        
+                        {challengeNotesCursor && (
+                          <Button
+                            size="sm"
+                            variant="outline"
+                            className="w-full"
+                            onClick={() => loadChallengeNotes({ cursor: challengeNotesCursor, search: challengeNotesQuery })}
+                            disabled={loadingChallengeNotes}
+                          >
+                            {loadingChallengeNotes
+                              ? 'Загрузка...'
+                              : `Загрузить еще (${challengeNotes.length} из ${challengeNotesTotal})`}
+                          </Button>
+                        )}
                       </div>
                     </div>
                   )}
@@ -2557,7 +2665,7 @@ const LessonEditModal = ({
               {viewingFile.mime_type?.startsWith('image/') && (
                 <div className="flex items-center justify-center h-full">
                   <img
-                    src={`http://localhost:8000/uploads/learning_v2/${viewingFile.stored_name}`}
+                    src={viewingFileUrl || undefined}
                     alt={viewingFile.original_name}
                     className="max-w-full max-h-full object-contain rounded-lg shadow-lg"
                   />
@@ -2570,7 +2678,7 @@ const LessonEditModal = ({
                   <video
                     controls
                     className="max-w-full max-h-full rounded-lg shadow-lg"
-                    src={`http://localhost:8000/uploads/learning_v2/${viewingFile.stored_name}`}
+                    src={viewingFileUrl || undefined}
                   >
                     Ваш браузер не поддерживает воспроизведение видео.
                   </video>
@@ -2580,7 +2688,7 @@ const LessonEditModal = ({
               {/* PDF */}
               {viewingFile.extension === 'pdf' && (
                 <iframe
-                  src={`http://localhost:8000/uploads/learning_v2/${viewingFile.stored_name}`}
+                  src={viewingFileUrl || undefined}
                   className="w-full h-full rounded-lg shadow-lg"
                   title={viewingFile.original_name}
                 />
@@ -2590,7 +2698,7 @@ const LessonEditModal = ({
               {viewingFile.mime_type?.startsWith('text/') && (
                 <div className="bg-white p-6 rounded-lg shadow-lg h-full overflow-auto">
                   <iframe
-                    src={`http://localhost:8000/uploads/learning_v2/${viewingFile.stored_name}`}
+                    src={viewingFileUrl || undefined}
                     className="w-full h-full border-0"
                     title={viewingFile.original_name}
                   />
@@ -2639,7 +2747,7 @@ const LessonEditModal = ({
               </Button>
               <Button
                 onClick={() => {
-                  window.open(`http://localhost:8000/uploads/learning_v2/${viewingFile.stored_name}`, '_blank');
+                  handleOpenFileInNewTab(viewingFile);
                 }}
                 className="bg-blue-600 hover:bg-blue-700 text-white"
               >
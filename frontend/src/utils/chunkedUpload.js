@@ -0,0 +1,150 @@
+// Возобновляемая загрузка больших файлов по частям через /api/admin/upload-sessions.
+// Части отправляются параллельно; id сессии хранится в localStorage, поэтому после
+// обрыва связи или перезагрузки страницы догружаются только недостающие части.
+
+export const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024; // 32 МБ
+const PARALLEL_CHUNKS = 4;
+const MAX_CHUNK_RETRIES = 3;
+const ASSEMBLY_POLL_INTERVAL = 2000; // мс
+
+const sessionStorageKey = (file, lessonId, section) =>
+  `upload-session:${lessonId}:${section}:${file.name}:${file.size}:${file.lastModified}`;
+
+const authHeaders = () => ({
+  'Authorization': `Bearer ${localStorage.getItem('token')}`
+});
+
+const readError = async (response, fallback) => {
+  try {
+    const error = await response.json();
+    return new Error(error.detail || fallback);
+  } catch (e) {
+    return new Error(fallback);
+  }
+};
+
+const getSession = (backendUrl, sessionId) =>
+  fetch(`${backendUrl}/api/admin/upload-sessions/${sessionId}`, {
+    headers: authHeaders()
+  });
+
+const findResumableSession = async (backendUrl, storageKey) => {
+  const sessionId = localStorage.getItem(storageKey);
+  if (!sessionId) return null;
+
+  const response = await getSession(backendUrl, sessionId);
+  if (!response.ok) {
+    localStorage.removeItem(storageKey);
+    return null;
+  }
+  const session = await response.json();
+  // assembling - сервер еще склеивает файл: части уже получены, ждем завершения
+  if (!['active', 'assembling', 'completed'].includes(session.status)) {
+    localStorage.removeItem(storageKey);
+    return null;
+  }
+  return session;
+};
+
+const createSession = async (backendUrl, file, { lessonId, section, fileType }) => {
+  const response = await fetch(`${backendUrl}/api/admin/upload-sessions`, {
+    method: 'POST',
+    headers: { ...authHeaders(), 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      filename: file.name,
+      file_size: file.size,
+      lesson_id: lessonId,
+      section,
+      file_type: fileType,
+      mime_type: file.type || null
+    })
+  });
+  if (!response.ok) {
+    throw await readError(response, 'Ошибка создания сессии загрузки');
+  }
+  return response.json();
+};
+
+const uploadChunk = async (backendUrl, session, file, index) => {
+  const start = index * session.chunk_size;
+  const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+
+  for (let attempt = 1; ; attempt++) {
+    let response = null;
+    try {
+      response = await fetch(
+        `${backendUrl}/api/admin/upload-sessions/${session.session_id}/chunks/${index}`,
+        {
+          method: 'PUT',
+          headers: { ...authHeaders(), 'Content-Type': 'application/octet-stream' },
+          body: blob
+        }
+      );
+    } catch (error) {
+      // Сетевая ошибка - повторяем
+      if (attempt >= MAX_CHUNK_RETRIES) throw error;
+    }
+    if (response) {
+      if (response.ok) return;
+      // Ошибки клиента (4xx) повторять бессмысленно - сразу прерываем загрузку
+      if (response.status < 500 || attempt >= MAX_CHUNK_RETRIES) {
+        throw await readError(response, `Ошибка загрузки части ${index}`);
+      }
+    }
+    await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+  }
+};
+
+const completeSession = async (backendUrl, sessionId) => {
+  for (;;) {
+    const response = await fetch(
+      `${backendUrl}/api/admin/upload-sessions/${sessionId}/complete`,
+      { method: 'POST', headers: authHeaders() }
+    );
+    if (response.ok) return response.json();
+
+    // 409: склейку выполняет другой вызов (например, до перезагрузки страницы) -
+    // ждем, пока сессия выйдет из assembling; зависшую склейку сервер захватит заново по таймауту
+    if (response.status === 409) {
+      const sessionResponse = await getSession(backendUrl, sessionId);
+      const session = sessionResponse.ok ? await sessionResponse.json() : null;
+      if (session && (session.status === 'assembling' || session.status === 'completed')) {
+        await new Promise(resolve => setTimeout(resolve, ASSEMBLY_POLL_INTERVAL));
+        continue;
+      }
+    }
+    throw await readError(response, 'Ошибка завершения загрузки');
+  }
+};
+
+export const uploadFileInChunks = async (backendUrl, file, { lessonId, section, fileType, onProgress }) => {
+  const storageKey = sessionStorageKey(file, lessonId, section);
+
+  let session = await findResumableSession(backendUrl, storageKey);
+  if (!session) {
+    session = await createSession(backendUrl, file, { lessonId, section, fileType });
+    localStorage.setItem(storageKey, session.session_id);
+  }
+
+  if (session.status === 'active') {
+    const pending = [...session.missing_chunks];
+    let done = session.total_chunks - pending.length;
+    onProgress?.(done, session.total_chunks);
+
+    const worker = async () => {
+      while (pending.length > 0) {
+        const index = pending.shift();
+        await uploadChunk(backendUrl, session, file, index);
+        done += 1;
+        onProgress?.(done, session.total_chunks);
+      }
+    };
+    await Promise.all(
+      Array.from({ length: Math.min(PARALLEL_CHUNKS, pending.length) }, worker)
+    );
+  }
+
+  const result = await completeSession(backendUrl, session.session_id);
+  localStorage.removeItem(storageKey);
+  return result;
+};
@@ -0,0 +1,43 @@
+// Ссылки на файлы уроков без токена сессии в URL.
+// <img>/<video>/<iframe> не умеют передавать заголовок Authorization, поэтому для них
+// запрашивается подписанная ссылка на один файл с ограниченным сроком действия.
+// «Открыть в новой вкладке» загружает файл с заголовком и открывает его как blob.
+
+const authHeaders = () => ({
+  'Authorization': `Bearer ${localStorage.getItem('token')}`
+});
+
+export const fetchStreamUrl = async (backendUrl, fileId) => {
+  const response = await fetch(`${backendUrl}/api/stream-url/${fileId}`, {
+    headers: authHeaders()
+  });
+  if (!response.ok) {
+    throw new Error(`Ошибка получения ссылки на файл: ${response.status}`);
+  }
+  const data = await response.json();
+  return `${backendUrl}${data.url}`;
+};
+
+export const openFileInNewTab = async (backendUrl, fileId) => {
+  // Вкладка открывается сразу (до await), иначе браузер заблокирует всплывающее окно
+  const tab = window.open('', '_blank');
+  try {
+    const response = await fetch(`${backendUrl}/api/download-file/${fileId}`, {
+      headers: authHeaders()
+    });
+    if (!response.ok) {
+      throw new Error(`Ошибка загрузки файла: ${response.status}`);
+    }
+    const url = window.URL.createObjectURL(await response.blob());
+    if (tab) {
+      tab.location.href = url;
+    } else {
+      window.open(url, '_blank');
+    }
+    // Вкладка уже загрузила файл - ссылку можно освободить
+    setTimeout(() => window.URL.revokeObjectURL(url), 60000);
+  } catch (error) {
+    tab?.close();
+    throw error;
+  }
+};
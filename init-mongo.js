@@ -9,6 +9,8 @@ print("Creating indexes for lessons_v2...");
 db.lessons_v2.createIndex({ "id": 1 }, { unique: true });
 db.lessons_v2.createIndex({ "is_active": 1 });
 db.lessons_v2.createIndex({ "order": 1 });
+db.lessons_v2.createIndex({ "order": 1, "id": 1 }); // Курсорная пагинация списков уроков
+db.lessons_v2.createIndex({ "is_active": 1, "order": 1, "id": 1 });
 db.lessons_v2.createIndex({ "created_at": -1 });
 db.lessons_v2.createIndex({ "updated_at": -1 });
 
@@ -31,6 +33,7 @@ db.lesson_progress.createIndex({ "id": 1 }, { unique: true });
 db.lesson_progress.createIndex({ "user_id": 1, "lesson_id": 1 }, { unique: true });
 db.lesson_progress.createIndex({ "user_id": 1 });
 db.lesson_progress.createIndex({ "lesson_id": 1 });
+db.lesson_progress.createIndex({ "lesson_id": 1, "user_id": 1 });
 db.lesson_progress.createIndex({ "is_completed": 1 });
 db.lesson_progress.createIndex({ "completion_percentage": -1 });
 db.lesson_progress.createIndex({ "last_activity_at": -1 });
@@ -49,6 +52,20 @@ db.quiz_attempts.createIndex({ "passed": 1 });
 db.quiz_attempts.createIndex({ "score": -1 });
 db.quiz_attempts.createIndex({ "started_at": -1 });
 db.quiz_attempts.createIndex({ "completed_at": -1 });
+db.quiz_attempts.createIndex({ "lesson_id": 1, "key_version": 1 });
+
+// ===== КОЛЛЕКЦИЯ: quiz_answer_keys =====
+// Скомпилированные ключи ответов тестов (по одному на урок)
+print("Creating indexes for quiz_answer_keys...");
+db.quiz_answer_keys.createIndex({ "lesson_id": 1 }, { unique: true });
+
+// ===== КОЛЛЕКЦИЯ: quiz_regrade_jobs =====
+// Задачи переоценки попыток после изменения теста
+print("Creating indexes for quiz_regrade_jobs...");
+db.quiz_regrade_jobs.createIndex({ "id": 1 }, { unique: true });
+db.quiz_regrade_jobs.createIndex({ "lesson_id": 1, "started_at": -1 });
+// Не больше одной выполняемой задачи на урок (между воркерами)
+db.quiz_regrade_jobs.createIndex({ "lesson_id": 1 }, { unique: true, partialFilterExpression: { "status": "running" } });
 
 // ===== КОЛЛЕКЦИЯ: challenge_progress =====
 // Хранит прогресс студентов по челленджам (множественные попытки)
@@ -56,6 +73,11 @@ print("Creating indexes for challenge_progress...");
 db.challenge_progress.createIndex({ "id": 1 }, { unique: true });
 // УДАЛЕН уникальный индекс для множественных попыток
 db.challenge_progress.createIndex({ "user_id": 1, "lesson_id": 1, "challenge_id": 1 });
+// Не больше одной активной (незавершенной) попытки на студента и челлендж
+db.challenge_progress.createIndex(
+  { "user_id": 1, "lesson_id": 1, "challenge_id": 1 },
+  { unique: true, partialFilterExpression: { "is_completed": false }, name: "active_attempt_unique" }
+);
 db.challenge_progress.createIndex({ "user_id": 1 });
 db.challenge_progress.createIndex({ "lesson_id": 1 });
 db.challenge_progress.createIndex({ "challenge_id": 1 });
@@ -66,6 +88,18 @@ db.challenge_progress.createIndex({ "completed_at": -1 });
 db.challenge_progress.createIndex({ "attempt_number": 1 });
 db.challenge_progress.createIndex({ "points_earned": -1 });
 
+// ===== КОЛЛЕКЦИЯ: challenge_notes =====
+// Заметки студентов по дням челленджа (по документу на попытку и день)
+print("Creating indexes for challenge_notes...");
+db.challenge_notes.createIndex({ "id": 1 }, { unique: true });
+db.challenge_notes.createIndex({ "lesson_id": 1, "completed_at": -1, "id": -1 });
+db.challenge_notes.createIndex({ "lesson_id": 1, "user_id": 1, "completed_at": -1 });
+db.challenge_notes.createIndex({ "progress_id": 1 });
+db.challenge_notes.createIndex(
+  { "lesson_id": 1, "note": "text" },
+  { default_language: "russian", name: "lesson_note_text" }
+);
+
 // ===== КОЛЛЕКЦИЯ: time_activity =====
 // Хранит время активности студентов и начисленные баллы
 print("Creating indexes for time_activity...");
@@ -98,6 +132,21 @@ db.files.createIndex({ "file_type": 1 }); // media, document
 db.files.createIndex({ "uploaded_by": 1 });
 db.files.createIndex({ "uploaded_at": -1 });
 db.files.createIndex({ "original_name": 1 });
+db.files.createIndex({ "checksum_sha256": 1 });
+
+// ===== КОЛЛЕКЦИЯ: file_blobs =====
+// Содержимое файлов в хранилище uploads/blobs и счетчики ссылок на него
+print("Creating indexes for file_blobs...");
+db.file_blobs.createIndex({ "sha256": 1 }, { unique: true });
+
+// ===== КОЛЛЕКЦИЯ: upload_sessions =====
+// Сессии возобновляемой загрузки больших файлов по частям
+print("Creating indexes for upload_sessions...");
+db.upload_sessions.createIndex({ "id": 1 }, { unique: true });
+db.upload_sessions.createIndex({ "status": 1, "updated_at": -1 });
+db.upload_sessions.createIndex({ "created_by": 1, "created_at": -1 });
+// Просроченные сессии удаляются по expires_at (части на диске удаляет очистка на сервере)
+db.upload_sessions.createIndex({ "expires_at": 1 }, { expireAfterSeconds: 0 });
 
 // ===== КОЛЛЕКЦИЯ: file_analytics =====
 // Аналитика просмотров и скачиваний файлов
@@ -110,6 +159,7 @@ db.file_analytics.createIndex({ "action": 1 }); // 'view' или 'download'
 db.file_analytics.createIndex({ "created_at": -1 });
 db.file_analytics.createIndex({ "file_id": 1, "user_id": 1 });
 db.file_analytics.createIndex({ "file_id": 1, "action": 1 });
+db.file_analytics.createIndex({ "user_id": 1, "lesson_id": 1, "file_id": 1, "action": 1 });
 
 // ===== КОЛЛЕКЦИЯ: video_watch_time =====
 // Отслеживание времени просмотра видео для начисления баллов
@@ -122,6 +172,36 @@ db.video_watch_time.createIndex({ "total_minutes": -1 });
 db.video_watch_time.createIndex({ "total_points": -1 });
 db.video_watch_time.createIndex({ "last_updated": -1 });
 
+// ===== КОЛЛЕКЦИИ: file_stats, file_user_stats =====
+// Счетчики просмотров/скачиваний по файлу и по паре (файл, студент)
+print("Creating indexes for file_stats...");
+db.file_stats.createIndex({ "file_id": 1 }, { unique: true });
+db.file_stats.createIndex({ "lesson_id": 1 });
+db.file_user_stats.createIndex({ "file_id": 1, "user_id": 1 }, { unique: true });
+db.file_user_stats.createIndex({ "user_id": 1, "lesson_id": 1 });
+
+// ===== КОЛЛЕКЦИЯ: points_ledger =====
+// Журнал начислений баллов (только добавление)
+print("Creating indexes for points_ledger...");
+db.points_ledger.createIndex({ "id": 1 }, { unique: true });
+db.points_ledger.createIndex({ "user_id": 1, "created_at": -1 });
+db.points_ledger.createIndex({ "lesson_id": 1, "source": 1 });
+// Записи, еще не примененные к балансам (фоновая задача на сервере)
+db.points_ledger.createIndex({ "created_at": 1 }, { partialFilterExpression: { "applied": false } });
+
+// ===== КОЛЛЕКЦИЯ: points_balances =====
+// Балансы баллов студентов: общий (lesson_id = null) и по урокам
+print("Creating indexes for points_balances...");
+db.points_balances.createIndex({ "user_id": 1, "lesson_id": 1 }, { unique: true });
+db.points_balances.createIndex({ "lesson_id": 1, "balance": -1 });
+
+// ===== КОЛЛЕКЦИЯ: activity_daily =====
+// Дневные сводки активности: scope "user" (по студенту) и "lesson" (по уроку)
+print("Creating indexes for activity_daily...");
+db.activity_daily.createIndex({ "id": 1 }, { unique: true });
+db.activity_daily.createIndex({ "scope": 1, "scope_id": 1, "date": -1 }, { unique: true });
+db.activity_daily.createIndex({ "scope": 1, "date": -1 });
+
 // ===== КОЛЛЕКЦИЯ: users =====
 // Хранит информацию о пользователях
 print("Creating indexes for users...");
@@ -140,12 +220,19 @@ print("  • lessons_v2 - Уроки с контентом");
 print("  • exercise_responses - Ответы на упражнения");
 print("  • lesson_progress - Прогресс по урокам");
 print("  • quiz_attempts - Попытки прохождения тестов");
+print("  • quiz_answer_keys - Ключи ответов тестов");
+print("  • quiz_regrade_jobs - Задачи переоценки попыток тестов");
 print("  • challenge_progress - Прогресс по челленджам");
+print("  • challenge_notes - Заметки по дням челленджей");
 print("  • time_activity - Время активности и баллы");
 print("  • files - Метаданные загруженных файлов");
 print("  • file_analytics - Аналитика просмотров/скачиваний файлов");
 print("  • video_watch_time - Время просмотра видео и баллы");
 print("  • student_analytics - Общая аналитика студентов");
+print("  • file_stats, file_user_stats - Счетчики файлов");
+print("  • points_ledger - Журнал начислений баллов");
+print("  • points_balances - Балансы баллов и уровни");
+print("  • activity_daily - Дневные сводки активности");
 print("  • users - Пользователи системы");
 print("========================================");
 print("All indexes created successfully!");
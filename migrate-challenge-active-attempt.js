@@ -0,0 +1,44 @@
+// Миграция: уникальный частичный индекс активной попытки для challenge_progress
+// Гарантирует не больше одной незавершенной попытки на студента и челлендж
+
+db = db.getSiblingDB('learning_v2');
+
+print("Starting migration: Adding active attempt index to challenge_progress...");
+
+// Ищем дубликаты активных попыток, оставшиеся после гонок параллельных сохранений
+const duplicates = db.challenge_progress.aggregate([
+    { $match: { is_completed: false } },
+    { $group: {
+        _id: { user_id: "$user_id", lesson_id: "$lesson_id", challenge_id: "$challenge_id" },
+        ids: { $push: "$id" },
+        count: { $sum: 1 }
+    } },
+    { $match: { count: { $gt: 1 } } }
+]).toArray();
+
+if (duplicates.length > 0) {
+    print("\n========================================");
+    print("Found " + duplicates.length + " duplicate active attempts:");
+    duplicates.forEach(function (item) {
+        print("  • " + JSON.stringify(item._id) + " -> " + item.ids.join(", "));
+    });
+    print("Resolve duplicates manually and run the migration again.");
+    print("========================================\n");
+} else {
+    try {
+        db.challenge_progress.createIndex(
+            { "user_id": 1, "lesson_id": 1, "challenge_id": 1 },
+            { unique: true, partialFilterExpression: { "is_completed": false }, name: "active_attempt_unique" }
+        );
+        print("✓ Index active_attempt_unique created successfully");
+        
+        print("\n========================================");
+        print("Migration completed successfully!");
+        print("========================================\n");
+    } catch (error) {
+        print("\n========================================");
+        print("Migration error:");
+        print(error);
+        print("========================================\n");
+    }
+}
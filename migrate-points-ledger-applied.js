@@ -0,0 +1,21 @@
+// Миграция: индекс не примененных записей points_ledger
+// Начисления, балансы которых не обновились, помечаются applied: false и доводятся фоновой
+// задачей сервера; существующие записи поля не имеют и считаются примененными
+
+db = db.getSiblingDB('learning_v2');
+
+print("Starting migration: Adding unapplied entries index to points_ledger...");
+
+try {
+    db.points_ledger.createIndex({ "created_at": 1 }, { partialFilterExpression: { "applied": false } });
+    print("✓ Partial index on created_at (applied: false) created successfully");
+    
+    print("\n========================================");
+    print("Migration completed successfully!");
+    print("========================================\n");
+} catch (error) {
+    print("\n========================================");
+    print("Migration error:");
+    print(error);
+    print("========================================\n");
+}
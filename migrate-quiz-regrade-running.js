@@ -0,0 +1,28 @@
+// Миграция: не больше одной выполняемой задачи переоценки на урок
+// Сервер занимает урок, переводя задачу в status: "running"; уникальный частичный индекс
+// не дает сделать это второй задаче того же урока (в том числе из другого воркера)
+
+db = db.getSiblingDB('learning_v2');
+
+print("Starting migration: Adding running job index to quiz_regrade_jobs...");
+
+try {
+    // Задачи, оставшиеся в работе от прежних версий сервера, не должны блокировать индекс
+    const stale = db.quiz_regrade_jobs.updateMany(
+        { "status": "running" },
+        { $set: { "status": "failed", "error": "Прервана при обновлении", "finished_at": new Date() } }
+    );
+    print(`✓ Marked ${stale.modifiedCount} unfinished jobs as failed`);
+    
+    db.quiz_regrade_jobs.createIndex({ "lesson_id": 1 }, { unique: true, partialFilterExpression: { "status": "running" } });
+    print("✓ Unique partial index on lesson_id (status: running) created successfully");
+    
+    print("\n========================================");
+    print("Migration completed successfully!");
+    print("========================================\n");
+} catch (error) {
+    print("\n========================================");
+    print("Migration error:");
+    print(error);
+    print("========================================\n");
+}
@@ -0,0 +1,27 @@
+// Миграция: TTL-индекс для upload_sessions
+// Сессии загрузки удаляются после expires_at; сессиям без этого поля он проставляется
+// от updated_at (части на диске удаляет фоновая очистка на сервере)
+
+db = db.getSiblingDB('learning_v2');
+
+print("Starting migration: Adding TTL index to upload_sessions...");
+
+try {
+    const result = db.upload_sessions.updateMany(
+        { expires_at: { $exists: false } },
+        [{ $set: { expires_at: { $add: ["$updated_at", 24 * 3600 * 1000] } } }]
+    );
+    print("✓ expires_at set for " + result.modifiedCount + " sessions");
+    
+    db.upload_sessions.createIndex({ "expires_at": 1 }, { expireAfterSeconds: 0 });
+    print("✓ TTL index on expires_at created successfully");
+    
+    print("\n========================================");
+    print("Migration completed successfully!");
+    print("========================================\n");
+} catch (error) {
+    print("\n========================================");
+    print("Migration error:");
+    print(error);
+    print("========================================\n");
+}